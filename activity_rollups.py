@@ -0,0 +1,268 @@
+import datetime
+import logging
+
+from activity_store import ActivityStore
+
+
+logger = logging.getLogger(__name__)
+
+
+class FenwickTree:
+    """Binary indexed tree: O(log n) point updates and prefix sums over a growable array."""
+
+    def __init__(self, size=1024):
+        self.tree = [0.0] * (size + 1)
+
+    def __len__(self):
+        return len(self.tree) - 1
+
+    def grow(self, size):
+        """Resizes the tree to at least `size` slots, doubling so growth is amortized O(1), in O(n)."""
+        new_size = max(len(self), 1)
+        while new_size < size:
+            new_size *= 2
+        # recover the slot values by undoing the linear time construction, then redo it at the new size
+        tree = self.tree
+        for i in range(len(tree) - 1, 0, -1):
+            j = i + (i & -i)
+            if j < len(tree):
+                tree[j] -= tree[i]
+        tree = tree + [0.0] * (new_size + 1 - len(tree))
+        for i in range(1, len(tree)):
+            j = i + (i & -i)
+            if j < len(tree):
+                tree[j] += tree[i]
+        self.tree = tree
+
+    def add(self, i, delta):
+        if i >= len(self):
+            self.grow(i + 1)
+        i += 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, i):
+        """Sum of slots [0, i]."""
+        i = min(i, len(self) - 1) + 1
+        s = 0.0
+        while i > 0:
+            s += self.tree[i]
+            i -= i & -i
+        return s
+
+    def range_sum(self, lo, hi):
+        """Sum of slots [lo, hi]."""
+        if hi < lo or hi < 0:
+            return 0.0
+        return self.prefix_sum(hi) - (self.prefix_sum(lo - 1) if lo > 0 else 0.0)
+
+
+class ActivityRollups:
+    """Incremental totals over activity summaries, by sport type and by day, week, month and year.
+
+    * `add`/`remove` cost O(log n). `sync` only applies what changed since the last sync: the changes an ActivityStore
+    logged, or for other mappings the activities newer than the newest one seen (the high-water mark) or not seen yet,
+    so keeping up with new activities is O(delta).
+    * `totals` answers arbitrary date ranges in O(log n) using one Fenwick tree per sport type and metric.
+    * `athlete_stats` derives the same shape as Strava's `/athletes/{id}/stats` locally,
+    so that endpoint only needs to be used to `reconcile` once in a while.
+    """
+    metrics = ("count", "distance", "moving_time", "elapsed_time", "elevation_gain")
+    periods = {
+        "day": "%Y-%m-%d",
+        "week": "%G-W%V",
+        "month": "%Y-%m",
+        "year": "%Y",
+    }
+    # how Strava groups sport types into the run/ride/swim totals of athlete stats
+    stats_groups = {
+        "run": ("Run", "TrailRun", "VirtualRun"),
+        "ride": ("Ride", "MountainBikeRide", "GravelRide", "EBikeRide", "EMountainBikeRide", "VirtualRide", "Velomobile", "Handcycle"),
+        "swim": ("Swim",),
+    }
+    epoch = datetime.date(2009, 1, 1)  # Strava was founded in 2009, day indices count from here
+    all_sports = "*"
+
+    def __init__(self, activities=None):
+        self.activities = {}  # {activity_id: (sport_type, date, values)}
+        self.trees = {}  # {sport_type: {metric: FenwickTree}}
+        self.buckets = {period: {} for period in self.periods}  # {period: {(sport_type, key): [values]}}
+        self.newest = ""  # high-water mark: the latest start_date added
+        self._source = None  # the ActivityStore last synced and the seq of its change log at the time
+        self._source_seq = 0
+        if activities:
+            self.sync(activities)
+
+    @classmethod
+    def parse_date(cls, d):
+        if d is None or isinstance(d, datetime.date) and not isinstance(d, datetime.datetime):
+            return d
+        if isinstance(d, datetime.datetime):
+            return d.date()
+        if isinstance(d, (int, float)):
+            return datetime.date.fromtimestamp(d)
+        return datetime.date.fromisoformat(d[:10])
+
+    def day_index(self, d):
+        return max((d - self.epoch).days, 0)
+
+    @staticmethod
+    def activity_values(activity):
+        return (
+            1,
+            activity.get("distance") or 0.0,
+            activity.get("moving_time") or 0,
+            activity.get("elapsed_time") or 0,
+            activity.get("total_elevation_gain") or 0.0,
+        )
+
+    def _apply(self, sport_type, date, values, sign):
+        i = self.day_index(date)
+        for s in (sport_type, self.all_sports):
+            trees = self.trees.setdefault(s, {m: FenwickTree() for m in self.metrics})
+            for m, v in zip(self.metrics, values):
+                if v:
+                    trees[m].add(i, sign * v)
+            for period, fmt in self.periods.items():
+                bucket = self.buckets[period].setdefault((s, date.strftime(fmt)), [0] * len(self.metrics))
+                for j, v in enumerate(values):
+                    bucket[j] += sign * v
+
+    def add(self, activity):
+        """Adds an activity summary, replacing the previous contribution if the activity was already added."""
+        sport_type = activity.get("sport_type") or activity.get("type")
+        date = self.parse_date(activity.get("start_date_local") or activity["start_date"])
+        values = self.activity_values(activity)
+        entry = (sport_type, date, values)
+        previous = self.activities.get(activity["id"])
+        if previous == entry:
+            return False
+        if previous is not None:
+            self._apply(*previous, sign=-1)
+        self._apply(*entry, sign=1)
+        self.activities[activity["id"]] = entry
+        self.newest = max(self.newest, activity["start_date"] or "")
+        return True
+
+    def remove(self, activity_id):
+        previous = self.activities.pop(activity_id, None)
+        if previous is not None:
+            self._apply(*previous, sign=-1)
+        return previous is not None
+
+    def sync(self, activities, remove_missing=False, full=False):
+        """Adds new or changed activities.
+
+        Args:
+            activities (dict | ActivityStore): {activity_id: activity summary}, e.g. BareStravaAPI.all_activities.
+                Syncing the same ActivityStore again only applies the changes it logged since (including removals).
+                Otherwise only activities newer than the high-water mark or not added yet are applied, edits of older
+                activities need `add` or `full`.
+            remove_missing (bool): Also remove activities which are no longer in `activities`. Defaults to False.
+            full (bool): Compare every activity instead. Defaults to False.
+
+        Returns:
+            int: The number of activities which were added, changed or removed.
+        """
+        is_store = isinstance(activities, ActivityStore)
+        changed = 0
+        if is_store and activities is self._source and not full:
+            ids, self._source_seq = activities.changes_since(self._source_seq)
+            for activity_id in ids:
+                activity = activities.get(activity_id)
+                changed += self.remove(activity_id) if activity is None else self.add(activity)
+            return changed
+        seq = activities.seq if is_store else 0
+        for activity_id, activity in activities.items():
+            if not full and activity_id in self.activities and (activity["start_date"] or "") <= self.newest:
+                continue
+            changed += self.add(activity)
+        if remove_missing:
+            for activity_id in set(self.activities) - set(activities):
+                changed += self.remove(activity_id)
+        self._source, self._source_seq = (activities, seq) if is_store else (None, 0)
+        return changed
+
+    def totals(self, start=None, end=None, sport_type=None):
+        """Returns {metric: total} for activities between start and end (inclusive dates).
+
+        Args:
+            start (datetime.date | datetime.datetime | str | float | None): First day to include. Defaults to the beginning.
+            end (datetime.date | datetime.datetime | str | float | None): Last day to include. Defaults to the end.
+            sport_type (str | tuple[str] | None): Sport type(s) to include. Defaults to all sports.
+        """
+        lo = self.day_index(self.parse_date(start)) if start is not None else 0
+        hi = self.day_index(self.parse_date(end)) if end is not None else None
+        sport_types = (self.all_sports,) if sport_type is None else (sport_type,) if isinstance(sport_type, str) else sport_type
+        totals = dict.fromkeys(self.metrics, 0)
+        for s in sport_types:
+            trees = self.trees.get(s)
+            if trees is None:
+                continue
+            for m in self.metrics:
+                tree = trees[m]
+                totals[m] += tree.range_sum(lo, len(tree) - 1 if hi is None else hi)
+        totals["count"] = round(totals["count"])
+        return totals
+
+    def period_totals(self, period="month", sport_type=None):
+        """Returns [(key, {metric: total})] sorted by key, e.g. [("2024-05", {...}), ("2024-06", {...})]
+
+        Args:
+            period (str): One of "day", "week", "month" or "year". Defaults to "month".
+            sport_type (str | None): Only include this sport type. Defaults to all sports.
+        """
+        if period not in self.periods:
+            raise ValueError(f"period must be one of {list(self.periods)}")
+        s = self.all_sports if sport_type is None else sport_type
+        return sorted(
+            (key, dict(zip(self.metrics, values)))
+            for (bucket_sport, key), values in self.buckets[period].items()
+            if bucket_sport == s and values[0]
+        )
+
+    def athlete_stats(self, today=None):
+        """Derives the totals of Strava's `/athletes/{id}/stats` from the rolled up activities.
+
+        Recent totals cover the last 4 weeks, ytd totals the current calendar year.
+        """
+        today = self.parse_date(today) or datetime.date.today()
+        starts = {
+            "recent": today - datetime.timedelta(days=27),
+            "ytd": datetime.date(today.year, 1, 1),
+            "all": None,
+        }
+        stats = {}
+        for name, start in starts.items():
+            for group, sport_types in self.stats_groups.items():
+                stats[f"{name}_{group}_totals"] = self.totals(start, today, sport_type=sport_types)
+        rides = [v for s, d, v in self.activities.values() if s in self.stats_groups["ride"]]
+        stats["biggest_ride_distance"] = max((v[1] for v in rides), default=0.0)
+        stats["biggest_climb_elevation_gain"] = max((v[4] for v in rides), default=0.0)
+        return stats
+
+    def reconcile(self, strava_stats, today=None, tolerance=0.01):
+        """Compares the local rollups against stats returned by Strava and logs any discrepancy.
+
+        Args:
+            strava_stats (dict): The response of BareStravaAPI.get_athlete_stats
+            tolerance (float): Relative difference which is still considered equal. Defaults to 0.01.
+
+        Returns:
+            dict: {(totals key, metric): (local, strava)} for every metric which is off by more than the tolerance.
+        """
+        local = self.athlete_stats(today=today)
+        differences = {}
+        for key, strava_totals in strava_stats.items():
+            if not key.endswith("_totals") or key not in local:
+                continue
+            for metric, strava_value in strava_totals.items():
+                if metric not in self.metrics:
+                    continue
+                local_value = local[key][metric]
+                if abs(local_value - strava_value) > tolerance * max(abs(strava_value), 1):
+                    differences[(key, metric)] = (local_value, strava_value)
+        if differences:
+            logger.warning(f"Local rollups differ from Strava athlete stats: {differences}")
+        return differences
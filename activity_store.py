@@ -0,0 +1,287 @@
+import json
+import sys
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+
+
+def without_deleted(activities: list[dict]) -> list[dict]:
+    """Drops the tombstones StravaWebhook leaves in cached list pages in place of deleted activities."""
+    return [activity for activity in activities if not activity.get("deleted")]
+
+
+class ActivitySummary:
+    """Compact record of the activity summary fields we actually use.
+
+    Behaves like a read-only dict: `activity["name"]` and `activity.get("kudos_count")` read the slots directly,
+    any other key (e.g. "map" or "athlete") is looked up in the full raw JSON, which is lazily loaded from the cache.
+    Summaries which are not in a cached list page (fetched with cache=False, or created since the last listing)
+    keep their decoded dict instead.
+    """
+    fields = ("id", "name", "type", "sport_type", "start_date", "start_date_local",
+              "distance", "moving_time", "elapsed_time", "total_elevation_gain",
+              "average_speed", "max_speed", "average_heartrate", "max_heartrate", "average_watts",
+              "kudos_count", "comment_count", "athlete_count", "achievement_count", "pr_count",
+              "gear_id", "commute", "trainer", "private", "detailed")
+    field_set = frozenset(fields)
+    interned = ("type", "sport_type", "gear_id")
+    __slots__ = fields + ("_store", "_raw")
+
+    def __init__(self, activity: dict, store=None, keep_raw=None):
+        """
+        Args:
+            activity (dict): The activity summary as returned by Strava.
+            store (ActivityStore | None): Where the raw JSON is read from.
+            keep_raw (bool | None): Keep `activity` as the raw JSON. Defaults to None, which keeps it without a store.
+        """
+        for field in self.fields:
+            value = activity.get(field)
+            if field in self.interned and value is not None:
+                value = sys.intern(value)
+            setattr(self, field, value)
+        self._store = store
+        self._raw = activity if (store is None if keep_raw is None else keep_raw) else None
+
+    def __getitem__(self, key):
+        if key in self.field_set:
+            return getattr(self, key)
+        return self.raw()[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self.field_set or key in self.keys()
+
+    def keys(self):
+        try:
+            return self.raw().keys()
+        except KeyError:
+            return self.fields
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def raw(self) -> dict:
+        """The full activity summary as returned by Strava (loaded from the cache on demand)."""
+        if self._raw is not None:
+            return self._raw
+        if self._store is None:
+            return {}
+        return self._store.raw(self.id)
+
+    def to_dict(self) -> dict:
+        return {**self.raw(), **{field: getattr(self, field) for field in self.fields}}
+
+    def __eq__(self, other):
+        if isinstance(other, ActivitySummary):
+            return all(getattr(self, f) == getattr(other, f) for f in self.fields)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"ActivitySummary({self.id}, {self.name!r}, {self.sport_type}, {self.start_date})"
+
+
+class ActivityStore(Mapping):
+    """Dict-like {activity_id: ActivitySummary} which keeps only compact records in memory.
+
+    The full JSON of an activity is read back from the cached `list_activities` response it came from,
+    and the last few decoded pages are kept in a small LRU.
+    """
+
+    def __init__(self, cache=None, url=None, page_cache_size=4):
+        """
+        Args:
+            cache (APICache): Where to read raw responses from. Defaults to None, which disables raw access.
+            url (str): The url of the list_activities route the activities were fetched from.
+            page_cache_size (int): How many decoded response pages to keep. Defaults to 4.
+        """
+        self.cache = cache
+        self.url = url
+        self.page_cache_size = page_cache_size
+        self._records = {}
+        self._rows = {}  # {activity_id: requests row id}, filled in as pages are added or searched
+        self._indexed_rows = set()
+        self._pages = OrderedDict()  # {requests row id: {activity_id: raw activity}}
+        self.last_row = 0  # the newest requests row added with add_page
+        self.newest = ""  # the latest start_date added
+        self.seq = 0  # incremented on every add or remove
+        self._changes = OrderedDict()  # {activity_id: seq of its last add or remove}, oldest change first
+
+    def __getitem__(self, activity_id):
+        return self._records[activity_id]
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, activity_id):
+        return activity_id in self._records
+
+    def __repr__(self):
+        return f"ActivityStore({len(self)} activities)"
+
+    def add(self, activity: dict, row=None, keep_raw=False):
+        """Adds (or replaces) one activity summary.
+
+        Args:
+            activity (dict): The activity summary as returned by Strava.
+            row (int | None): The id of the `requests` row this activity was read from, if known.
+            keep_raw (bool): Keep the decoded dict, for activities which are not in any cached list page. Defaults to False.
+        """
+        record = ActivitySummary(activity, self, keep_raw=keep_raw and row is None)
+        if row is not None:
+            self._rows[record.id] = row
+        existing = self._records.get(record.id)
+        if existing == record:
+            if row is not None:
+                existing._raw = None  # the cached page has it now
+            return existing  # unchanged, e.g. the same page listed again
+        self._records[record.id] = record
+        if record.start_date and record.start_date > self.newest:
+            self.newest = record.start_date
+        self._log(record.id)
+        return record
+
+    def _log(self, activity_id):
+        self.seq += 1
+        self._changes[activity_id] = self.seq
+        self._changes.move_to_end(activity_id)
+
+    def changes_since(self, seq):
+        """Returns ([ids of the activities added, replaced or removed after `seq`], the current seq), in O(changes)."""
+        ids = []
+        for activity_id, changed_at in reversed(self._changes.items()):
+            if changed_at <= seq:
+                break
+            ids.append(activity_id)
+        return ids[::-1], self.seq
+
+    def remove(self, activity_id):
+        """Removes an activity (e.g. one which was deleted on Strava), returning whether it was there."""
+        row = self._rows.pop(activity_id, None)
+        if row is not None:
+            self._pages.pop(row, None)  # the row may be rewritten without it
+        if self._records.pop(activity_id, None) is None:
+            return False
+        self._log(activity_id)
+        return True
+
+    def add_page(self, activities: list[dict], row=None):
+        for activity in without_deleted(activities):
+            self.add(activity, row)
+        if row is not None:
+            self._indexed_rows.add(row)
+            self.last_row = max(self.last_row, row)
+
+    def update(self, other):
+        """Merges another ActivityStore (or dict of activity summaries) into this one, like dict.update"""
+        if isinstance(other, ActivityStore):
+            self._records.update({k: v for k, v in other._records.items()})
+            for record in other._records.values():
+                record._store = self
+                self._log(record.id)
+            self._rows.update(other._rows)
+            self._indexed_rows.update(other._indexed_rows)
+            self.last_row = max(self.last_row, other.last_row)
+            self.newest = max(self.newest, other.newest)
+        else:
+            for activity in other.values():
+                self.add(activity)
+
+    def raw(self, activity_id) -> dict:
+        for _ in range(2):  # the remembered row may have been deleted or rewritten since, then it is searched again
+            row = self._rows.get(activity_id)
+            if row is None:
+                row = self._locate(activity_id)
+            if row is None:
+                break
+            page = self._page(row)
+            if activity_id in page:
+                return page[activity_id]
+            self._rows.pop(activity_id, None)
+        raise KeyError(activity_id)
+
+    def _page(self, row) -> dict:
+        """Returns {activity_id: raw activity} of a cached list page, {} if the row no longer exists."""
+        if row in self._pages:
+            self._pages.move_to_end(row)
+            return self._pages[row]
+        rows = self.cache.select(columns="response_json", id=row)
+        if not rows:
+            self._indexed_rows.discard(row)
+            return {}
+        page = {activity["id"]: activity for activity in self.cache.codec.loads(rows[0])}
+        self._pages[row] = page
+        if len(self._pages) > self.page_cache_size:
+            self._pages.popitem(last=False)
+        return page
+
+    def _locate(self, activity_id):
+        """Searches cached list_activities responses, newest first, for the row containing an activity."""
+        if self.cache is None or self.url is None:
+            return None
+        rows = self.cache.select(columns="id", url=self.url, method="GET", response_code=200, order_by="called_at DESC")
+        for row in rows:
+            if row in self._indexed_rows:
+                continue
+            for other_id in self._page(row):
+                self._rows.setdefault(other_id, row)
+            self._indexed_rows.add(row)
+            if activity_id in self._rows:
+                return self._rows[activity_id]
+        return None
+
+
+def benchmark(n=5000):
+    """Compares memory and filter iteration time of plain dicts against an ActivityStore of n synthetic activities."""
+    import random
+    import tracemalloc
+
+    def synthetic_activity(i):
+        return {
+            "resource_state": 2, "athlete": {"id": 1234, "resource_state": 1}, "name": f"Morning Run {i}",
+            "distance": random.random() * 20000, "moving_time": random.randint(600, 7200),
+            "elapsed_time": random.randint(600, 8000), "total_elevation_gain": random.random() * 300,
+            "type": "Run", "sport_type": random.choice(["Run", "Ride", "TrailRun"]), "workout_type": None, "id": i,
+            "start_date": "2024-05-01T12:00:00Z", "start_date_local": "2024-05-01T05:00:00Z",
+            "timezone": "(GMT-08:00) America/Los_Angeles", "utc_offset": -25200.0, "location_city": None,
+            "location_state": None, "location_country": "United States", "achievement_count": 0, "kudos_count": i % 17,
+            "comment_count": i % 3, "athlete_count": 1, "photo_count": 0,
+            "map": {"id": f"a{i}", "summary_polyline": "".join(random.choices("abcdefghijklmnopqrstuvwxyz_~?@", k=800)),
+                    "resource_state": 2},
+            "trainer": False, "commute": False, "manual": False, "private": False, "visibility": "everyone",
+            "flagged": False, "gear_id": "g123", "start_latlng": [37.7, -122.4], "end_latlng": [37.7, -122.4],
+            "average_speed": 3.1, "max_speed": 5.2, "average_cadence": 80.1, "has_heartrate": True,
+            "average_heartrate": 150.2, "max_heartrate": 180.0, "heartrate_opt_out": False,
+            "display_hide_heartrate_option": True, "elev_high": 100.0, "elev_low": 10.0, "upload_id": i * 10,
+            "upload_id_str": str(i * 10), "external_id": f"garmin_{i}.fit", "from_accepted_tag": False, "pr_count": 0,
+            "total_photo_count": 0, "has_kudoed": False,
+        }
+
+    body = json.dumps([synthetic_activity(i) for i in range(n)])
+    results = {}
+    for name, build in [("dict", lambda a: {x["id"]: x for x in a}),
+                        ("ActivityStore", lambda a: (s := ActivityStore(), s.add_page(a))[0])]:
+        tracemalloc.start()
+        activities = build(json.loads(body))
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        t0 = time.perf_counter()
+        long_runs = [a for a in activities.values() if a.get("distance") > 10000 and a.get("sport_type") == "Run"]
+        t = time.perf_counter() - t0
+        results[name] = {"memory_mb": memory / 1e6, "filter_ms": t * 1000, "matches": len(long_runs)}
+    return results
+
+
+if __name__ == "__main__":
+    for name, result in benchmark().items():
+        print(name, result)
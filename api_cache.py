@@ -1,27 +1,70 @@
+import contextvars
 import datetime
 import json
+import re
 import sqlite3
 import time
 import logging
+import threading
+from contextlib import contextmanager
 
 import requests
 
+from json_codecs import get_codec
+from request_scheduler import Priority
+
 
 logger = logging.getLogger(__name__)
 
+# the requests row id of the response the running response hooks were called with, None if it wasn't cached
+response_row = contextvars.ContextVar("response_row", default=None)
+
 
 class RateLimitError(Exception):
     """Raised when the API rate limit is exceeded."""
     pass
 
 
+class OfflineMissError(LookupError):
+    """Raised by an offline API when the cache has no response for a request."""
+    def __init__(self, url, params=None, as_of=None):
+        self.url = url
+        self.params = params
+        self.as_of = as_of
+        msg = f"No cached response for GET {url} with params {params}"
+        if as_of is not None:
+            msg += f" as of {datetime.datetime.fromtimestamp(as_of)}"
+        super().__init__(msg)
+
+
 class APICache:
-    """SQLite database for caching API requests to avoid rate limits and speed up development."""
-    unspecified = object()
+    """SQLite database for caching API requests to avoid rate limits and speed up development.
 
-    def __init__(self, path, cache_failed_requests=True):
-        self.conn = sqlite3.connect(path)
+    * `select`/`delete` conditions are column=value, or column=(operator, value) with the value bound as a parameter,
+    e.g. `cache.select(columns="url", response_code=("!=", 200), called_at=(">", t))`.
+    * `add_json_column` declares indexed virtual columns over paths of the response bodies of a route,
+    so `query` can filter on response content (e.g. kudos_count=(">", 20)) inside SQLite using the index.
+    """
+    unspecified = object()
+    operators = ("=", "!=", "<>", "<", "<=", ">", ">=", "LIKE", "NOT LIKE", "GLOB", "IN", "NOT IN", "BETWEEN", "IS", "IS NOT")
+    json_path_pattern = re.compile(r"\$(\.[A-Za-z_]\w*|\[\d+\])*")
+    builtin_columns = ("id", "called_at", "called_at_str", "url", "headers", "params", "method", "response_code",
+                       "response_json", "response_headers", "route")
+
+    def __init__(self, path, cache_failed_requests=True, codec=None, metrics=None):
+        """
+        Args:
+            path (str): Path of the SQLite database.
+            cache_failed_requests (bool): Whether to also cache non-200 responses. Defaults to True.
+            codec (str | JSONCodec | None): Codec used to decode response bodies, see json_codecs.get_codec.
+                Defaults to the fastest installed codec.
+            metrics (Metrics | None): Where to record query timings and bytes stored. Defaults to None (disabled).
+        """
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()  # the connection and cursor are shared by every thread using the cache
         self.cache_failed_requests = cache_failed_requests
+        self.codec = get_codec(codec)
+        self.metrics = metrics
         self.create()
 
     def create(self):
@@ -36,51 +79,130 @@ class APICache:
             method TEXT,
             response_code INTEGER,
             response_json JSON,
-            response_headers JSON
+            response_headers JSON,
+            route TEXT
         )""")
+        if "route" not in self.columns():
+            # created before requests recorded their route template, see backfill_routes
+            self.cursor.execute("ALTER TABLE requests ADD COLUMN route TEXT")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS requests_route ON requests (route)")
+        # one-off migrations which already ran, see backfill_routes
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS cache_meta (key TEXT PRIMARY KEY, value)")
+        # every cache lookup filters on url and method and takes the newest row
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS requests_url_method_called_at ON requests (url, method, called_at)")
 
     def retrieve_cached_get(self, url, params=unspecified, headers=unspecified, max_age=None, limit=1, order_by="called_at DESC", **kwargs):
         return self.retrieve_cached_request("GET", url, params=params, headers=headers, max_age=max_age, limit=limit, order_by=order_by, **kwargs)
 
-    def retrieve_cached_request(self, method, url, params=unspecified, headers=unspecified, max_age=None, limit=1, order_by="called_at DESC", **kwargs):
-        condition = {
-            "url": url,
-            "method": method,
-        }
-        condition.update(kwargs)
-        if params is not self.unspecified:
-            condition["params"] = json.dumps({k: params[k] for k in sorted(params)}) if params else None
-        if headers is not self.unspecified:
-            condition["headers"] = json.dumps({k: headers[k] for k in sorted(headers)}) if headers else None
+    def retrieve_fresh_get(self, url, params=unspecified, max_age=None, fields=None, **kwargs):
+        """Looks up the newest matching cached GET, returning (decoded body, "hit") if it is newer than max_age.
+
+        Otherwise returns (None, "stale") if there is an older one or (None, "miss") if there is none, so callers learn
+        why they have to refetch from the same indexed lookup.
+        """
+        condition = self.request_condition("GET", url, params=params, **kwargs)
+        columns = ["called_at", "id"] if fields is not None else ["called_at", "response_json"]
+        rows = self.select(columns=columns, order_by="called_at DESC", limit=1, **condition)
+        if not rows:
+            return None, "miss"
+        called_at, value = rows[0]
+        if max_age is not None and called_at <= time.time() - max_age:
+            return None, "stale"
+        if fields is not None:
+            result = self.retrieve_fields(fields, id=value)
+            return (result[0], "hit") if result else (None, "miss")
+        try:
+            return self.codec.loads(value), "hit"
+        except ValueError:
+            return value, "hit"
+
+    def retrieve_cached_request(self, method, url, params=unspecified, headers=unspecified, max_age=None, limit=1, order_by="called_at DESC", fields=None, **kwargs):
+        """Returns the decoded bodies of the matching cached responses (or None if there are none).
+
+        Args:
+            fields (tuple[str] | None): Only decode these top-level fields of each body, see `retrieve_fields`.
+        """
+        condition = self.request_condition(method, url, params=params, headers=headers, **kwargs)
+        if fields is not None:
+            return self.retrieve_fields(fields, max_age=max_age, limit=limit, order_by=order_by, **condition) or None
         result = self.select(columns="response_json", max_age=max_age, limit=limit, order_by=order_by, **condition)
         if isinstance(result, str):
             try:
-                result = json.loads(result)
-            except json.JSONDecodeError:
+                result = self.codec.loads(result)
+            except ValueError:
                 pass
         elif isinstance(result, list) and all(isinstance(x, str) for x in result):
             try:
-                result = [json.loads(x) for x in result]
-            except json.JSONDecodeError:
+                result = [self.codec.loads(x) for x in result]
+            except ValueError:
                 pass
         if result is None:
             return None
         return result
 
+    def request_condition(self, method, url, params=unspecified, headers=unspecified, **kwargs):
+        """Returns the select conditions matching requests with this method, url, params and headers."""
+        condition = {
+            "url": url,
+            "method": method,
+        }
+        condition.update(kwargs)
+        if params is not self.unspecified:
+            condition["params"] = json.dumps({k: params[k] for k in sorted(params)}) if params else None
+        if headers is not self.unspecified:
+            condition["headers"] = json.dumps({k: headers[k] for k in sorted(headers)}) if headers else None
+        return condition
+
+    def retrieve_fields(self, fields, max_age=None, limit=None, order_by=None, **conditions):
+        """Returns [{field: value}] with only the top-level `fields` of each matching cached response.
+
+        Objects are picked apart by SQLite's json_extract, so no Python objects are built for the rest of the body.
+        Other bodies (e.g. lists of activities) are decoded with `codec.loads_fields`.
+        """
+        for f in fields:
+            if not f.isidentifier():
+                raise ValueError(f"fields must be identifiers, got {f!r}")
+        columns = ["id", "json_type(response_json)"]
+        for f in fields:
+            columns += [f"json_extract(response_json, '$.{f}')", f"json_type(response_json, '$.{f}')"]
+        results = []
+        rows = self.select(columns=columns, where="json_valid(response_json)", max_age=max_age, limit=limit,
+                           order_by=order_by, **conditions)
+        for row in rows:
+            if row[1] != "object":
+                [response_json] = self.select(columns="response_json", id=row[0])
+                results.append(self.codec.loads_fields(response_json, fields))
+                continue
+            result = {}
+            for f, value, value_type in zip(fields, row[2::2], row[3::2]):
+                if value_type in ("object", "array"):
+                    value = self.codec.loads(value)
+                elif value_type in ("true", "false"):
+                    value = value_type == "true"  # json_extract returns booleans as 1/0
+                result[f] = value
+            results.append(result)
+        return results
+
     def cache_post(self, url, params, response_code, response_json, called_at=None):
         return self.cache_request("POST", url, params, response_code, response_json, called_at)
 
-    def cache_get(self, url, params, response, called_at: float = None):
-        return self.cache_request("GET", url=url, params=params, response=response, called_at=called_at)
+    def cache_get(self, url, params, response, called_at: float = None, route=None):
+        return self.cache_request("GET", url=url, params=params, response=response, called_at=called_at, route=route)
 
-    def cache_request(self, method, url, response, headers=None, params=None, called_at: float = None):
+    def cache_request(self, method, url, response, headers=None, params=None, called_at: float = None, route=None):
+        """Stores a response, returns the id of its row (None if it wasn't stored)."""
         if not ((response.status_code == 200) or self.cache_failed_requests):
             return
         p = json.dumps({k: params[k] for k in sorted(params)}) if params else None
         h = json.dumps({k: headers[k] for k in sorted(headers)}) if headers else None
         called_at = time.time() if called_at is None else called_at
         called_at_str = str(datetime.datetime.fromtimestamp(called_at))
-        response_json = json.dumps(response.json())
+        # the body is stored as received and only parsed when it is read back. JSON is UTF-8 whatever charset requests
+        # guesses from the headers, bodies which aren't UTF-8 are kept as raw bytes rather than mangled
+        try:
+            response_json = response.content.decode("utf-8")
+        except UnicodeDecodeError:
+            response_json = response.content
         record = {
             "called_at": called_at,
             "called_at_str": called_at_str,
@@ -90,34 +212,47 @@ class APICache:
             "headers": h,
             "response_code": response.status_code,
             "response_json": response_json,
-            "response_headers": json.dumps(dict(response.headers))
+            "response_headers": json.dumps(dict(response.headers)),
+            "route": route
         }
-        self.insert(record)
+        row = self.insert(record)
+        if self.metrics is not None:
+            self.metrics.inc("cache_bytes_stored_total", len(response.content))
+        return row
 
     def trim_old(self, max_age):
         self.delete(max_age=max_age)
 
     def delete_failed(self):
-        self.delete(response_code="!= 200")
+        self.delete(response_code=("!=", 200))
 
     def delete(self, where=None, max_age=None, order_by=None, limit=None, offset=None, **conditions):
-        cmd, condition_params = self._compose_query("DELETE", where=where, max_age=max_age, order_by=order_by,
+        cmd, condition_params = self._compose_query("DELETE", columns="", where=where, max_age=max_age, order_by=order_by,
                                                     limit=limit, offset=offset, **conditions)
-        self.cursor.execute(cmd, condition_params)
-        self.conn.commit()
+        t0 = time.perf_counter() if self.metrics is not None else None
+        with self.lock:
+            self.cursor.execute(cmd, condition_params)
+            self.conn.commit()
+        if t0 is not None:
+            self.metrics.observe("cache_query_seconds", time.perf_counter() - t0, op="delete")
 
     def count(self, where=None, max_age=None, order_by=None, limit=None, offset=None, **conditions):
         return self.select(columns="COUNT(*)", where=where, max_age=max_age, order_by=order_by, limit=limit, offset=offset, **conditions)[0]
 
-    def select(self, columns="*", where=None, max_age=None, order_by=None, limit=None, offset=None, **conditions):
+    def select(self, columns="*", where=None, max_age=None, order_by=None, limit=None, offset=None, where_params=(), **conditions):
         cmd, condition_params = self._compose_query("SELECT", columns=columns, where=where, max_age=max_age,
-                                                order_by=order_by, limit=limit, offset=offset, **conditions)
+                                                order_by=order_by, limit=limit, offset=offset, where_params=where_params,
+                                                **conditions)
+        t0 = time.perf_counter() if self.metrics is not None else None
         try:
-            self.cursor.execute(cmd, condition_params)
-            r = self.cursor.fetchall()
+            with self.lock:
+                self.cursor.execute(cmd, condition_params)
+                r = self.cursor.fetchall()
         except Exception as e:
             logger.error(f"Error in query: {cmd} with params {condition_params}: {e}")
             raise
+        if t0 is not None:
+            self.metrics.observe("cache_query_seconds", time.perf_counter() - t0, op="select")
         if isinstance(columns, str) and columns != "*" and "," not in columns:
             return r[0] if len(r) == 1 and not isinstance(r[0], tuple) else [x[0] for x in r] if len(r) > 0 and all(isinstance(x, tuple) for x in r) else r
         return r
@@ -125,32 +260,44 @@ class APICache:
     def insert(self, record):
         keys = ", ".join(record.keys())
         values = ", ".join(["?" for _ in record])
-        self.cursor.execute(f"INSERT INTO requests ({keys}) VALUES ({values})", list(record.values()))
-        self.conn.commit()
-
-    def _compose_query(self, cmd, columns="*", where=None, max_age=None, order_by=None, limit=None, offset=None, **conditions):
+        t0 = time.perf_counter() if self.metrics is not None else None
+        with self.lock:
+            self.cursor.execute(f"INSERT INTO requests ({keys}) VALUES ({values})", list(record.values()))
+            row = self.cursor.lastrowid
+            self.conn.commit()
+        if t0 is not None:
+            self.metrics.observe("cache_query_seconds", time.perf_counter() - t0, op="insert")
+        return row
+
+    def update_row(self, id, **values):
+        """Overwrites columns of one row, e.g. update_row(row_id, response_json=new_body)."""
+        assignments = ", ".join(f"{k} = ?" for k in values)
+        t0 = time.perf_counter() if self.metrics is not None else None
+        with self.lock:
+            self.cursor.execute(f"UPDATE requests SET {assignments} WHERE id = ?", [*values.values(), id])
+            self.conn.commit()
+        if t0 is not None:
+            self.metrics.observe("cache_query_seconds", time.perf_counter() - t0, op="update")
+
+    def _compose_query(self, cmd, columns="*", where=None, max_age=None, order_by=None, limit=None, offset=None, where_params=(), **conditions):
         c = columns if isinstance(columns, str) else ", ".join(columns)
         if max_age is not None:
             called_at = (time.time() - max_age) if max_age else 0
-            conditions["called_at"] = f"> {called_at}"
+            conditions["called_at"] = (">", called_at)
 
-        cond = ""
+        cond = []
         condition_params = []
         for k, v in conditions.items():
-            if isinstance(v, str) and (
-                    v.startswith(">") or v.startswith("<") or v.startswith("=") or v.startswith("!") or v.startswith(
-                    "IN") or v.startswith("LIKE") or v.startswith("BETWEEN") or v.startswith("IS")):
-                cond += f"{k} {v} AND "
-            else:
-                cond += f"{k} = ? AND "
-                if isinstance(v, (list, dict)):
-                    v = json.dumps(v)
-                condition_params.append(v)
-        cond = cond[:-5]
+            sql, params = self._condition(k, v)
+            cond.append(sql)
+            condition_params.extend(params)
+        cond = " AND ".join(cond)
 
         if where is not None:
-            where = "AND " + where.replace("WHERE", "").strip()
-        w = f"WHERE {cond or ''}{where or ''}" if cond or where else ""
+            where = re.sub(r"^\s*WHERE\b", "", where).strip()  # the WHERE of a subquery stays
+            cond = f"{cond} AND {where}" if cond else where
+            condition_params.extend(where_params)
+        w = f"WHERE {cond}" if cond else ""
         cmd = f"""{cmd} {c} FROM requests {w}"""
         if order_by:
             cmd += f" ORDER BY {order_by}"
@@ -160,6 +307,143 @@ class APICache:
             cmd += f" OFFSET {offset}"
         return cmd, condition_params
 
+    @classmethod
+    def _condition(cls, column, value):
+        """Returns (sql, params) of one condition.
+
+        value can be:
+            (operator, operand): the operand is bound as a parameter, e.g. (">", 20), ("IN", [1, 2]), ("BETWEEN", (lo, hi)),
+                ("LIKE", "https://www.strava.com/api/v3/activities/%")
+            None: IS NULL
+            anything else: equality (strings too, e.g. "> 5" only matches that exact string), lists and dicts are
+                compared as their JSON
+        """
+        if not column.isidentifier():
+            raise ValueError(f"Invalid column name {column!r}")
+        if isinstance(value, tuple) and len(value) == 2 and isinstance(value[0], str) and value[0].upper() in cls.operators:
+            op, operand = value[0].upper(), value[1]
+            if op in ("IN", "NOT IN"):
+                operand = list(operand)
+                return f"{column} {op} ({', '.join('?' * len(operand))})", operand
+            if op == "BETWEEN":
+                lo, hi = operand
+                return f"{column} BETWEEN ? AND ?", [lo, hi]
+            if isinstance(operand, (list, dict)):
+                operand = json.dumps(operand)
+            return f"{column} {op} ?", [operand]
+        if value is None:
+            # "= NULL" never matches, so e.g. requests without params could never be found in the cache
+            return f"{column} IS NULL", []
+        if isinstance(value, (list, dict)):
+            value = json.dumps(value)
+        return f"{column} = ?", [value]
+
+    def columns(self):
+        """Returns the names of the columns of the requests table, including generated ones."""
+        with self.lock:
+            return [row[1] for row in self.conn.execute("PRAGMA table_xinfo(requests)")]
+
+    def add_json_column(self, name, path, route=None, index=True):
+        """Adds a virtual column holding the value at a JSON path of each response body (of one route only, if given).
+
+        e.g. `cache.add_json_column("kudos_count", "$.kudos_count", route="/activities/{id}")`, then
+        `cache.query("/activities/{id}", columns="url", kudos_count=(">", 20))`.
+        The column is computed by SQLite (no Python decoding) and, if `index`, indexed. Columns are part of the database,
+        so adding them again is a no-op. Requires SQLite 3.31 or newer.
+        Raises ValueError if the name is taken by a built-in column or by a json column with another path or route.
+
+        Args:
+            name (str): Column name.
+            path (str): JSON path, e.g. "$.kudos_count", "$.map.id" or "$.laps[0].moving_time".
+            route (str | None): Route template whose responses the column applies to (NULL for other rows).
+            index (bool): Whether to index the column. Defaults to True.
+        """
+        if not name.isidentifier():
+            raise ValueError(f"Invalid column name {name!r}")
+        if not self.json_path_pattern.fullmatch(path):
+            raise ValueError(f"Unsupported JSON path {path!r}")
+        # DDL can't take parameters, so the route is quoted as an SQL string literal
+        only_route = f"route = '{route.replace(chr(39), chr(39) * 2)}' AND " if route is not None else ""
+        if name in self.builtin_columns:
+            raise ValueError(f"{name!r} is a built-in column")
+        definition = (f"{name} GENERATED ALWAYS AS (CASE WHEN {only_route}json_valid(response_json) "
+                      f"THEN json_extract(response_json, '{path}') END) VIRTUAL")
+        with self.lock:
+            if name not in self.columns():
+                self.cursor.execute(f"ALTER TABLE requests ADD COLUMN {definition}")
+            else:
+                # SQLite keeps the text of every ALTER TABLE ADD COLUMN in the table's definition
+                table_sql = self.conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'requests'").fetchone()[0]
+                if "".join(definition.split()) not in "".join(table_sql.split()):
+                    raise ValueError(f"Column {name!r} already exists with another definition")
+            if index:
+                # with the route first, the index also serves queries which filter on the route
+                indexed = f"route, {name}" if route is not None else name
+                self.cursor.execute(f"CREATE INDEX IF NOT EXISTS requests_{name} ON requests ({indexed})")
+            self.conn.commit()
+
+    def query(self, route=None, columns="response_json", contains=None, latest=True, order_by=None, limit=None, **conditions):
+        """Selects cached 200 GET responses by their content, filtering inside SQLite.
+
+        e.g. `cache.query("/activities/{id}", kudos_count=(">", 20))` (see add_json_column), or
+        `cache.query("/activities/{id}", contains=("$.segment_efforts", "$.segment.id", segment_id))`
+
+        Args:
+            route (str | None): Only responses of this route template, e.g. "/activities/{id}".
+            columns (str | list[str]): As in select, json columns can be selected too.
+                Defaults to "response_json", which returns the decoded bodies.
+            contains (tuple | None): (array path, value) or (array path, item path, value): only responses with an element
+                of the array (or a value at the item path of one) equal to value. Arrays can't be indexed, so this parses
+                the bodies of the route (still without decoding them in Python).
+            latest (bool): Only the newest response of each url and params. Defaults to True. A request whose newest
+                response is an error (e.g. a 404 after the activity was deleted) returns nothing rather than its
+                older 200. Cached 429s are ignored, they say nothing about the resource.
+            **conditions: As in select, e.g. kudos_count=(">", 20).
+        """
+        where, where_params = [], []
+        if route is not None:
+            conditions["route"] = route
+        if contains is not None:
+            array_path, *item_path, value = contains
+            element = "json_extract(e.value, ?)" if item_path else "e.value"
+            where.append("EXISTS (SELECT 1 FROM json_each(CASE WHEN json_valid(requests.response_json) "
+                         f"THEN requests.response_json END, ?) AS e WHERE {element} = ?)")
+            where_params += [array_path, *item_path, value]
+        if latest:
+            # looked up per matching row with the (url, method, called_at) index
+            where.append("NOT EXISTS (SELECT 1 FROM requests AS newer WHERE newer.url = requests.url AND newer.method = 'GET' "
+                         "AND newer.params IS requests.params AND newer.response_code != 429 AND newer.id > requests.id)")
+        rows = self.select(columns=columns, where=" AND ".join(where) or None, where_params=where_params,
+                           order_by=order_by, limit=limit, method="GET", response_code=200, **conditions)
+        if columns == "response_json":
+            return [self.codec.loads(row) for row in rows]
+        return rows
+
+    def backfill_routes(self, base_url, routes):
+        """Sets the route of rows cached before the route column existed, by matching their urls against route templates.
+
+        Runs once per database (recorded in `cache_meta`), rows cached since have their route or never match one.
+
+        Returns:
+            int: The number of rows updated.
+        """
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM cache_meta WHERE key = 'routes_backfilled'").fetchone():
+                return 0
+        patterns = [(re.compile(re.escape(base_url) + "[^/]+".join(re.escape(part) for part in re.split(r"\{\w+}", route))),
+                     route) for route in routes]
+        updates = []
+        for row, url in self.select(columns=["id", "url"], route=None):
+            for pattern, route in patterns:
+                if pattern.fullmatch(url):
+                    updates.append((route, row))
+                    break
+        with self.lock:
+            self.cursor.executemany("UPDATE requests SET route = ? WHERE id = ?", updates)
+            self.cursor.execute("INSERT OR REPLACE INTO cache_meta (key, value) VALUES ('routes_backfilled', ?)", (time.time(),))
+            self.conn.commit()
+        return len(updates)
+
 
 class API:
     """API class for making GET requests with caching and rate limiting.
@@ -169,6 +453,10 @@ class API:
     unless you specify a max_age (seconds) less than the time since your previous request.
     * If you get a 429 response (rate limit exceeded) the request will be retried after a delay
     based on the rate limits specified in the rate_limits dictionary.
+    * If a RequestScheduler is given, every network request waits for a slot of the rate limit budget according to its
+    priority (see `priority` and `submit`), so background work never gets in front of interactive requests.
+    * In offline mode nothing is sent over the network: every request is answered with the latest cached 200 response
+    (regardless of max_age), or the latest one cached at or before `as_of`, and OfflineMissError is raised if there is none.
     """
     rate_limits: dict[int, int] = {}  # {<number of requests>: <timeframe in seconds>}
     # e.g. {100: 15*60} means a rate limit of 100 requests every 15 minutes
@@ -177,62 +465,204 @@ class API:
                  rate_limits=None,
                  headers=None,
                  retry_on_rate_limit=True,
-                 loglevel=logging.INFO
+                 loglevel=logging.INFO,
+                 codec=None,
+                 scheduler=None,
+                 metrics=None,
+                 offline=False,
+                 as_of=None,
+                 tenant=None
                  ):
+        """
+        Args:
+            offline (bool): Only answer requests from the cache, never use the network. Defaults to False.
+            as_of (float | datetime.datetime | None): Replay the cache as it was at this time (implies offline).
+            tenant (Hashable | None): Who the requests are made for when several clients share the scheduler,
+                the scheduler takes turns between tenants. Defaults to None.
+        """
         self.base_url = base_url
-        self.cache = APICache(cache_path)
+        self.cache = APICache(cache_path, codec=codec, metrics=metrics)
         self.headers = headers or {}
         if rate_limits is not None:
             self.rate_limits = rate_limits
         self.retry_on_rate_limit = retry_on_rate_limit
+        self.scheduler = scheduler
+        self.metrics = metrics
+        self._priority = threading.local()
+        self.response_hooks = {}  # {route template: [callback(params, body)]}
+        self.as_of = as_of.timestamp() if isinstance(as_of, datetime.datetime) else as_of
+        self.offline = offline or self.as_of is not None
+        self.tenant = tenant
         if loglevel:
             logging.basicConfig(level=loglevel)
 
-    def get(self, route, params=None, max_age=None, cache=True, retry_on_rate_limit=None, rate_limit_delay=None):
+    @contextmanager
+    def priority(self, priority):
+        """Within this block, requests made by this thread use the given Priority (unless get is passed one explicitly).
+
+        e.g. `with api.priority(Priority.backfill): api.get_activity_streams(activity_id)`
+        """
+        previous = getattr(self._priority, "value", None)
+        self._priority.value = priority
+        try:
+            yield
+        finally:
+            self._priority.value = previous
+
+    def get(self, route, params=None, max_age=None, cache=True, retry_on_rate_limit=None, rate_limit_delay=None, fields=None, priority=None):
+        """GETs a route, returning the cached response if there is one newer than max_age.
+
+        Each response body is decoded exactly once. Pass `fields` (e.g. ("id", "start_date")) to only decode those
+        top-level fields, which is much cheaper for large bodies like detailed activities.
+        `priority` is only used if the API has a scheduler, it defaults to the priority set by `with api.priority(...)`,
+        or Priority.interactive.
+        """
         if retry_on_rate_limit is None:
             retry_on_rate_limit = self.retry_on_rate_limit
-        if params is not None:
-            for key, value in params.copy().items():
-                if f"{{{key}}}" in route:
-                    route = route.replace(f"{{{key}}}", str(value))
-                    del params[key]
-
-        if '{' in route and '}' in route:
-            raise ValueError(f"Route {route} has unresolved parameters: {params}")
-
+        route_template = route
+        route_params = dict(params) if params else params  # resolve_route removes the placeholders from params
+        route = self.resolve_route(route, params)
         url = f"{self.base_url}{route}"
+        if self.offline:
+            return self._get_offline(url, params, route_template, fields)
+        kind = "bypass"
         if max_age != 0:
-            cached_json = self.cache.retrieve_cached_get(url, params=params, max_age=max_age)
-            if cached_json:
+            # a cached 429 is never an answer (otherwise the retry below would return it)
+            cached_json, kind = self.cache.retrieve_fresh_get(url, params=params, max_age=max_age, fields=fields,
+                                                              response_code=("!=", 429))
+            if kind == "hit":  # the body itself may be falsy, e.g. the empty page which ends a listing
                 logger.info(f"Retrieved cached response for {url}")
-                return cached_json[0] if isinstance(cached_json, list) and len(cached_json) == 1 else cached_json
+                if self.metrics is not None:
+                    self.metrics.inc("api_requests_total", route=route_template, result="hit")
+                return cached_json
+        if self.metrics is not None:
+            self.metrics.inc("api_requests_total", route=route_template, result=kind)
+        if priority is None:
+            priority = getattr(self._priority, "value", None)
+            priority = Priority.interactive if priority is None else priority
+        if self.scheduler is not None:
+            t0 = time.perf_counter()
+            self.scheduler.acquire(priority, tenant=self.tenant)
+            if self.metrics is not None:
+                self.metrics.inc("api_rate_limit_wait_seconds_total", time.perf_counter() - t0, reason="scheduler")
         called_at = time.time()
         logger.info(f"GET {url}")
         result = requests.get(url, headers=self.headers, params=params)
+        if self.metrics is not None:
+            self.metrics.observe("api_request_seconds", time.time() - called_at, route=route_template, status=result.status_code)
+            self._record_quota(result.headers)
+        if self.scheduler is not None:
+            self.scheduler.update_usage(result.headers)
 
+        row = None
         if cache:
             logger.info(f"Caching response for {url}")
-            self.cache.cache_get(url, params, result, called_at=called_at)
+            row = self.cache.cache_get(url, params, result, called_at=called_at, route=route_template)
         if result.status_code == 200:
-            return result.json()
+            hooks = self.response_hooks.get(route_template)
+            if hooks:
+                body = self.cache.codec.loads(result.content)
+                self._run_response_hooks(hooks, route_params, body, row)
+                return body if fields is None else self.cache.codec.pick_fields(body, fields)
+            if fields is not None:
+                return self.cache.codec.loads_fields(result.content, fields)
+            return self.cache.codec.loads(result.content)
         elif result.status_code == 429:
             if retry_on_rate_limit:
                 logger.info("Rate limit exceeded. Waiting before retrying")
-                if rate_limit_delay is not None:
-                    time.sleep(rate_limit_delay)
+                delay = rate_limit_delay if rate_limit_delay is not None else self.get_rate_limit_delay()
+                if self.metrics is not None:
+                    self.metrics.inc("api_rate_limited_total", route=route_template)
+                    self.metrics.inc("api_rate_limit_wait_seconds_total", delay, reason="429")
+                if self.scheduler is not None:
+                    # the retry waits in the scheduler, along with every other request
+                    self.scheduler.pause(delay)
                 else:
-                    time.sleep(self.get_rate_limit_delay())
-                return self.get(route, params=params, max_age=max_age, cache=cache, retry_on_rate_limit=retry_on_rate_limit)
+                    time.sleep(delay)
+                return self.get(route_template, params=route_params, max_age=max_age, cache=cache, retry_on_rate_limit=retry_on_rate_limit, fields=fields, priority=priority)
             raise RateLimitError("Rate limit exceeded")
         raise ValueError(f"Error {result.status_code}: {result.text}")
 
+    def add_response_hook(self, route, callback):
+        """Calls callback(params, body) with every 200 response of a route received from the network (not cache hits).
+
+        e.g. `api.add_response_hook("/activities/{id}/streams", lambda params, streams: index(params["id"], streams))`,
+        params include the route's placeholders. During the call `response_row.get()` is the row the response was
+        cached in (None with cache=False).
+        """
+        self.response_hooks.setdefault(route, []).append(callback)
+
+    def remove_response_hook(self, route, callback):
+        self.response_hooks[route].remove(callback)
+
+    @staticmethod
+    def _run_response_hooks(hooks, params, body, row=None):
+        token = response_row.set(row)
+        try:
+            for hook in hooks:
+                try:
+                    hook(params, body)
+                except Exception:
+                    # a failing hook must not lose the response, which is cached already
+                    logger.exception(f"Response hook {hook} failed")
+        finally:
+            response_row.reset(token)
+
+    def backfill_routes(self, routes):
+        """Sets the route of cached rows from before routes were recorded, see APICache.backfill_routes."""
+        return self.cache.backfill_routes(self.base_url, routes)
+
+    def resolve_route(self, route, params=None):
+        """Substitutes the {key} placeholders of a route with (and removes them from) params."""
+        if params is not None:
+            for key, value in params.copy().items():
+                if f"{{{key}}}" in route:
+                    route = route.replace(f"{{{key}}}", str(value))
+                    del params[key]
+
+        if '{' in route and '}' in route:
+            raise ValueError(f"Route {route} has unresolved parameters: {params}")
+        return route
+
+    def _get_offline(self, url, params, route_template, fields=None):
+        conditions = {"response_code": 200}
+        if self.as_of is not None:
+            conditions["called_at"] = ("<=", self.as_of)
+        # the cached body may be falsy (e.g. the empty page which ends a listing), only `kind` tells a miss
+        cached_json, kind = self.cache.retrieve_fresh_get(url, params=params, fields=fields, **conditions)
+        if self.metrics is not None:
+            self.metrics.inc("api_requests_total", route=route_template, result=kind)
+        if kind != "hit":
+            raise OfflineMissError(url, params, self.as_of)
+        return cached_json
+
+    def _record_quota(self, headers):
+        """Records the rate limit usage reported in X-RateLimit-* headers, matching values to windows shortest first."""
+        windows = sorted(self.rate_limits.values())
+        for prefix, kind in (("X-RateLimit", "overall"), ("X-ReadRateLimit", "read")):
+            for suffix, name in (("Usage", "api_rate_limit_usage"), ("Limit", "api_rate_limit_limit")):
+                value = headers.get(f"{prefix}-{suffix}")
+                if value:
+                    for window, v in zip(windows, value.split(",")):
+                        self.metrics.set(name, int(v), window=window, kind=kind)
+
+    def submit(self, route, params=None, priority=Priority.backfill, **kwargs):
+        """Queues a GET on the scheduler's thread pool, returning a concurrent.futures.Future of the response.
+
+        Cache hits are returned without waiting for the rate limit budget.
+        """
+        if self.scheduler is None:
+            raise ValueError("submit requires the API to have a scheduler")
+        return self.scheduler.executor.submit(self.get, route, params, priority=priority, **kwargs)
+
     def get_rate_limit_delay(self):
         safe = None
         for limit, delay in self.rate_limits.items():
-            t = self.cache.select(columns="called_at", limit=1, offset=limit-2)
-            if t:
-                next_safe = t + delay
-                if safe is None or next_safe < safe:
+            # the limit-th most recent call has to leave the window before we are back under the limit
+            t = self.cache.select(columns="called_at", order_by="called_at DESC", limit=1, offset=limit - 1)
+            if t and t[0] + delay > time.time():
+                next_safe = t[0] + delay
+                if safe is None or next_safe > safe:
                     safe = next_safe
         if safe is None:
             # just guess and use the lowest rate limit
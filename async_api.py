@@ -0,0 +1,190 @@
+import asyncio
+import contextvars
+import logging
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from api_cache import API, RateLimitError
+from request_scheduler import Priority
+
+
+logger = logging.getLogger(__name__)
+
+
+class _TaskPriority:
+    """Holds the priority set by `API.priority` per asyncio task (and thread) instead of per thread."""
+    __slots__ = ("_var",)
+
+    def __init__(self):
+        self._var = contextvars.ContextVar("priority", default=None)
+
+    @property
+    def value(self):
+        return self._var.get()
+
+    @value.setter
+    def value(self, priority):
+        self._var.set(priority)
+
+
+class AsyncAPI(API):
+    """asyncio version of API, for services which must not block their event loop.
+
+    * Requests go through a pooled aiohttp.ClientSession, so hundreds of them can be in flight at once.
+    * The SQLite cache (same APICache and schema as API, so sync and async clients can share a database) is read and
+    written in worker threads with asyncio.to_thread.
+    * Waiting for the rate limit budget (`RequestScheduler.acquire_async`) and after 429s uses asyncio.sleep.
+    * `with api.priority(...)` applies to the current task and the tasks it creates.
+
+    Use it as `async with AsyncAPI(...) as api: await api.get(route)`, or call `await api.aclose()` when done.
+    """
+
+    def __init__(self, base_url, cache_path,
+                 rate_limits=None,
+                 headers=None,
+                 retry_on_rate_limit=True,
+                 loglevel=logging.INFO,
+                 codec=None,
+                 scheduler=None,
+                 metrics=None,
+                 offline=False,
+                 as_of=None,
+                 tenant=None,
+                 max_connections=100
+                 ):
+        """
+        Args:
+            max_connections (int): Size of the HTTP connection pool. Defaults to 100.
+        """
+        if aiohttp is None:
+            raise ImportError("AsyncAPI requires aiohttp (pip install aiohttp)")
+        API.__init__(self, base_url, cache_path,
+                     rate_limits=rate_limits,
+                     headers=headers,
+                     retry_on_rate_limit=retry_on_rate_limit,
+                     loglevel=loglevel,
+                     codec=codec,
+                     scheduler=scheduler,
+                     metrics=metrics,
+                     offline=offline,
+                     as_of=as_of,
+                     tenant=tenant)
+        self._priority = _TaskPriority()
+        self.max_connections = max_connections
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            # no timeouts, like requests: queued requests wait for a free connection however long that takes
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_connections),
+                                                  timeout=aiohttp.ClientTimeout(total=None))
+        return self._session
+
+    async def aclose(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def get(self, route, params=None, max_age=None, cache=True, retry_on_rate_limit=None, rate_limit_delay=None, fields=None, priority=None):
+        """GETs a route, returning the cached response if there is one newer than max_age. See API.get."""
+        if retry_on_rate_limit is None:
+            retry_on_rate_limit = self.retry_on_rate_limit
+        route_template = route
+        route_params = dict(params) if params else params  # resolve_route removes the placeholders from params
+        route = self.resolve_route(route, params)
+        url = f"{self.base_url}{route}"
+        if self.offline:
+            return await asyncio.to_thread(self._get_offline, url, params, route_template, fields)
+        kind = "bypass"
+        if max_age != 0:
+            cached_json, kind = await asyncio.to_thread(self.cache.retrieve_fresh_get, url, params=params, max_age=max_age,
+                                                        fields=fields, response_code=("!=", 429))
+            if kind == "hit":  # the body itself may be falsy, e.g. the empty page which ends a listing
+                logger.info(f"Retrieved cached response for {url}")
+                if self.metrics is not None:
+                    self.metrics.inc("api_requests_total", route=route_template, result="hit")
+                return cached_json
+        if self.metrics is not None:
+            self.metrics.inc("api_requests_total", route=route_template, result=kind)
+        if priority is None:
+            priority = getattr(self._priority, "value", None)
+            priority = Priority.interactive if priority is None else priority
+        if self.scheduler is not None:
+            t0 = time.perf_counter()
+            await self.scheduler.acquire_async(priority, tenant=self.tenant)
+            if self.metrics is not None:
+                self.metrics.inc("api_rate_limit_wait_seconds_total", time.perf_counter() - t0, reason="scheduler")
+        called_at = time.time()
+        logger.info(f"GET {url}")
+        async with self.session.get(url, headers=self.headers, params=_query_params(params)) as response:
+            result = Response(response.status, await response.read(), response.charset, response.headers)
+        if self.metrics is not None:
+            self.metrics.observe("api_request_seconds", time.time() - called_at, route=route_template, status=result.status_code)
+            self._record_quota(result.headers)
+        if self.scheduler is not None:
+            self.scheduler.update_usage(result.headers)
+
+        row = None
+        if cache:
+            logger.info(f"Caching response for {url}")
+            row = await asyncio.to_thread(self.cache.cache_get, url, params, result, called_at=called_at, route=route_template)
+        if result.status_code == 200:
+            hooks = self.response_hooks.get(route_template)
+            if hooks:
+                body = self.cache.codec.loads(result.content)
+                await asyncio.to_thread(self._run_response_hooks, hooks, route_params, body, row)
+                return body if fields is None else self.cache.codec.pick_fields(body, fields)
+            if fields is not None:
+                return self.cache.codec.loads_fields(result.content, fields)
+            return self.cache.codec.loads(result.content)
+        elif result.status_code == 429:
+            if retry_on_rate_limit:
+                logger.info("Rate limit exceeded. Waiting before retrying")
+                delay = rate_limit_delay if rate_limit_delay is not None else await asyncio.to_thread(self.get_rate_limit_delay)
+                if self.metrics is not None:
+                    self.metrics.inc("api_rate_limited_total", route=route_template)
+                    self.metrics.inc("api_rate_limit_wait_seconds_total", delay, reason="429")
+                if self.scheduler is not None:
+                    self.scheduler.pause(delay)
+                else:
+                    await asyncio.sleep(delay)
+                return await self.get(route_template, params=route_params, max_age=max_age, cache=cache, retry_on_rate_limit=retry_on_rate_limit, fields=fields, priority=priority)
+            raise RateLimitError("Rate limit exceeded")
+        raise ValueError(f"Error {result.status_code}: {result.text}")
+
+    def submit(self, route, params=None, priority=Priority.backfill, **kwargs):
+        """Starts a GET in a new task, returning the asyncio.Task (await it for the response)."""
+        return asyncio.create_task(self.get(route, params, priority=priority, **kwargs))
+
+
+class Response:
+    """The parts of a requests.Response which API.get and APICache.cache_request use."""
+    __slots__ = ("status_code", "content", "encoding", "headers")
+
+    def __init__(self, status_code, content, encoding, headers):
+        self.status_code = status_code
+        self.content = content
+        self.encoding = encoding
+        self.headers = headers
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+
+def _query_params(params):
+    """Encodes params the way requests does, so both clients send the same query strings: None is left out, True is "True"."""
+    if not params:
+        return None
+    return {k: str(v) if isinstance(v, bool) else v for k, v in params.items() if v is not None}
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+
+from activity_store import without_deleted
+from async_api import AsyncAPI
+from bare_strava_api import BareStravaAPI, StravaAPIRoutes
+from request_scheduler import Priority, RequestScheduler
+
+
+class AsyncBareStravaAPI(AsyncAPI, BareStravaAPI):
+    """asyncio version of BareStravaAPI with the same endpoints, e.g. `await api.get_activity(activity_id)`.
+
+    * Endpoints which only wrap `get` are inherited from BareStravaAPI and return the coroutine of AsyncAPI.get,
+    the ones which post-process or page through responses are re-implemented here.
+    The write endpoints (create_activity, update_activity, ...) are inherited unchanged and still block,
+    `startup` raises TypeError (use `start`).
+    * Nothing is requested in __init__, `await api.start()` (or `async with`) runs the OAuth setup in a worker thread
+    and makes the startup requests.
+    * Pass the scheduler of a BareStravaAPI to share its rate limit budget, both can use the same cache database.
+
+        async with AsyncBareStravaAPI() as api:
+            streams = await asyncio.gather(*(api.get_activity_streams(i) for i in api.activity_ids[:100]))
+    """
+    max_connections = 100
+
+    def __init__(self,
+                 get_athlete=True,
+                 list_all_activities=True,
+                 get_athlete_zones=False,
+                 get_athlete_stats=False,
+                 offline=False,
+                 as_of=None,
+                 scheduler=None
+                 ):
+        """
+        Args:
+            get_athlete, list_all_activities, get_athlete_zones, get_athlete_stats, offline, as_of: See BareStravaAPI.
+            scheduler (RequestScheduler | None): Defaults to a new RequestScheduler for this client.
+        """
+        AsyncAPI.__init__(self, self.base_url, self.cache_db,
+                          rate_limits=self.rate_limits,
+                          retry_on_rate_limit=True,
+                          loglevel=logging.INFO,
+                          codec=self.codec,
+                          scheduler=scheduler or RequestScheduler(self.rate_limits),
+                          metrics=self.metrics,
+                          offline=offline,
+                          as_of=as_of,
+                          max_connections=self.max_connections,
+                          )
+        self.backfill_routes(StravaAPIRoutes.all)
+        self.startup_requests = {
+            "get_athlete": get_athlete,
+            "list_all_activities": list_all_activities,
+            "get_athlete_zones": get_athlete_zones,
+            "get_athlete_stats": get_athlete_stats,
+        }
+
+    async def start(self):
+        """Runs the OAuth setup (unless offline) and the startup requests chosen in __init__, returns self."""
+        if not self.offline:
+            await asyncio.to_thread(self.authorize)
+        if self.startup_requests["get_athlete"]:
+            await self.get_athlete()
+        if self.startup_requests["list_all_activities"]:
+            await self.list_all_activities()
+        if self.startup_requests["get_athlete_zones"]:
+            await self.get_athlete_zones()
+        if self.startup_requests["get_athlete_stats"]:
+            await self.get_athlete_stats()
+        return self
+
+    def startup(self, *args, **kwargs):
+        raise TypeError("AsyncBareStravaAPI makes its startup requests in `await api.start()`")
+
+    async def aclose(self):
+        if getattr(self, "cleanup_oauth_loop", None) is not None:
+            self.cleanup_oauth_loop.set()
+        await AsyncAPI.aclose(self)
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def get_athlete(self, max_age=None, cache=True):
+        r = await self.get(StravaAPIRoutes.athlete, max_age=max_age, cache=cache)
+        self.athlete_info = r
+        self.athlete_id = r["id"]
+        return r
+
+    async def get_athlete_zones(self, max_age=None, cache=True):
+        zones = await self.get(StravaAPIRoutes.athlete_zones, max_age=max_age, cache=cache)
+        if zones and self.athlete_info:
+            self.athlete_info["zones"] = zones
+        return zones
+
+    async def get_athlete_stats(self, max_age=None, cache=True):
+        stats = await self.get(StravaAPIRoutes.athlete_stats, {"id": self.athlete_info["id"]}, max_age=max_age, cache=cache)
+        if stats and self.athlete_info:
+            self.athlete_info["stats"] = stats
+        return stats
+
+    async def list_all_activities(self, after="last_cached", max_age=None, cache=True):
+        """See BareStravaAPI.list_all_activities."""
+        all_activities, after, replay = await asyncio.to_thread(self._cached_activities, after, max_age)
+        new_activities = []
+        if not replay:
+            expected_pages = 1
+            if after is None:
+                expected_count = await self.estimate_activity_count()
+                expected_pages = expected_count // 200 + 1 if expected_count else 1
+            for activities in await self.list_activity_pages(after=after, max_age=max_age, cache=cache, expected_pages=expected_pages):
+                new_activities.extend(activities)
+        return self._add_new_activities(all_activities, new_activities, cache)
+
+    async def list_activity_pages(self, after=None, max_age=None, cache=True, expected_pages=1, per_page=200, wave=4):
+        """Lists pages of activities concurrently, returning them in page order up to the first short page.
+
+        The first wave requests `expected_pages` pages at once, the following waves start at one page and double up to
+        `wave` pages, see BareStravaAPI.list_activity_pages. Requests for pages past the last one are cancelled.
+        """
+        priority = getattr(self._priority, "value", None)
+        priority = Priority.sync if priority is None else priority
+        pages = []
+        size = max(expected_pages, 1)
+        with self.priority(priority):  # the tasks copy the priority when they are created
+            while True:
+                tasks = [asyncio.create_task(self._activities_page(per_page=per_page, page=page, after=after,
+                                                                   max_age=max_age, cache=cache))
+                         for page in range(len(pages) + 1, len(pages) + size + 1)]
+                try:
+                    for task in tasks:
+                        pages.append(await task)
+                        if len(pages[-1]) < per_page:  # counted with tombstones, see BareStravaAPI.list_activity_pages
+                            return [without_deleted(page) for page in pages]
+                finally:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                size = min(size * 2, wave) if len(pages) > expected_pages else 1
+
+    async def estimate_activity_count(self):
+        """See BareStravaAPI.estimate_activity_count."""
+        return await asyncio.to_thread(BareStravaAPI.estimate_activity_count, self)
+
+    async def list_athlete_activities(self, before=None, after=None, page: int = 1, per_page: int = 30,
+                                      max_age: int | None = None, cache: bool = True, filter=None, **filters):
+        """See BareStravaAPI.list_athlete_activities."""
+        activities = without_deleted(await self._activities_page(before, after, page, per_page, max_age, cache))
+        if filter is None and not filters:
+            return activities
+        filtered_activities = self.filter_activities(filter, activities={a["id"]: a for a in activities}, **filters)
+        return list(filtered_activities.values())
+
+    async def list_all_activity_comments(self, activity_id: int, page_size: int = 200, max_age=None, cache=True):
+        """See BareStravaAPI.list_all_activity_comments."""
+        comments = []
+        after_cursor = None
+        while True:
+            page = await self.list_activity_comments(activity_id, page_size=page_size, after_cursor=after_cursor,
+                                                     max_age=max_age, cache=cache)
+            comments.extend(page)
+            if len(page) < page_size or not page[-1].get("cursor"):
+                return comments
+            after_cursor = page[-1]["cursor"]
+
+    async def list_all_activity_kudos(self, activity_id: int, per_page: int = 200, max_age=None, cache=True):
+        """See BareStravaAPI.list_all_activity_kudos."""
+        kudoers = []
+        page = 1
+        while True:
+            kudos = await self.list_activity_kudos(activity_id, page=page, per_page=per_page, max_age=max_age, cache=cache)
+            kudoers.extend(kudos)
+            if len(kudos) < per_page:
+                return kudoers
+            page += 1
+
+    async def export_route_gpx_bytes(self, activity_id, max_age=None, cache=True):
+        """See BareStravaAPI.export_route_gpx_bytes."""
+        return (await self.get(StravaAPIRoutes.export_gpx, {"id": activity_id}, max_age=max_age, cache=cache)).encode()
+
+    async def export_route_tcx_bytes(self, activity_id, max_age=None, cache=True):
+        """See BareStravaAPI.export_route_tcx_bytes."""
+        return (await self.get(StravaAPIRoutes.export_tcx, {"id": activity_id}, max_age=max_age, cache=cache)).encode()
+
+    async def export_route_gpx_file(self, activity_id, filename=None, max_age=None, cache=True):
+        """See BareStravaAPI.export_route_gpx_file."""
+        b = await self.export_route_gpx_bytes(activity_id, max_age=max_age, cache=cache)
+        return await asyncio.to_thread(self._write_export, activity_id, filename, "gpx", b)
+
+    async def export_route_tcx_file(self, activity_id, filename=None, max_age=None, cache=True):
+        """See BareStravaAPI.export_route_tcx_file."""
+        b = await self.export_route_tcx_bytes(activity_id, max_age=max_age, cache=cache)
+        return await asyncio.to_thread(self._write_export, activity_id, filename, "tcx", b)
+
+    def _write_export(self, activity_id, filename, extension, b):
+        if filename is None:
+            if activity_id in getattr(self, "all_activities", {}):
+                name = self.all_activities[activity_id]["name"].replace(" ", "_")
+                disallowed = "<>:\"/\\|?*"
+                name = "".join(c if c not in disallowed else "_" for c in name)
+                start_date = self.all_activities[activity_id]["start_date_local"].replace(":", "_")
+                filename = f"{start_date}_{name}_{activity_id}.{extension}"
+            else:
+                filename = f"{activity_id}.{extension}"
+        with open(filename, "wb") as f:
+            f.write(b)
+        return filename
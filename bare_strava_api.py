@@ -4,12 +4,15 @@ import time
 import datetime
 from pathlib import Path
 import webbrowser
+from concurrent.futures import ThreadPoolExecutor
 from typing import Literal
 
 import requests
 import yaml
 
-from api_cache import API
+from api_cache import API, OfflineMissError
+from request_scheduler import Priority, RequestScheduler
+from activity_store import ActivityStore, without_deleted
 from strava_oauth import StravaOauth
 
 
@@ -31,6 +34,9 @@ class StravaAPIRoutes:
     export_tcx = "/routes/{id}/export_tcx"
     get_route = "/routes/{id}"
 
+    all = (athlete, athlete_zones, athlete_stats, list_activities, detailed_activity, list_activity_comments,
+           list_activity_kudos, list_activity_laps, activity_streams, upload_activity, export_gpx, export_tcx, get_route)
+
 
 class Streams:
     """Enumerates the Strava API streams available for activities."""
@@ -70,6 +76,8 @@ class BareStravaAPI(StravaOauth, API):
     """
     base_url = "https://www.strava.com/api/v3"
     cache_db = "api_cache.db"
+    codec = None  # fastest installed JSON codec, see json_codecs.get_codec
+    metrics = None  # set to a metrics.Metrics() to instrument requests and the cache
     secrets_yaml = Path("secrets.yaml")
     rate_limits = {
         100: 15 * 60,
@@ -106,7 +114,11 @@ class BareStravaAPI(StravaOauth, API):
                  get_athlete=True,
                  list_all_activities=True,
                  get_athlete_zones=False,
-                 get_athlete_stats=False
+                 get_athlete_stats=False,
+                 offline=False,
+                 as_of=None,
+                 scheduler=None,
+                 tenant=None
                  ):
         """Initializes the API object and makes a few useful requests to get you started.
 
@@ -120,14 +132,35 @@ class BareStravaAPI(StravaOauth, API):
                 This is useful if you want to get the athlete's heart rate zones, power zones, etc.
             get_athlete_stats (bool): Whether to get the athlete stats. Defaults to False.
                 This is useful if you want to get the athlete's stats like total distance, total time, etc.
+            offline (bool): Answer every request from the cache, skipping OAuth and never touching the network.
+                Requests which were never cached raise OfflineMissError. Defaults to False.
+            as_of (float | datetime.datetime | None): Replay the cache as it was at this time (implies offline).
+            scheduler (RequestScheduler | None): Shared with other clients of the same app. Defaults to a new
+                RequestScheduler with the rate limits.
+            tenant (Hashable | None): Who the requests are made for, see API. Defaults to None.
             """
         API.__init__(self, self.base_url, self.cache_db,
                      rate_limits=self.rate_limits,
                      retry_on_rate_limit=True,
                      loglevel=logging.INFO,
-
+                     codec=self.codec,
+                     scheduler=RequestScheduler(self.rate_limits) if scheduler is None else scheduler,
+                     metrics=self.metrics,
+                     offline=offline,
+                     as_of=as_of,
+                     tenant=tenant,
                      )
+        self.backfill_routes(StravaAPIRoutes.all)
+        if not self.offline:
+            self.authorize()
+        self.startup(get_athlete, list_all_activities, get_athlete_zones, get_athlete_stats)
+
+    def authorize(self):
+        """Runs the OAuth setup (see StravaOauth), called by __init__ unless offline."""
         StravaOauth.__init__(self, secrets_yaml=self.secrets_yaml)
+
+    def startup(self, get_athlete=True, list_all_activities=True, get_athlete_zones=False, get_athlete_stats=False):
+        """Makes the requests chosen in __init__."""
         if get_athlete:
             self.athlete_info = self.get_athlete()
             self.athlete_id = self.athlete_info["id"]
@@ -171,44 +204,134 @@ class BareStravaAPI(StravaOauth, API):
 
         By default it will use the cache to get the last time the list was retrieved, and only get activities after that time.
         If you want to get all activities from the beginning, set max_age=0
+        Pages are requested concurrently through the scheduler, see `list_activity_pages`.
 
         Args:
             after (str | datetime.datetime | int): A timestamp to use for filtering activities that have taken place after a certain time.
                 Defaults to "last_cached", which will use the last time the list was retrieved from the cache.
                 If you want to get all activities from the beginning, set after=0
             max_age (int | None): Maximum age of the cache in seconds. Defaults to None.
+                Ignored when offline, where the cached pages (as of `as_of`) are returned without listing newer ones.
             cache (bool): Whether to use the cache. Defaults to True.
         """
-        if after == "last_cached" and max_age != 0:
-            cached_responses = self.cache.retrieve_cached_get(
-                self.base_url + StravaAPIRoutes.list_activities,
-                limit=None,
-                order_by="called_at ASC",
-                response_code=200,
-                max_age=max_age,
-            )
-            all_cached_activities = {}
-            for response in cached_responses:
-                for activity in response:
-                    all_cached_activities[activity["id"]] = activity
-            after = max([datetime.datetime.strptime(activity["start_date"], "%Y-%m-%dT%H:%M:%SZ") for activity in all_cached_activities.values()]) if all_cached_activities else None
-        else:
-            all_cached_activities = {}
+        all_activities, after, replay = self._cached_activities(after, max_age)
+        new_activities = []
+        if not replay:
+            expected_pages = 1
+            if after is None:
+                # a full listing, the athlete stats tell us roughly how many pages to expect
+                expected_count = self.estimate_activity_count()
+                expected_pages = expected_count // 200 + 1 if expected_count else 1
+            for activities in self.list_activity_pages(after=after, max_age=max_age, cache=cache, expected_pages=expected_pages):
+                new_activities.extend(activities)
+        return self._add_new_activities(all_activities, new_activities, cache)
+
+    def _cached_activities(self, after, max_age):
+        """Returns (ActivityStore of the cached list pages, `after` to list newer activities from, whether to stop there).
+
+        The current all_activities store is kept and only the pages cached since are added to it, so its change log
+        (see ActivityStore.changes_since) tells consumers like ActivityRollups what a new listing changed.
+        A new store is built for max_age and as_of, which limit the pages taken into account.
+        """
+        url = self.base_url + StravaAPIRoutes.list_activities
+        replay = self.offline and after == "last_cached"  # offline, the cached pages are all there is
+        if after != "last_cached" or (max_age == 0 and not replay):
+            return ActivityStore(self.cache, url), None if after == "last_cached" else after, replay
+        all_activities = getattr(self, "all_activities", None)
+        if not isinstance(all_activities, ActivityStore) or all_activities.url != url or max_age is not None or self.as_of is not None:
+            all_activities = ActivityStore(self.cache, url)
+        conditions = {"called_at": ("<=", self.as_of)} if self.as_of is not None else {}
+        if all_activities.last_row:
+            conditions["id"] = (">", all_activities.last_row)
+        cached_responses = self.cache.select(
+            columns=["id", "response_json"],
+            url=url,
+            method="GET",
+            response_code=200,
+            max_age=None if self.offline else max_age,
+            order_by="called_at ASC",
+            **conditions
+        )
+        if replay and not cached_responses and not all_activities:
+            raise OfflineMissError(url, as_of=self.as_of)
+        with self.cache.lock:  # the store may be the live all_activities, which webhook fetches update
+            for row, response_json in cached_responses:
+                all_activities.add_page(self.cache.codec.loads(response_json), row=row)
+        after = datetime.datetime.strptime(all_activities.newest, "%Y-%m-%dT%H:%M:%SZ") if all_activities.newest else None
+        return all_activities, after, replay
+
+    def _add_new_activities(self, all_activities, new_activities, cache=True):
+        new_activities.sort(key=lambda x: datetime.datetime.strptime(x["start_date"], "%Y-%m-%dT%H:%M:%SZ"), reverse=True)
+        with self.cache.lock:  # webhook fetches update all_activities from other threads
+            for activity in new_activities:
+                all_activities.add(activity, keep_raw=not cache)  # uncached pages can't be read back
+            # the pages just listed are in the store already, the next listing only reads pages cached after them
+            url = self.base_url + StravaAPIRoutes.list_activities
+            all_activities.last_row = max(all_activities.last_row, self.cache.select(columns="MAX(id)", url=url)[0] or 0)
+            self.all_activities = all_activities
+            self.activity_ids = list(self.all_activities.keys())
+        return all_activities
 
-        page = 1
-        activities = True
-        all_activities = []
-        while activities:
-            activities = self.list_athlete_activities(per_page=200, page=page, after=after, max_age=max_age, cache=cache)
-            page += 1
-            all_activities.extend(activities)
-        all_activities.sort(key=lambda x: datetime.datetime.strptime(x["start_date"], "%Y-%m-%dT%H:%M:%SZ"), reverse=True)
-        self.all_activities = {
-            **all_cached_activities,
-            **{activity["id"]: activity for activity in all_activities}
-        }
-        self.activity_ids = list(self.all_activities.keys())
-        return self.all_activities
+    def list_activity_pages(self, after=None, max_age=None, cache=True, expected_pages=1, per_page=200):
+        """Lists pages of activities concurrently, returning them in page order up to the first short page.
+
+        The first wave requests `expected_pages` pages at once. The estimate is a lower bound, so once it is passed the
+        following waves start at one page and double up to as many pages as the scheduler has workers, and no wave is
+        submitted after a short page. Each request still waits for its slot of the rate limit budget, at the priority
+        of the calling thread (Priority.sync if none is set). Queued requests for pages past the last one are cancelled.
+        The pages are fetched on a pool of their own, so this can be called from the scheduler's threads.
+        Without a scheduler the pages are requested one at a time.
+        """
+        priority = getattr(self._priority, "value", None)
+        priority = Priority.sync if priority is None else priority
+
+        def fetch(page):
+            with self.priority(priority):
+                return self._activities_page(per_page=per_page, page=page, after=after, max_age=max_age, cache=cache)
+
+        # pages are counted with the tombstones of deleted activities, which are only dropped from the result
+        pages = []
+        if self.scheduler is None:
+            while not pages or len(pages[-1]) == per_page:
+                pages.append(fetch(len(pages) + 1))
+            return [without_deleted(page) for page in pages]
+
+        # waiting on the scheduler's own executor from one of its threads could leave no thread to run the pages
+        pool = ThreadPoolExecutor(max_workers=self.scheduler.max_workers, thread_name_prefix="list_activity_pages")
+        wave = max(expected_pages, 1)
+        try:
+            while True:
+                futures = [pool.submit(fetch, page) for page in range(len(pages) + 1, len(pages) + wave + 1)]
+                try:
+                    for future in futures:
+                        pages.append(future.result())
+                        if len(pages[-1]) < per_page:
+                            return [without_deleted(page) for page in pages]
+                finally:
+                    for future in futures:
+                        future.cancel()
+                wave = min(wave * 2, self.scheduler.max_workers) if len(pages) > expected_pages else 1
+        finally:
+            pool.shutdown(wait=False)
+
+    def estimate_activity_count(self):
+        """Estimates the number of activities from the athlete stats, or returns None if they are not available.
+
+        Only uses stats which were already fetched (athlete_info or the cache), listing shouldn't cost an extra request.
+        Only runs, rides and swims are counted in the stats, so this is a lower bound.
+        """
+        if getattr(self, "athlete_info", None) is None:
+            return None
+        stats = self.athlete_info.get("stats")
+        if stats is None:
+            url = self.base_url + StravaAPIRoutes.athlete_stats.format(id=self.athlete_info["id"])
+            conditions = {"called_at": ("<=", self.as_of)} if self.as_of is not None else {}
+            cached = self.cache.retrieve_cached_get(url, response_code=200, fields=("all_run_totals", "all_ride_totals", "all_swim_totals"),
+                                                    **conditions)
+            if not cached:
+                return None
+            stats = cached[0]
+        return sum((stats.get(f"all_{sport}_totals") or {}).get("count", 0) for sport in ("run", "ride", "swim"))
 
     def list_athlete_activities(self,
                                 before: int | datetime.datetime | str | None = None,
@@ -230,6 +353,14 @@ class BareStravaAPI(StravaOauth, API):
             max_age (int | None): Maximum age of the cache in seconds. Defaults to None.
             cache (bool): Whether to use the cache. Defaults to True.
         """
+        activities = without_deleted(self._activities_page(before, after, page, per_page, max_age, cache))
+        if filter is None and not filters:
+            return activities
+        filtered_activities = self.filter_activities(filter, activities={a["id"]: a for a in activities}, **filters)
+        return list(filtered_activities.values())
+
+    def _activities_page(self, before=None, after=None, page=1, per_page=30, max_age=None, cache=True):
+        """Returns a page of list_activities as cached, including the tombstones of deleted activities (see StravaWebhook)."""
         if per_page > 200:
             raise ValueError("per_page must be less than or equal to 200")
         if per_page < 0:
@@ -245,7 +376,7 @@ class BareStravaAPI(StravaOauth, API):
         if page < 1:
             raise ValueError("page must be greater than or equal to 1")
 
-        activities = self.get(StravaAPIRoutes.list_activities, {
+        return self.get(StravaAPIRoutes.list_activities, {
             "before": before,
             "after": after,
             "page": page,
@@ -253,15 +384,13 @@ class BareStravaAPI(StravaOauth, API):
         },
         max_age=max_age,
         cache=cache)
-        filtered_activities = self.filter_activities(filter, **filters)
-        return filtered_activities
 
     def filter_activities(self, filter = None, activities=None, **filters):
         """Searches the cache for activities that match the conditions.
 
         Args:
             filter (function): A function that takes an activity and returns True if it should be included, False otherwise.
-            activities (dict): A dictionary of activities to filter. Defaults to None, which will use all_activities.
+            activities (dict | ActivityStore): A dictionary of activities to filter. Defaults to None, which will use all_activities.
             filters (dict): A dictionary of key-value pairs to filter the activities by. The key is the field to filter by, and the value is the condition to filter by.
                 The condition can be...
                 * a value,
@@ -270,7 +399,7 @@ class BareStravaAPI(StravaOauth, API):
                 * a string that starts with "~" to search for a substring, or
                 * a function that takes a value and returns True if it matches the condition.
         """
-        if not activities:
+        if activities is None:
             activities = self.all_activities
         filtered_activities = {k: v for k, v in activities.items() if not filter or filter(v)}
         for activity_id, activity in filtered_activities.items():
@@ -428,6 +557,23 @@ class BareStravaAPI(StravaOauth, API):
                         max_age=max_age,
                         cache=cache)
 
+    def list_all_activity_comments(self, activity_id: int, page_size: int = 200, max_age=None, cache=True):
+        """Lists every comment on an activity by following `after_cursor` until an empty or partial page is returned.
+
+        Args:
+            activity_id (int) The identifier of the activity.
+            page_size (int) Number of items per page. Defaults to 200.
+        """
+        comments = []
+        after_cursor = None
+        while True:
+            page = self.list_activity_comments(activity_id, page_size=page_size, after_cursor=after_cursor,
+                                               max_age=max_age, cache=cache)
+            comments.extend(page)
+            if len(page) < page_size or not page[-1].get("cursor"):
+                return comments
+            after_cursor = page[-1]["cursor"]
+
     def add_activity_comment(self, activity_id: int, text: str):
         return requests.post(StravaAPIRoutes.list_activity_comments,
                         {"id": activity_id, "text": text})
@@ -444,6 +590,22 @@ class BareStravaAPI(StravaOauth, API):
                         max_age=max_age,
                         cache=cache)
 
+    def list_all_activity_kudos(self, activity_id: int, per_page: int = 200, max_age=None, cache=True):
+        """Lists every kudoer of an activity by requesting pages until an empty or partial page is returned.
+
+        Args:
+            activity_id (int) The identifier of the activity.
+            per_page (int) Number of items per page. Defaults to 200.
+        """
+        kudoers = []
+        page = 1
+        while True:
+            kudos = self.list_activity_kudos(activity_id, page=page, per_page=per_page, max_age=max_age, cache=cache)
+            kudoers.extend(kudos)
+            if len(kudos) < per_page:
+                return kudoers
+            page += 1
+
     def list_activity_laps(self, activity_id: int, max_age=None, cache=True):
         return self.get(StravaAPIRoutes.list_activity_laps,
                         {"id": activity_id},
@@ -464,7 +626,7 @@ class BareStravaAPI(StravaOauth, API):
 
     def export_route_gpx_bytes(self, activity_id, max_age=None, cache=True):
         # / routes / {id} / export_gpx
-        return self.get(StravaAPIRoutes.export_route_gpx,
+        return self.get(StravaAPIRoutes.export_gpx,
                         {"id": activity_id},
                         max_age=max_age,
                         cache=cache).encode()
@@ -487,7 +649,7 @@ class BareStravaAPI(StravaOauth, API):
 
     def export_route_tcx_bytes(self, activity_id, max_age=None, cache=True):
         # / routes / {id} / export_tcx
-        return self.get(StravaAPIRoutes.export_route_tcx,
+        return self.get(StravaAPIRoutes.export_tcx,
                         {"id": activity_id},
                         max_age=max_age,
                         cache=cache).encode()
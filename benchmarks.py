@@ -0,0 +1,200 @@
+"""Reproducible benchmarks of the hot paths, run against MockStrava and synthetic cache databases (no quota is spent).
+
+    python benchmarks.py --sizes 10000 100000 --output bench.json
+    python benchmarks.py --compare bench.json  # flags results more than 20% slower than a previous run
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import tempfile
+import time
+
+from json_codecs import available_codecs, get_codec
+from kudokid import KudoKidAPI
+from mock_strava import MockStrava, make_cache_db
+
+
+def make_client(base_url, cache_path, cls=KudoKidAPI, **kwargs):
+    """Constructs an API client through its regular __init__, pointed at `base_url` and authorized with a dummy token.
+
+    The client gets unlimited rate limits and makes no startup requests unless kwargs ask for them.
+    """
+    client_cls = type(f"Mock{cls.__name__}", (cls,), {
+        "base_url": base_url,
+        "cache_db": cache_path,
+        "rate_limits": {10 ** 9: 1},
+        "authorize": lambda self: self.set_access_token("mock"),
+    })
+    for request in ("get_athlete", "list_all_activities", "get_athlete_zones", "get_athlete_stats"):
+        kwargs.setdefault(request, False)
+    api = client_cls(**kwargs)
+    if not hasattr(api, "all_activities"):
+        api.all_activities = {}
+    return api
+
+
+def timed(fn, repeat=1):
+    """Returns the best wall time of `repeat` calls of fn, and the last result."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        t = time.perf_counter() - t0
+        best = t if best is None else min(best, t)
+    return best, result
+
+
+class Benchmarks:
+    def __init__(self, sizes=(10_000, 100_000), n_activities=2000, latency=0.0, workdir=None, seed=0):
+        self.sizes = sizes
+        self.n_activities = n_activities
+        self.latency = latency
+        self.workdir = workdir or tempfile.mkdtemp(prefix="kudokid_bench_")
+        self.seed = seed
+        self.results = []
+
+    def record(self, name, seconds, n=1, **params):
+        result = {"name": name, "params": params, "seconds": seconds, "n": n, "ops_per_sec": n / seconds if seconds else None}
+        self.results.append(result)
+        print(f"{name:<36} {str(params):<48} {seconds * 1000:10.2f} ms  {result['ops_per_sec'] or 0:12.1f} ops/s")
+        return result
+
+    def db_path(self, name):
+        path = os.path.join(self.workdir, f"{name}.db")
+        if os.path.exists(path):
+            os.remove(path)
+        return path
+
+    def bench_cache(self, lookups=500, inserts=500):
+        r = random.Random(self.seed)
+        for size in self.sizes:
+            path = self.db_path(f"cache_{size}")
+            cache = make_cache_db(path, size, seed=self.seed)
+            mock = MockStrava(n_activities=size, seed=self.seed)
+            ids = [mock.activity_id(r.randrange(size)) for _ in range(lookups)]
+            url = "https://www.strava.com/api/v3/activities/{}"
+            t, _ = timed(lambda: [cache.retrieve_cached_get(url.format(i), params={"include_all_efforts": True}) for i in ids])
+            self.record("cache_lookup", t, lookups, rows=size)
+            t, _ = timed(lambda: [cache.retrieve_cached_get(url.format(i), params={"include_all_efforts": True},
+                                                            fields=("id", "kudos_count")) for i in ids])
+            self.record("cache_lookup_fields", t, lookups, rows=size)
+            responses = [_Response({"id": i, "name": f"new {i}"}) for i in range(inserts)]
+            t, _ = timed(lambda: [cache.cache_get(url.format(i), {"include_all_efforts": True}, response)
+                                  for i, response in enumerate(responses)])
+            self.record("cache_insert", t, inserts, rows=size)
+            cache.conn.close()
+            # opening the cache, creating its indexes and backfilling routes
+            t, api = timed(lambda: make_client("https://www.strava.com/api/v3", path))
+            self.record("client_init", t, 1, rows=size)
+            api.cache.conn.close()
+
+    def bench_list_all_activities(self, mock):
+        pages = (self.n_activities + 199) // 200
+        path = self.db_path("list_all_activities")
+        make_cache_db(path, 0, base_url=mock.base_url, mock=mock, list_pages=pages).conn.close()
+        api = make_client(mock.base_url, path)
+        t, activities = timed(lambda: api.list_all_activities())
+        self.record("list_all_activities_startup", t, len(activities), activities=len(activities), cached_pages=pages)
+        t, _ = timed(lambda: api.filter_activities(lambda a: a["distance"] > 10000, sport_type="Run"), repeat=5)
+        self.record("filter_activities", t, len(activities), activities=len(activities))
+
+        cold = make_client(mock.base_url, self.db_path("list_all_activities_cold"))
+        t, activities = timed(lambda: cold.list_all_activities())
+        self.record("list_all_activities_cold", t, len(activities), activities=len(activities), latency=mock.latency)
+
+    def bench_detailed_activities(self, mock, n=100):
+        api = make_client(mock.base_url, self.db_path("detailed"))
+        api.all_activities = {mock.activity_id(i): mock.activity(i) for i in range(n)}
+        api.list_all_activities = lambda max_age=None, cache=True: api.all_activities
+        t, detailed = timed(lambda: api.get_all_detailed_activities())
+        self.record("get_all_detailed_activities_cold", t, len(detailed), activities=n, latency=mock.latency)
+        t, detailed = timed(lambda: api.get_all_detailed_activities())
+        self.record("get_all_detailed_activities_cached", t, len(detailed), activities=n)
+
+    def bench_streams(self, mock, n=20):
+        api = make_client(mock.base_url, self.db_path("streams"))
+        ids = [mock.activity_id(i) for i in range(n)]
+        t, _ = timed(lambda: [api.get_activity_streams(i) for i in ids])
+        self.record("get_activity_streams_cold", t, n, points=mock.stream_points, latency=mock.latency)
+        t, _ = timed(lambda: [api.get_activity_streams(i) for i in ids])
+        self.record("get_activity_streams_cached", t, n, points=mock.stream_points)
+        keys = ["time", "distance", "latlng", "altitude", "heartrate", "cadence", "watts", "velocity_smooth", "grade_smooth"]
+        body = json.dumps(mock.streams(0, keys)).encode()
+        for name in available_codecs:
+            codec = get_codec(name)
+            t, _ = timed(lambda: codec.loads(body), repeat=5)
+            self.record("stream_decode", t, 1, codec=name, points=mock.stream_points, bytes=len(body))
+
+    def run(self):
+        self.bench_cache()
+        with MockStrava(n_activities=self.n_activities, latency=self.latency, seed=self.seed) as mock:
+            self.bench_list_all_activities(mock)
+            self.bench_detailed_activities(mock)
+            self.bench_streams(mock)
+        return self.report()
+
+    def report(self):
+        try:
+            commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+        except OSError:
+            commit = None
+        return {
+            "created_at": time.time(),
+            "commit": commit,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "results": self.results,
+        }
+
+
+class _Response:
+    """Just enough of a requests.Response for APICache.cache_request"""
+    status_code = 200
+    encoding = "utf-8"
+    headers = {"Content-Type": "application/json; charset=utf-8"}
+
+    def __init__(self, body):
+        self.content = json.dumps(body).encode()
+
+
+def compare(report, baseline, threshold=0.2):
+    """Returns [(name, params, baseline seconds, seconds)] for results more than `threshold` slower than the baseline."""
+    previous = {(r["name"], json.dumps(r["params"], sort_keys=True)): r["seconds"] for r in baseline["results"]}
+    regressions = []
+    for r in report["results"]:
+        key = (r["name"], json.dumps(r["params"], sort_keys=True))
+        if key in previous and r["seconds"] > previous[key] * (1 + threshold):
+            regressions.append((r["name"], r["params"], previous[key], r["seconds"]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000],
+                        help="cache sizes (rows) for the APICache benchmarks, e.g. 10000 100000 1000000")
+    parser.add_argument("--activities", type=int, default=2000, help="number of activities the mock athlete has")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds of latency the mock server adds to each request")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--compare", help="compare against the results in this json file")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative slowdown which counts as a regression")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)  # the clients would log every request at INFO
+
+    report = Benchmarks(sizes=args.sizes, n_activities=args.activities, latency=args.latency).run()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), threshold=args.threshold)
+        for name, params, before, after in regressions:
+            print(f"REGRESSION {name} {params}: {before * 1000:.2f} ms -> {after * 1000:.2f} ms")
+        if regressions:
+            raise SystemExit(1)
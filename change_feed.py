@@ -0,0 +1,197 @@
+import json
+import logging
+import re
+import threading
+import time
+from functools import partial
+
+from api_cache import response_row
+from bare_strava_api import StravaAPIRoutes
+
+
+logger = logging.getLogger(__name__)
+
+
+def diff(old, new, path=""):
+    """Yields (path, old value, new value) for every difference between two JSON values.
+
+    Objects are compared key by key and lists of the same length element by element, so a changed title is reported as
+    ("name", "Morning Run", "Race!") and a changed lap as ("laps[2].moving_time", 300, 301). Missing keys count as None.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in [*old, *(k for k in new if k not in old)]:
+            yield from diff(old.get(key), new.get(key), f"{path}.{key}" if path else key)
+    elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        for i, (a, b) in enumerate(zip(old, new)):
+            yield from diff(a, b, f"{path}[{i}]")
+    elif old != new:
+        yield path, old, new
+
+
+class ChangeFeed:
+    """Change data capture for refetched responses, e.g. detailed activities after titles, gear or kudos counts change.
+
+    * Every response of the watched routes received from the network is diffed against the previous cached response for
+    the same request, and only the differences are appended to the `change_feed` table as (seq, activity id, path, old, new).
+    * With `prune` (the default) the previous copies are then deleted from the cache, so storage only grows with actual
+    changes. Offline `as_of` replay reads those copies: without a `replay_horizon` it only sees the latest version of
+    these responses, with one every copy it needs for an `as_of` within the horizon is kept.
+    * Consumers tail the feed incrementally: `poll("my_consumer")` returns the changes since its last poll, the offsets
+    are stored in `change_feed_offsets`.
+    * The first response for a request is the baseline and produces no changes. `build_cached()` diffs the versions
+    which were cached before the feed existed.
+    """
+
+    def __init__(self, api, routes=(StravaAPIRoutes.detailed_activity,), conn=None, prune=True, replay_horizon=None):
+        """
+        Args:
+            api (BareStravaAPI): The API whose responses are watched.
+            routes (tuple[str]): Route templates to watch, their {id} is recorded as the object id.
+                Defaults to detailed activities.
+            conn (sqlite3.Connection): Where to store the feed. Defaults to the connection of the API cache.
+            prune (bool): Delete the previous copies of a response once it has been diffed. Defaults to True.
+            replay_horizon (float | None): Seconds of history pruning keeps for `as_of` replay: the copies cached since
+                then and the newest one before. Defaults to None, which keeps only the latest copy.
+        """
+        self.api = api
+        self.routes = routes
+        self.conn = api.cache.conn if conn is None else conn
+        self.lock = api.cache.lock if conn is None else threading.RLock()
+        self.prune = prune
+        self.replay_horizon = replay_horizon
+        self.create()
+
+    def create(self):
+        with self.lock:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS change_feed (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    changed_at REAL,
+                    route TEXT,
+                    object_id INTEGER,
+                    path TEXT,
+                    old TEXT,  -- JSON, TEXT affinity keeps e.g. "5" from being stored as an integer
+                    new TEXT
+                );
+                CREATE INDEX IF NOT EXISTS change_feed_object ON change_feed (object_id, seq);
+
+                CREATE TABLE IF NOT EXISTS change_feed_offsets (
+                    consumer TEXT PRIMARY KEY,
+                    seq INTEGER
+                );
+            """)
+            self.conn.commit()
+
+    def attach(self, api=None):
+        """Diffs the responses of the watched routes `api` (defaults to self.api) receives from now on."""
+        api = api or self.api
+        for route in self.routes:
+            api.add_response_hook(route, partial(self._on_response, route))
+        return self
+
+    def _on_response(self, route, params, body):
+        params = dict(params or {})
+        object_id = params.get("id")
+        url = self.api.base_url + self.api.resolve_route(route, params)
+        cache = self.api.cache
+        condition = cache.request_condition("GET", url, params=params, response_code=200)
+        current = response_row.get()  # the row this response was cached in, None with cache=False
+        previous = cache.select(columns=["response_json"], order_by="id DESC", limit=1,
+                                **condition, **({"id": ("<", current)} if current is not None else {}))
+        if previous:
+            self.record(route, object_id, cache.codec.loads(previous[0][0]), body)
+        if self.prune and current is not None:
+            self._prune(condition, current)
+
+    def _prune(self, condition, before):
+        """Deletes the copies of a response cached before row `before`, except those as_of replay within the horizon needs."""
+        cache = self.api.cache
+        if self.replay_horizon is not None:
+            # an as_of at the horizon reads the newest copy cached before it, later ones read the copies since
+            before = cache.select(columns="MAX(id)", id=("<", before),
+                                  called_at=("<=", time.time() - self.replay_horizon), **condition)[0]
+            if before is None:
+                return
+        cache.delete(id=("<", before), **condition)
+
+    def record(self, route, object_id, old, new, changed_at=None):
+        """Appends the differences between two versions of a response to the feed, returns how many there were."""
+        changed_at = time.time() if changed_at is None else changed_at
+        changes = [(changed_at, route, object_id, path, json.dumps(a), json.dumps(b)) for path, a, b in diff(old, new)]
+        if changes:
+            with self.lock:
+                self.conn.executemany("INSERT INTO change_feed (changed_at, route, object_id, path, old, new) "
+                                      "VALUES (?, ?, ?, ?, ?, ?)", changes)
+                self.conn.commit()
+            logger.info(f"{len(changes)} changes of {route} {object_id}")
+        return len(changes)
+
+    def changes(self, after=0, limit=1000, object_id=None, route=None):
+        """Returns up to `limit` changes with a seq greater than `after`, oldest first.
+
+        Returns:
+            list[dict]: [{"seq", "changed_at", "route", "object_id", "path", "old", "new"}]
+        """
+        cmd = "SELECT seq, changed_at, route, object_id, path, old, new FROM change_feed WHERE seq > ?"
+        params = [after]
+        if object_id is not None:
+            cmd += " AND object_id = ?"
+            params.append(object_id)
+        if route is not None:
+            cmd += " AND route = ?"
+            params.append(route)
+        cmd += " ORDER BY seq LIMIT ?"
+        params.append(limit)
+        with self.lock:
+            rows = self.conn.execute(cmd, params).fetchall()
+        return [{"seq": seq, "changed_at": changed_at, "route": route, "object_id": object_id, "path": path,
+                 "old": json.loads(old), "new": json.loads(new)}
+                for seq, changed_at, route, object_id, path, old, new in rows]
+
+    def offset(self, consumer):
+        """Returns the seq of the last change the consumer committed (0 if none)."""
+        with self.lock:
+            row = self.conn.execute("SELECT seq FROM change_feed_offsets WHERE consumer = ?", (consumer,)).fetchone()
+        return row[0] if row else 0
+
+    def commit(self, consumer, seq):
+        with self.lock:
+            self.conn.execute("INSERT INTO change_feed_offsets (consumer, seq) VALUES (?, ?) "
+                              "ON CONFLICT (consumer) DO UPDATE SET seq = excluded.seq", (consumer, seq))
+            self.conn.commit()
+
+    def poll(self, consumer, limit=1000, commit=True):
+        """Returns the changes since the consumer's last poll, committing its new offset unless `commit` is False."""
+        changes = self.changes(after=self.offset(consumer), limit=limit)
+        if commit and changes:
+            self.commit(consumer, changes[-1]["seq"])
+        return changes
+
+    def build_cached(self):
+        """Diffs the consecutive versions already in the cache into the feed (pruning them if `prune`).
+
+        Returns:
+            int: The number of changes recorded.
+        """
+        cache = self.api.cache
+        n = 0
+        for route in self.routes:
+            object_id_pattern = re.compile(re.escape(self.api.base_url) + "([^/]+)".join(
+                re.escape(part) for part in re.split(r"\{\w+}", route)))
+            with self.lock:
+                groups = self.conn.execute("SELECT url, params FROM requests WHERE route = ? AND method = 'GET' "
+                                           "AND response_code = 200 GROUP BY url, params HAVING COUNT(*) > 1",
+                                           (route,)).fetchall()
+            for url, params in groups:
+                match = object_id_pattern.fullmatch(url)
+                object_id = int(match.group(1)) if match and match.groups() and match.group(1).isdigit() else None
+                rows = cache.select(columns=["id", "called_at", "response_json"], url=url, method="GET", params=params,
+                                    response_code=200, order_by="id")
+                previous = cache.codec.loads(rows[0][2])
+                for _, called_at, response_json in rows[1:]:
+                    body = cache.codec.loads(response_json)
+                    n += self.record(route, object_id, previous, body, changed_at=called_at)
+                    previous = body
+                if self.prune:
+                    self._prune({"url": url, "method": "GET", "params": params, "response_code": 200}, rows[-1][0])
+        return n
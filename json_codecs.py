@@ -0,0 +1,105 @@
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+class JSONCodec:
+    """Decodes/encodes response bodies with the standard library json module.
+
+    Every codec raises a subclass of ValueError when a body is not valid JSON.
+    """
+    name = "json"
+
+    def loads(self, data: bytes | str):
+        return json.loads(data)
+
+    def dumps(self, obj) -> str:
+        return json.dumps(obj)
+
+    def loads_fields(self, data: bytes | str, fields: tuple[str]):
+        """Decodes only the top-level `fields` of an object (or of each object in a list of objects).
+
+        The base implementation decodes everything and then picks the fields, faster codecs skip the rest of the body.
+        """
+        return self.pick_fields(self.loads(data), fields)
+
+    @staticmethod
+    def pick_fields(obj, fields: tuple[str]):
+        if isinstance(obj, dict):
+            return {f: obj.get(f) for f in fields}
+        if isinstance(obj, list):
+            return [{f: x.get(f) for f in fields} if isinstance(x, dict) else x for x in obj]
+        return obj
+
+
+class OrjsonCodec(JSONCodec):
+    name = "orjson"
+
+    def loads(self, data: bytes | str):
+        return orjson.loads(data)
+
+    def dumps(self, obj) -> str:
+        return orjson.dumps(obj).decode()
+
+
+class MsgspecCodec(JSONCodec):
+    name = "msgspec"
+
+    def __init__(self):
+        self.decoder = msgspec.json.Decoder()
+        self.encoder = msgspec.json.Encoder()
+        self.field_decoders = {}  # {fields: msgspec.json.Decoder}
+
+    def loads(self, data: bytes | str):
+        return self.decoder.decode(data)
+
+    def dumps(self, obj) -> str:
+        return self.encoder.encode(obj).decode()
+
+    def loads_fields(self, data: bytes | str, fields: tuple[str]):
+        fields = tuple(fields)
+        decoder = self.field_decoders.get(fields)
+        if decoder is None:
+            struct = msgspec.defstruct("Fields", [(f, Any, None) for f in fields])
+            decoder = self.field_decoders[fields] = msgspec.json.Decoder(struct | list[struct])
+        try:
+            result = decoder.decode(data)
+        except msgspec.ValidationError:
+            # not an object or a list of objects, so there are no fields to pick
+            return self.pick_fields(self.loads(data), fields)
+        if isinstance(result, list):
+            return [msgspec.structs.asdict(x) for x in result]
+        return msgspec.structs.asdict(result)
+
+
+codecs = {
+    "json": JSONCodec,
+    "orjson": OrjsonCodec,
+    "msgspec": MsgspecCodec,
+}
+available_codecs = tuple(name for name, module in [("msgspec", msgspec), ("orjson", orjson), ("json", json)] if module is not None)
+
+
+def get_codec(codec: str | JSONCodec | None = None) -> JSONCodec:
+    """Returns a codec instance.
+
+    Args:
+        codec (str | JSONCodec | None): "json", "orjson", "msgspec", or a codec instance.
+            Defaults to None, which picks the fastest installed codec (msgspec, then orjson, then json).
+    """
+    if isinstance(codec, JSONCodec):
+        return codec
+    if codec is None:
+        codec = available_codecs[0]
+    if codec not in available_codecs:
+        raise ValueError(f"codec must be one of {available_codecs}, got {codec}")
+    return codecs[codec]()
@@ -1,5 +1,8 @@
 import datetime
 from bare_strava_api import BareStravaAPI
+from kudos_sync import KudosSync
+from activity_rollups import ActivityRollups
+from request_scheduler import Priority
 
 
 class KudoKidAPI(BareStravaAPI):
@@ -7,28 +10,53 @@ class KudoKidAPI(BareStravaAPI):
                  get_athlete=True,
                  list_all_activities=True,
                  get_athlete_zones=True,
-                 get_athlete_stats=True):
+                 get_athlete_stats=True,
+                 offline=False,
+                 as_of=None):
         super().__init__(get_athlete=get_athlete,
                          list_all_activities=list_all_activities,
                          get_athlete_zones=get_athlete_zones,
-                         get_athlete_stats=get_athlete_stats)
+                         get_athlete_stats=get_athlete_stats,
+                         offline=offline,
+                         as_of=as_of)
 
     def __repr__(self):
         return f'KudoKid({self.athlete_info.get("firstname", "Unknown")}, {self.athlete_info.get("lastname", "Unknown")})'
 
-    def get_all_detailed_activities(self, max_age=None, cache=True):
+    def get_all_detailed_activities(self, max_age=None, cache=True, priority=Priority.backfill):
         activities = self.list_all_activities(max_age=max_age, cache=cache)
-        non_detailed_activities = [activity for activity in activities if not activity.get("detailed")]
+        non_detailed_activities = [activity for activity in activities.values() if not activity.get("detailed")]
         number_of_activities = len(non_detailed_activities)
         time_needed = ((15 * 60) / 200) * number_of_activities
         print(f"Estimated time needed: {(time_needed/60):.2f} minutes")
 
         detailed_activities = []
-        for activity in activities:
-            detailed_activity = self.get_activity(activity["id"], max_age=max_age, cache=cache)
-            detailed_activities.append(detailed_activity)
+        with self.priority(priority):
+            for activity in activities.values():
+                detailed_activity = self.get_activity(activity["id"], max_age=max_age, cache=cache)
+                detailed_activities.append(detailed_activity)
         return detailed_activities
 
+    def sync_kudos(self, force=False):
+        """Fetches kudos and comments for every activity whose counts changed since the last sync."""
+        if getattr(self, "kudos_sync", None) is None:
+            self.kudos_sync = KudosSync(self)
+        return self.kudos_sync.sync(force=force)
+
+    def get_local_athlete_stats(self, reconcile_every=24 * 60 * 60):
+        """Derives athlete stats from the cached activity summaries instead of spending a request on get_athlete_stats.
+
+        Args:
+            reconcile_every (int | None): Compare against Strava's stats when the cached stats are older than this
+                many seconds. None never reconciles. Defaults to once a day.
+        """
+        if getattr(self, "rollups", None) is None:
+            self.rollups = ActivityRollups()
+        self.rollups.sync(self.all_activities)
+        if reconcile_every is not None:
+            self.rollups.reconcile(self.get_athlete_stats(max_age=reconcile_every))
+        return self.rollups.athlete_stats()
+
 
 if __name__ == "__main__":
     ku = KudoKidAPI()
@@ -0,0 +1,269 @@
+import time
+import logging
+import threading
+
+from request_scheduler import Priority
+
+
+logger = logging.getLogger(__name__)
+
+
+def period_sql(period, time_value):
+    """Returns an SQL expression bucketing a time value by "day", "week" (ISO, like activity_rollups), "month" or "year".
+
+    SQLite only has %G/%V (ISO year and week) since 3.46, so the ISO week is derived from the Thursday of the week.
+
+    Args:
+        period (str): One of "day", "week", "month" or "year".
+        time_value (str): SQL time value and modifiers, e.g. "start_date" or "synced_at, 'unixepoch'".
+    """
+    if period == "week":
+        thursday = f"date({time_value}, '-3 days', 'weekday 4')"
+        return f"printf('%s-W%02d', strftime('%Y', {thursday}), (strftime('%j', {thursday}) - 1) / 7 + 1)"
+    formats = {"day": "%Y-%m-%d", "month": "%Y-%m", "year": "%Y"}
+    if period not in formats:
+        raise ValueError("period must be one of ['day', 'week', 'month', 'year']")
+    return f"strftime('{formats[period]}', {time_value})"
+
+
+class KudosSync:
+    """Walks all activities and stores their kudos and comments in indexed SQLite tables.
+
+    * Kudos are paginated with page/per_page and comments with after_cursor until exhausted.
+    * The `kudos_count` and `comment_count` of each activity summary are remembered, so on the next sync only
+    activities whose counts changed are refetched.
+    * Every sync of an activity appends a row to `activity_social_history`, so deltas and trends are plain SQL queries.
+    """
+
+    def __init__(self, api, conn=None):
+        """
+        Args:
+            api (BareStravaAPI): The API object used to list activities, kudos and comments.
+            conn (sqlite3.Connection): Where to store the tables. Defaults to the connection of the API cache.
+        """
+        self.api = api
+        self.conn = api.cache.conn if conn is None else conn
+        self.lock = api.cache.lock if conn is None else threading.RLock()
+        self.create()
+
+    def create(self):
+        with self.lock:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS activity_social (
+                    activity_id INTEGER PRIMARY KEY,
+                    start_date TEXT,
+                    sport_type TEXT,
+                    kudos_count INTEGER,
+                    comment_count INTEGER,
+                    synced_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS activity_social_start_date ON activity_social (start_date);
+
+                CREATE TABLE IF NOT EXISTS activity_social_history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    activity_id INTEGER,
+                    synced_at REAL,
+                    kudos_count INTEGER,
+                    comment_count INTEGER,
+                    kudos_delta INTEGER,
+                    comment_delta INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS activity_social_history_activity ON activity_social_history (activity_id, synced_at);
+                CREATE INDEX IF NOT EXISTS activity_social_history_synced_at ON activity_social_history (synced_at);
+
+                CREATE TABLE IF NOT EXISTS kudos (
+                    activity_id INTEGER,
+                    position INTEGER,
+                    firstname TEXT,
+                    lastname TEXT,
+                    PRIMARY KEY (activity_id, position)
+                );
+                CREATE INDEX IF NOT EXISTS kudos_athlete ON kudos (firstname, lastname);
+
+                CREATE TABLE IF NOT EXISTS comments (
+                    id INTEGER PRIMARY KEY,
+                    activity_id INTEGER,
+                    athlete_id INTEGER,
+                    firstname TEXT,
+                    lastname TEXT,
+                    text TEXT,
+                    created_at TEXT,
+                    cursor TEXT
+                );
+                CREATE INDEX IF NOT EXISTS comments_activity ON comments (activity_id);
+                CREATE INDEX IF NOT EXISTS comments_athlete ON comments (athlete_id);
+            """)
+            self.conn.commit()
+
+    def synced_counts(self):
+        """Returns {activity_id: (kudos_count, comment_count)} as of the last sync."""
+        with self.lock:
+            rows = self.conn.execute("SELECT activity_id, kudos_count, comment_count FROM activity_social").fetchall()
+        return {activity_id: (kudos_count, comment_count) for activity_id, kudos_count, comment_count in rows}
+
+    def changed_activities(self, activities=None, synced=None):
+        """Returns the activity summaries whose kudos or comment count differs from the last sync.
+
+        Args:
+            activities (dict): {activity_id: activity summary}. Defaults to the api's all_activities.
+            synced (dict | None): The result of `synced_counts`, if the caller has it already.
+        """
+        if activities is None:
+            activities = self.api.all_activities
+        if synced is None:
+            synced = self.synced_counts()
+        return [
+            activity for activity_id, activity in activities.items()
+            if synced.get(activity_id) != (activity.get("kudos_count", 0), activity.get("comment_count", 0))
+        ]
+
+    def sync(self, activities=None, force=False):
+        """Refetches kudos and comments for every activity whose counts changed since the last sync.
+
+        Args:
+            activities (dict): {activity_id: activity summary}. Defaults to the api's all_activities.
+            force (bool): Refetch every activity, even if its counts did not change. Defaults to False.
+
+        Returns:
+            dict: {activity_id: (kudos_delta, comment_delta)} for each activity which was refetched.
+        """
+        if activities is None:
+            activities = self.api.all_activities
+        synced = self.synced_counts()
+        changed = list(activities.values()) if force else self.changed_activities(activities, synced)
+        logger.info(f"Syncing kudos and comments for {len(changed)} of {len(activities)} activities")
+        deltas = {}
+        with self.api.priority(Priority.kudos):
+            for activity in changed:
+                deltas[activity["id"]] = self.sync_activity(activity, previous=synced.get(activity["id"]), force=force)
+        return deltas
+
+    def sync_activity(self, activity, previous=None, force=False):
+        """Fetches all kudos and/or comments of one activity (only the ones whose count changed) and stores them.
+
+        Args:
+            activity (dict): The activity summary.
+            previous (tuple[int, int] | None): The (kudos_count, comment_count) stored by the previous sync.
+            force (bool): Refetch both kudos and comments, even if their counts did not change. Defaults to False.
+
+        Returns:
+            tuple[int, int]: (kudos_delta, comment_delta) relative to the previous sync.
+        """
+        activity_id = activity["id"]
+        kudos_count = activity.get("kudos_count", 0)
+        comment_count = activity.get("comment_count", 0)
+        old_kudos_count, old_comment_count = previous or (0, 0)
+        synced_at = time.time()
+
+        kudoers = comments = None
+        if force or kudos_count != old_kudos_count or previous is None:
+            kudoers = self.api.list_all_activity_kudos(activity_id, max_age=0) if kudos_count else []
+        if force or comment_count != old_comment_count or previous is None:
+            comments = self.api.list_all_activity_comments(activity_id, max_age=0) if comment_count else []
+
+        kudos_delta = kudos_count - old_kudos_count
+        comment_delta = comment_count - old_comment_count
+        # the fetches are done, the connection is only held (it's shared with the cache's other threads) for the writes
+        with self.lock:
+            if kudoers is not None:
+                self.conn.execute("DELETE FROM kudos WHERE activity_id = ?", (activity_id,))
+                self.conn.executemany(
+                    "INSERT INTO kudos (activity_id, position, firstname, lastname) VALUES (?, ?, ?, ?)",
+                    [(activity_id, i, k.get("firstname"), k.get("lastname")) for i, k in enumerate(kudoers)]
+                )
+            if comments is not None:
+                self.conn.execute("DELETE FROM comments WHERE activity_id = ?", (activity_id,))
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO comments (id, activity_id, athlete_id, firstname, lastname, text, created_at, cursor) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(c["id"], activity_id, c.get("athlete", {}).get("id"), c.get("athlete", {}).get("firstname"),
+                      c.get("athlete", {}).get("lastname"), c.get("text"), c.get("created_at"), c.get("cursor"))
+                     for c in comments]
+                )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO activity_social (activity_id, start_date, sport_type, kudos_count, comment_count, synced_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (activity_id, activity.get("start_date"), activity.get("sport_type"), kudos_count, comment_count, synced_at)
+            )
+            self.conn.execute(
+                "INSERT INTO activity_social_history (activity_id, synced_at, kudos_count, comment_count, kudos_delta, comment_delta) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (activity_id, synced_at, kudos_count, comment_count, kudos_delta, comment_delta)
+            )
+            self.conn.commit()
+        return kudos_delta, comment_delta
+
+    def top_kudos_givers(self, limit=10, since=None):
+        """Returns [(firstname, lastname, number of activities kudoed)] sorted by the number of kudos given.
+
+        Args:
+            limit (int): Maximum number of athletes to return. Defaults to 10.
+            since (str | None): Only count kudos on activities which started on or after this ISO 8601 date.
+        """
+        with self.lock:
+            return self.conn.execute(f"""
+                SELECT k.firstname, k.lastname, COUNT(*) AS n
+                FROM kudos k JOIN activity_social a ON a.activity_id = k.activity_id
+                {"WHERE a.start_date >= ?" if since else ""}
+                GROUP BY k.firstname, k.lastname
+                ORDER BY n DESC
+                LIMIT ?
+            """, (since, limit) if since else (limit,)).fetchall()
+
+    def top_commenters(self, limit=10):
+        """Returns [(athlete_id, firstname, lastname, number of comments)] sorted by the number of comments."""
+        # names are taken from each athlete's latest comment (comment ids increase over time)
+        with self.lock:
+            return self.conn.execute("""
+                WITH counts AS (
+                    SELECT athlete_id, COUNT(*) AS n, MAX(id) AS latest
+                    FROM comments
+                    GROUP BY athlete_id
+                    ORDER BY n DESC
+                    LIMIT ?
+                )
+                SELECT counts.athlete_id, comments.firstname, comments.lastname, counts.n
+                FROM counts JOIN comments ON comments.id = counts.latest
+                ORDER BY counts.n DESC
+            """, (limit,)).fetchall()
+
+    def kudos_over_time(self, period="month", by="activity"):
+        """Returns [(period, kudos, comments)] sorted by period.
+
+        Args:
+            period (str): One of "day", "week", "month" or "year". Defaults to "month".
+            by (str): "activity" buckets the current counts by activity start date,
+                "sync" buckets the kudos/comments gained by the time they were noticed. Defaults to "activity".
+        """
+        if by == "activity":
+            cmd = f"""SELECT {period_sql(period, 'start_date')} AS p, SUM(kudos_count), SUM(comment_count)
+                      FROM activity_social GROUP BY p ORDER BY p"""
+        elif by == "sync":
+            cmd = f"""SELECT {period_sql(period, "synced_at, 'unixepoch'")} AS p, SUM(kudos_delta), SUM(comment_delta)
+                      FROM activity_social_history GROUP BY p ORDER BY p"""
+        else:
+            raise ValueError("by must be 'activity' or 'sync'")
+        with self.lock:
+            return self.conn.execute(cmd).fetchall()
+
+    def activity_deltas(self, activity_id=None, since=None):
+        """Returns [(activity_id, synced_at, kudos_count, comment_count, kudos_delta, comment_delta)] sorted by sync time.
+
+        Args:
+            activity_id (int | None): Only return the history of this activity.
+            since (float | None): Only return syncs at or after this epoch timestamp.
+        """
+        conditions, params = [], []
+        if activity_id is not None:
+            conditions.append("activity_id = ?")
+            params.append(activity_id)
+        if since is not None:
+            conditions.append("synced_at >= ?")
+            params.append(since)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self.lock:
+            return self.conn.execute(f"""
+                SELECT activity_id, synced_at, kudos_count, comment_count, kudos_delta, comment_delta
+                FROM activity_social_history {where}
+                ORDER BY synced_at
+            """, params).fetchall()
@@ -0,0 +1,176 @@
+import threading
+import time
+
+from socketwrench import serve
+from socketwrench.types import RawResponse
+
+
+class Histogram:
+    """Cumulative-bucket histogram, the way Prometheus expects it."""
+    default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                self.counts[i] += 1
+
+
+class Metrics:
+    """Counters, gauges and histograms collected by API, APICache and RequestScheduler.
+
+    Instrumentation is off unless a Metrics object is passed in (`API(..., metrics=Metrics())`),
+    in which case each instrumented call costs a `metrics is not None` check and nothing else.
+
+    * `add_hook(callback)` forwards every event as callback(kind, name, value, labels), e.g. to statsd or a tracer.
+    * `render()` returns the Prometheus text exposition format and `serve(port)` exposes it on /metrics.
+
+    Metrics collected:
+    * api_requests_total{route, result}: result is "hit", "miss", "stale" (cached but older than max_age) or "bypass" (max_age=0)
+    * api_request_seconds{route, status}: network latency
+    * api_rate_limited_total{route}: 429 responses
+    * api_rate_limit_wait_seconds_total{reason}: time spent sleeping after 429s or waiting for a scheduler slot
+    * api_rate_limit_usage{window} / api_rate_limit_limit{window}: as reported in Strava's X-RateLimit headers
+    * cache_query_seconds{op}: SQLite select/insert/delete timings
+    * cache_bytes_stored_total: size of the response bodies written to the cache
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # {(name, labels): value}
+        self.gauges = {}  # {(name, labels): value}
+        self.histograms = {}  # {(name, labels): Histogram}
+        self.hooks = []
+        self.cleanup_event = None
+
+    def add_hook(self, callback):
+        """Calls callback(kind, name, value, labels) for every recorded event, kind is "counter", "gauge" or "histogram"."""
+        self.hooks.append(callback)
+
+    def remove_hook(self, callback):
+        self.hooks.remove(callback)
+
+    def _emit(self, kind, name, value, labels):
+        for hook in self.hooks:
+            hook(kind, name, value, labels)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        if self.hooks:
+            self._emit("counter", name, value, labels)
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+        if self.hooks:
+            self._emit("gauge", name, value, labels)
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+        if self.hooks:
+            self._emit("histogram", name, value, labels)
+
+    def timer(self, name, **labels):
+        """Context manager which observes the seconds spent inside it."""
+        return _Timer(self, name, labels)
+
+    def hit_ratio(self, route=None):
+        """Returns the fraction of requests (optionally of one route) which were answered from the cache."""
+        hits = total = 0
+        for (name, labels), value in self.counters.items():
+            if name != "api_requests_total":
+                continue
+            labels = dict(labels)
+            if route is not None and labels.get("route") != route:
+                continue
+            total += value
+            if labels.get("result") == "hit":
+                hits += value
+        return hits / total if total else None
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels) + "}"
+
+    def render(self) -> str:
+        """Returns all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for kind, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in metrics}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (n, labels), value in metrics.items():
+                        if n == name:
+                            lines.append(f"{name}{self._format_labels(labels)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (n, labels), histogram in self.histograms.items():
+                    if n != name:
+                        continue
+                    for b, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{name}_bucket{self._format_labels(labels, [('le', b)])} {count}")
+                    lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {histogram.count}")
+                    lines.append(f"{name}_sum{self._format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{self._format_labels(labels)} {histogram.count}")
+        return "".join(line + "\n" for line in lines)
+
+    def serve(self, port=9100):
+        """Serves the metrics at http://localhost:<port>/metrics from a background thread until `stop` is called."""
+        self.cleanup_event = threading.Event()
+        thread = threading.Thread(target=serve, args=(MetricsWebServer(self),),
+                                  kwargs={"port": port, "cleanup_event": self.cleanup_event}, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        if self.cleanup_event is not None:
+            self.cleanup_event.set()
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class MetricsWebServer:
+    def __init__(self, metrics):
+        self._metrics = metrics
+
+    def metrics(self):
+        # socketwrench rewrites header names (Content-Type becomes contentType), so the response is written out as is
+        body = self._metrics.render().encode()
+        return RawResponse(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                           b"Content-Length: %d\r\n\r\n%b" % (len(body), body))
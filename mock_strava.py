@@ -0,0 +1,362 @@
+import bisect
+import datetime
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from api_cache import APICache
+
+
+class MockStrava:
+    """Local stand-in for the parts of the Strava API we use, so hot paths can be measured without spending quota.
+
+    Serves /athlete, /athlete/zones, /athletes/{id}/stats, /athlete/activities (before/after/page/per_page),
+    /activities/{id}, /activities/{id}/streams, /activities/{id}/kudos (page/per_page),
+    /activities/{id}/comments (page_size/after_cursor) and /routes/{id}/export_gpx|export_tcx
+    under http://127.0.0.1:<port>/api/v3
+
+    * All data is generated deterministically from the seed, so runs are reproducible.
+    * `latency` adds a delay to every response, `error_rate` randomly answers 429,
+    and the rate limits are enforced in fixed windows and reported in X-RateLimit headers like Strava does.
+    """
+    athlete_id = 1234
+
+    def __init__(self, n_activities=1000, latency=0.0, error_rate=0.0, rate_limits=None, stream_points=5000,
+                 segment_efforts=10, seed=0, port=0):
+        """
+        Args:
+            n_activities (int): Number of activities the athlete has. Defaults to 1000.
+            latency (float): Seconds to wait before answering each request. Defaults to 0.
+            error_rate (float): Fraction of requests randomly answered with 429. Defaults to 0.
+            rate_limits (dict[int, int] | None): {<number of requests>: <window in seconds>}. Defaults to no limits.
+            stream_points (int): Number of points in each activity stream. Defaults to 5000.
+            segment_efforts (int): Number of segment efforts in each detailed activity. Defaults to 10.
+            seed (int): Seed of the synthetic data. Defaults to 0.
+            port (int): Port to listen on. Defaults to 0, which picks a free port.
+        """
+        self.n_activities = n_activities
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limits = rate_limits or {}
+        self.stream_points = stream_points
+        self.segment_efforts = segment_efforts
+        self.seed = seed
+        self.port = port
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.usage = {}  # {window: (window start, count)}
+        self.requests = []  # [(path, query)] of every request served
+        self.start_date = datetime.datetime(2015, 1, 1)
+        self._epochs = None
+        self.server = None
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/api/v3"
+
+    def start(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep connections alive like the real API
+
+            def do_GET(self):
+                mock.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            request_queue_size = 1024  # lots of concurrent clients connect at once
+            daemon_threads = True
+
+        self.server = Server(("127.0.0.1", self.port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # synthetic data
+    def activity_id(self, i):
+        return 10_000_000 + i
+
+    def activity(self, i):
+        """Summary of the i-th activity (oldest first)."""
+        r = random.Random(self.seed * 1_000_003 + i)
+        start = self.start_date + datetime.timedelta(hours=19 * i + r.randint(0, 8))
+        sport_type = r.choice(("Run", "Run", "Ride", "Ride", "Swim", "TrailRun", "Walk"))
+        distance = round(r.uniform(1000, 60000), 1)
+        moving_time = int(distance / r.uniform(2, 9))
+        return {
+            "resource_state": 2, "athlete": {"id": self.athlete_id, "resource_state": 1},
+            "name": f"{sport_type} {i}", "distance": distance, "moving_time": moving_time,
+            "elapsed_time": moving_time + r.randint(0, 900), "total_elevation_gain": round(r.uniform(0, 800), 1),
+            "type": sport_type, "sport_type": sport_type, "workout_type": None, "id": self.activity_id(i),
+            "start_date": start.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "start_date_local": (start - datetime.timedelta(hours=7)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "timezone": "(GMT-08:00) America/Los_Angeles", "utc_offset": -25200.0,
+            "achievement_count": r.randint(0, 5), "kudos_count": r.randint(0, 60), "comment_count": r.randint(0, 6),
+            "athlete_count": 1, "photo_count": 0,
+            "map": {"id": f"a{self.activity_id(i)}", "summary_polyline": "".join(r.choices("abcdefghijklmnopqrstuvwxyz_~?@", k=600)),
+                    "resource_state": 2},
+            "trainer": False, "commute": False, "manual": False, "private": False, "visibility": "everyone",
+            "gear_id": "g1", "average_speed": round(distance / moving_time, 3), "max_speed": 12.0,
+            "has_heartrate": True, "average_heartrate": round(r.uniform(110, 170), 1), "max_heartrate": 185.0,
+            "pr_count": 0, "has_kudoed": False,
+        }
+
+    def index(self, activity_id):
+        i = activity_id - 10_000_000
+        return i if 0 <= i < self.n_activities else None
+
+    def detailed_activity(self, i):
+        activity = self.activity(i)
+        r = random.Random(self.seed * 7 + i)
+        activity.update({
+            "resource_state": 3, "description": f"Description of activity {i}", "calories": r.randint(100, 2000),
+            "segment_efforts": [self.segment_effort(activity, j, r) for j in range(self.segment_efforts)],
+            "laps": [{"id": activity["id"] * 10 + j, "lap_index": j + 1, "elapsed_time": 300} for j in range(5)],
+        })
+        return activity
+
+    def segment_effort(self, activity, j, r):
+        segment_id = r.randint(1, 50)
+        elapsed_time = r.randint(60, 1200)
+        return {
+            "id": activity["id"] * 100 + j, "resource_state": 2, "name": f"Segment {segment_id}",
+            "activity": {"id": activity["id"]}, "athlete": {"id": self.athlete_id},
+            "elapsed_time": elapsed_time, "moving_time": elapsed_time - r.randint(0, 30),
+            "start_date": activity["start_date"], "start_date_local": activity["start_date_local"],
+            "distance": round(r.uniform(200, 5000), 1), "average_heartrate": round(r.uniform(120, 180), 1),
+            "average_watts": round(r.uniform(100, 350), 1), "pr_rank": None, "kom_rank": None,
+            "segment": {"id": segment_id, "name": f"Segment {segment_id}", "activity_type": activity["type"],
+                        "distance": 1000.0, "average_grade": 2.0, "city": "San Francisco"},
+        }
+
+    def streams(self, i, keys):
+        r = random.Random(self.seed * 13 + i)
+        n = self.stream_points
+        time_data = list(range(n))
+        data = {
+            "time": time_data,
+            "distance": [round(t * 3.1, 1) for t in time_data],
+            "altitude": [round(50 + 20 * r.random(), 1) for _ in time_data],
+            "heartrate": [r.randint(110, 180) for _ in time_data],
+            "cadence": [r.randint(80, 95) for _ in time_data],
+            "watts": [r.randint(100, 350) for _ in time_data],
+            "velocity_smooth": [round(3 + r.random(), 2) for _ in time_data],
+            "grade_smooth": [round(r.uniform(-5, 5), 1) for _ in time_data],
+            "temp": [20 for _ in time_data],
+            "moving": [True for _ in time_data],
+            "latlng": [[round(37.7 + t * 1e-5, 6), round(-122.4 + t * 1e-5 * r.random(), 6)] for t in time_data],
+        }
+        return {k: {"data": data[k], "series_type": "distance", "original_size": n, "resolution": "high"}
+                for k in keys if k in data}
+
+    def kudoers(self, i):
+        n = self.activity(i)["kudos_count"]
+        return [{"resource_state": 2, "firstname": f"Kudoer{(i + j) % 97}", "lastname": "K."} for j in range(n)]
+
+    def comments(self, i):
+        activity_id = self.activity_id(i)
+        n = self.activity(i)["comment_count"]
+        return [{"id": activity_id * 10 + j, "activity_id": activity_id, "text": f"Nice {j}!", "cursor": str(j),
+                 "created_at": self.activity(i)["start_date"],
+                 "athlete": {"id": 500 + (i + j) % 31, "firstname": f"Commenter{(i + j) % 31}", "lastname": "C."}}
+                for j in range(n)]
+
+    def stats(self):
+        totals = {}
+        for group, sport_types in (("run", ("Run", "TrailRun")), ("ride", ("Ride",)), ("swim", ("Swim",))):
+            activities = [a for a in map(self.activity, range(self.n_activities)) if a["sport_type"] in sport_types]
+            totals[f"all_{group}_totals"] = {
+                "count": len(activities), "distance": sum(a["distance"] for a in activities),
+                "moving_time": sum(a["moving_time"] for a in activities), "elapsed_time": sum(a["elapsed_time"] for a in activities),
+                "elevation_gain": sum(a["total_elevation_gain"] for a in activities),
+            }
+        return totals
+
+    # serving
+    def rate_limit_headers(self):
+        """Counts the request against the fixed rate limit windows, returns (headers, whether it is over the limit)."""
+        now = time.time()
+        over = False
+        usage = []
+        with self.lock:
+            for limit, window in sorted(self.rate_limits.items(), key=lambda x: x[1]):
+                start = now // window * window
+                window_start, count = self.usage.get(window, (start, 0))
+                count = count + 1 if window_start == start else 1
+                self.usage[window] = (start, count)
+                usage.append(count)
+                over = over or count > limit
+        if not self.rate_limits:
+            return {}, False
+        limits = sorted(self.rate_limits.items(), key=lambda x: x[1])
+        return {
+            "X-RateLimit-Limit": ",".join(str(limit) for limit, _ in limits),
+            "X-RateLimit-Usage": ",".join(map(str, usage)),
+        }, over
+
+    def route(self, path, query):
+        """Returns (status code, body) for a request."""
+        parts = path.removeprefix("/api/v3").strip("/").split("/")
+        q = {k: v[-1] for k, v in query.items()}
+        if parts == ["athlete"]:
+            return 200, {"id": self.athlete_id, "username": "mock", "firstname": "Mock", "lastname": "Athlete", "resource_state": 3}
+        if parts == ["athlete", "zones"]:
+            return 200, {"heart_rate": {"custom_zones": False, "zones": [{"min": 0, "max": 120}, {"min": 120, "max": -1}]}}
+        if len(parts) == 3 and parts[0] == "athletes" and parts[2] == "stats":
+            return 200, self.stats()
+        if parts == ["athlete", "activities"]:
+            page, per_page = int(q.get("page", 1)), int(q.get("per_page", 30))
+            after, before = float(q.get("after", 0) or 0), float(q.get("before", 0) or 0)
+            first = bisect.bisect_right(self.epochs(), after) if after else 0
+            end = bisect.bisect_left(self.epochs(), before) if before else self.n_activities
+            if after and not before:
+                indices = range(first, end)  # Strava returns activities after a date oldest first
+            else:
+                indices = range(end - 1, first - 1, -1)  # otherwise newest first
+            return 200, [self.activity(i) for i in indices[(page - 1) * per_page: page * per_page]]
+        if len(parts) >= 2 and parts[0] == "activities":
+            i = self.index(int(parts[1])) if parts[1].isdigit() else None
+            if i is None:
+                return 404, {"message": "Record Not Found", "errors": [{"resource": "Activity", "field": "id", "code": "not found"}]}
+            if len(parts) == 2:
+                return 200, self.detailed_activity(i)
+            if parts[2] == "streams":
+                return 200, self.streams(i, q.get("keys", "time").split(","))
+            if parts[2] == "kudos":
+                page, per_page = int(q.get("page", 1)), int(q.get("per_page", 30))
+                return 200, self.kudoers(i)[(page - 1) * per_page: page * per_page]
+            if parts[2] == "comments":
+                page_size = int(q.get("page_size", 30))
+                start = int(q["after_cursor"]) + 1 if q.get("after_cursor") else 0
+                return 200, self.comments(i)[start: start + page_size]
+            if parts[2] == "laps":
+                return 200, self.detailed_activity(i)["laps"]
+        if len(parts) == 3 and parts[0] == "routes" and parts[1].isdigit() and parts[2] in ("export_gpx", "export_tcx"):
+            # the document is served as a JSON string, which is what API.get decodes the body as
+            root = "gpx" if parts[2] == "export_gpx" else "TrainingCenterDatabase"
+            return 200, f'<?xml version="1.0" encoding="UTF-8"?><{root}><name>Route {parts[1]}</name></{root}>'
+        if len(parts) == 2 and parts[0] == "segments" and parts[1].isdigit():
+            segment_id = int(parts[1])
+            return 200, {"id": segment_id, "resource_state": 3, "name": f"Segment {segment_id}", "activity_type": "Run",
+                         "distance": 1000.0, "average_grade": 2.0, "climb_category": 0, "city": "San Francisco",
+                         "country": "United States", "effort_count": 100 * segment_id, "athlete_count": 10 * segment_id}
+        return 404, {"message": "Resource Not Found"}
+
+    def epochs(self):
+        """Start times of all activities, which increase with the index."""
+        if self._epochs is None:
+            self._epochs = [self._epoch(self.activity(i)) for i in range(self.n_activities)]
+        return self._epochs
+
+    def _epoch(self, activity):
+        return datetime.datetime.strptime(activity["start_date"], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=datetime.timezone.utc).timestamp()
+
+    def handle(self, handler):
+        url = urlparse(handler.path)
+        query = parse_qs(url.query)
+        with self.lock:
+            self.requests.append((url.path, query))
+        if self.latency:
+            time.sleep(self.latency)
+        headers, over = self.rate_limit_headers()
+        if over or (self.error_rate and self.random.random() < self.error_rate):
+            status, body = 429, {"message": "Rate Limit Exceeded", "errors": [{"resource": "Application", "code": "exceeded"}]}
+        else:
+            status, body = self.route(url.path, query)
+        payload = json.dumps(body).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json; charset=utf-8")
+        handler.send_header("Content-Length", str(len(payload)))
+        for k, v in headers.items():
+            handler.send_header(k, v)
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+
+def make_cache_db(path, n_rows, base_url="https://www.strava.com/api/v3", mock=None, detailed=False, list_pages=0,
+                  batch_size=10_000, seed=0):
+    """Fills a cache database with n_rows synthetic GET /activities/{id} responses (and optionally list pages).
+
+    Args:
+        path (str): Where to create the database.
+        n_rows (int): Number of /activities/{id} rows to insert.
+        base_url (str): Base url the rows are stored under. Defaults to the real Strava url.
+        mock (MockStrava | None): Where the bodies come from. Defaults to a MockStrava with n_rows activities.
+        detailed (bool): Store full detailed activities (~5KB each) instead of small bodies (~200 bytes). Defaults to False.
+        list_pages (int): Also store this many /athlete/activities pages of 200 summaries (at most the activities
+            the mock has, the last page may be short). Defaults to 0.
+        batch_size (int): Rows inserted per transaction. Defaults to 10000.
+
+    Returns:
+        APICache: The cache, opened on the new database.
+    """
+    mock = mock or MockStrava(n_activities=max(n_rows, list_pages * 200), seed=seed)
+    cache = APICache(path)
+    headers = json.dumps({"Content-Type": "application/json; charset=utf-8"})
+    now = time.time()
+
+    def rows():
+        for i in range(n_rows):
+            activity_id = mock.activity_id(i)
+            if detailed:
+                body = mock.detailed_activity(i)
+            else:
+                body = {"id": activity_id, "name": f"Activity {i}", "kudos_count": i % 61, "start_date": "2024-01-01T00:00:00Z"}
+            called_at = now - (n_rows - i)
+            yield (called_at, str(datetime.datetime.fromtimestamp(called_at)), f"{base_url}/activities/{activity_id}",
+                   None, json.dumps({"include_all_efforts": True}), "GET", 200, json.dumps(body), headers, "/activities/{id}")
+        for page in range(min(list_pages, -(-mock.n_activities // 200))):  # only activities the mock has
+            activities = [mock.activity(i) for i in range(page * 200, min((page + 1) * 200, mock.n_activities))]
+            yield (now, str(datetime.datetime.fromtimestamp(now)), f"{base_url}/athlete/activities", None,
+                   json.dumps({"after": None, "before": None, "page": page + 1, "per_page": 200}), "GET", 200,
+                   json.dumps(activities), headers, "/athlete/activities")
+
+    insert = ("INSERT INTO requests (called_at, called_at_str, url, headers, params, method, response_code, response_json, "
+              "response_headers, route) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+    batch = []
+    with cache.lock:
+        for row in rows():
+            batch.append(row)
+            if len(batch) >= batch_size:
+                cache.conn.executemany(insert, batch)
+                cache.conn.commit()
+                batch = []
+        cache.conn.executemany(insert, batch)
+        cache.conn.commit()
+    return cache
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Serves a mock Strava API")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--activities", type=int, default=1000, help="number of activities the mock athlete has")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds of latency added to each request")
+    args = parser.parse_args()
+    with MockStrava(n_activities=args.activities, latency=args.latency, port=args.port) as mock:
+        print(f"Mock Strava API serving at {mock.base_url}, press Ctrl+C to stop")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,232 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+
+class Priority:
+    """Enumerates the request priority classes, lower values are served first."""
+    interactive = 0  # someone is waiting on the answer
+    sync = 1  # picking up new activities
+    kudos = 2  # refreshing kudos and comments
+    backfill = 3  # detailed activities, streams, etc. which nobody is waiting for
+
+    all = (interactive, sync, kudos, backfill)
+
+
+class RequestScheduler:
+    """Decides which waiting request gets to spend the next unit of the API rate limit budget.
+
+    * Every request first `acquire`s a slot. Waiting requests are granted slots strictly by priority, then in arrival order,
+    so a queued backfill never gets in front of an interactive request.
+    * Requests can name a `tenant` (e.g. the athlete they are made for, when many athletes share one app's quota).
+    Within a priority class tenants then take turns (start-time fair queuing) instead of going strictly in arrival order,
+    so one athlete's backfill of thousands of requests doesn't hold up the others.
+    * Each priority class may only use up to its share of every rate limit window, e.g. with a backfill share of 0.5
+    backfills stop once half of the 15-minute (or daily) budget is used, reserving the rest for higher priorities.
+    * Usage is tracked locally and corrected with the usage Strava reports in its X-RateLimit-Usage headers.
+    * `submit` queues a function on a thread pool and returns a Future, for callers which don't want to block.
+    """
+    default_shares = {
+        Priority.interactive: 1.0,
+        Priority.sync: 0.9,
+        Priority.kudos: 0.7,
+        Priority.backfill: 0.5,
+    }
+
+    def __init__(self, rate_limits: dict[int, int], shares: dict[int, float] = None, max_workers: int = 4):
+        """
+        Args:
+            rate_limits (dict[int, int]): {<number of requests>: <timeframe in seconds>}, same as API.rate_limits
+            shares (dict[int, float]): {priority: fraction of each window that class may use}. Defaults to default_shares.
+            max_workers (int): Number of threads used to run submitted functions. Defaults to 4.
+        """
+        self.rate_limits = dict(rate_limits)
+        self.shares = {**self.default_shares, **(shares or {})}
+        self.max_workers = max_workers
+        self.condition = threading.Condition()
+        self.sent = {window: deque() for window in self.rate_limits.values()}  # {window seconds: deque of timestamps}
+        self.reported = {}  # {window seconds: (usage, limit, reported_at)}
+        self.paused_until = 0
+        self.waiting = []  # heap of (priority, fair queuing tag, arrival) tickets
+        self._arrivals = itertools.count()
+        self._virtual_time = {}  # {priority: tag of its last granted ticket}
+        self._next_tag = {}  # {(priority, tenant): tag of its next ticket}
+        self._async_waiters = {}  # {ticket: (event loop, future)} of the coroutines waiting in acquire_async
+        self._executor = None
+
+    def usage(self, window, now=None):
+        """Returns the number of requests used in a rate limit window."""
+        now = time.time() if now is None else now
+        sent = self.sent[window]
+        while sent and sent[0] <= now - window:
+            sent.popleft()
+        used = len(sent)
+        reported = self.reported.get(window)
+        if reported is not None and reported[2] // window == now // window:
+            # Strava counts fixed windows (every 15 minutes and daily since midnight UTC),
+            # so the reported usage holds until the window rolls over
+            used = max(used, reported[0] + sum(1 for t in sent if t > reported[2]))
+        return used
+
+    def wait_time(self, priority, now=None):
+        """Returns how many seconds a request of this priority has to wait before it may be sent (0 if it may go now)."""
+        now = time.time() if now is None else now
+        wait = max(self.paused_until - now, 0)
+        share = self.shares.get(priority, 1.0)
+        for limit, window in self.rate_limits.items():
+            reported = self.reported.get(window)
+            if reported is not None and reported[2] // window == now // window:
+                limit = min(limit, reported[1])
+            allowed = int(limit * share)
+            used = self.usage(window, now)
+            if used < allowed:
+                continue
+            sent = self.sent[window]
+            # the oldest request in the window which has to expire before we are back under the allowance
+            i = used - allowed
+            next_free = sent[i] + window if i < len(sent) else (now // window + 1) * window
+            if reported is not None and reported[2] // window == now // window:
+                next_free = max(next_free, (now // window + 1) * window)
+            wait = max(wait, next_free - now)
+        return wait
+
+    def _ticket(self, priority, tenant):
+        """Returns a new ticket of this priority and tenant, must be called holding the condition.
+
+        Each priority class keeps its own virtual time, so tenants' backfills don't skew the order of interactive requests.
+        """
+        # a tenant which was idle starts at the current virtual time instead of catching up on the turns it skipped
+        key = (priority, tenant)
+        tag = max(self._virtual_time.get(priority, 0), self._next_tag.get(key, 0))
+        self._next_tag[key] = tag + 1
+        return priority, tag, next(self._arrivals)
+
+    def _notify(self):
+        """Wakes the waiting threads and the coroutine at the head of the queue, must be called holding the condition."""
+        self.condition.notify_all()
+        if self.waiting:
+            waiter = self._async_waiters.get(self.waiting[0])
+            if waiter is not None:
+                loop, future = waiter
+                try:
+                    loop.call_soon_threadsafe(_set_done, future)
+                except RuntimeError:
+                    pass  # the loop was closed
+
+    def _grant(self):
+        """Pops the ticket at the head of the queue and counts it against the budget, must be called holding the condition."""
+        ticket = heapq.heappop(self.waiting)
+        self._virtual_time[ticket[0]] = max(self._virtual_time.get(ticket[0], 0), ticket[1])
+        now = time.time()
+        for sent in self.sent.values():
+            sent.append(now)
+
+    def acquire(self, priority=Priority.interactive, tenant=None):
+        """Blocks until a request of this priority (and tenant) may be sent, then counts it against the budget."""
+        with self.condition:
+            ticket = self._ticket(priority, tenant)
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while True:
+                    wait = self.wait_time(priority)
+                    if self.waiting[0] == ticket and wait <= 0:
+                        self._grant()
+                        break
+                    if wait > 0 and self.waiting[0] == ticket:
+                        logger.info(f"Priority {priority} request waiting {wait:.1f}s for rate limit budget")
+                    self.condition.wait(timeout=wait if wait > 0 else None)
+            except BaseException:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                raise
+            finally:
+                self._notify()
+
+    async def acquire_async(self, priority=Priority.interactive, tenant=None):
+        """Like acquire, but awaits a future so the event loop keeps running.
+
+        Async and threaded callers share the same queue and budget. Only the coroutine at the head of the queue is woken
+        when the head changes or the budget frees up, the others wait without polling.
+        """
+        loop = asyncio.get_running_loop()
+        with self.condition:
+            ticket = self._ticket(priority, tenant)
+            heapq.heappush(self.waiting, ticket)
+        try:
+            while True:
+                with self.condition:
+                    wait = self.wait_time(priority)
+                    at_head = self.waiting[0] == ticket
+                    if at_head and wait <= 0:
+                        self._grant()
+                        self._notify()
+                        return
+                    future = loop.create_future()
+                    self._async_waiters[ticket] = (loop, future)
+                # the head re-checks at least every second (usage reports may change the wait), the others wait to be woken
+                await asyncio.wait([future], timeout=min(wait, 1.0) if at_head else None)
+        finally:
+            with self.condition:
+                self._async_waiters.pop(ticket, None)
+                if ticket in self.waiting:  # cancelled or failed before being granted
+                    self.waiting.remove(ticket)
+                    heapq.heapify(self.waiting)
+                    self._notify()
+
+    def run(self, priority, fn, *args, **kwargs):
+        """Waits for a slot, then calls fn(*args, **kwargs) in the calling thread."""
+        self.acquire(priority)
+        return fn(*args, **kwargs)
+
+    def submit(self, priority, fn, *args, **kwargs):
+        """Queues fn(*args, **kwargs) to run on the scheduler's thread pool once a slot is granted.
+
+        Returns:
+            concurrent.futures.Future: call .result() to wait for the return value.
+        """
+        return self.executor.submit(self.run, priority, fn, *args, **kwargs)
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="request_scheduler")
+        return self._executor
+
+    def pause(self, seconds):
+        """Stops granting slots for the next `seconds` (e.g. after a 429 response)."""
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+            self._notify()
+
+    def update_usage(self, headers):
+        """Corrects the usage with Strava's X-RateLimit-Usage and X-RateLimit-Limit headers, e.g. "1,211" and "200,2000".
+
+        The comma-separated values are matched to the rate limit windows from shortest to longest.
+        """
+        usage = headers.get("X-RateLimit-Usage")
+        limits = headers.get("X-RateLimit-Limit")
+        if not usage or not limits:
+            return
+        now = time.time()
+        with self.condition:
+            for window, u, l in zip(sorted(self.sent), usage.split(","), limits.split(",")):
+                self.reported[window] = (int(u), int(l), now)
+            self._notify()
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
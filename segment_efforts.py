@@ -0,0 +1,342 @@
+import json
+import logging
+import threading
+import time
+
+from bare_strava_api import StravaAPIRoutes
+from kudos_sync import period_sql
+
+
+logger = logging.getLogger(__name__)
+
+
+class SegmentEffortIndex:
+    """Indexes the segment efforts of detailed activities into SQLite tables, so segment questions never parse JSON.
+
+    * `attach()` indexes the efforts of every detailed activity fetched from then on, `build_cached()` extracts the
+    efforts of the detailed activities already cached (inside SQLite with json_each).
+    * `history(segment_id)`, `leaderboard(segment_id)`, `personal_records(segment_id)` and `trend(segment_id)` are
+    indexed queries on the `segment_efforts` table.
+    * `segment_stats` (attempts, best time, first and last date per segment) is kept up to date for the segments of
+    each indexed activity, so `segments()` lists every segment ridden/run without aggregating all efforts.
+    * `segment(segment_id)` returns what the efforts told us about a segment and fetches the detailed segment
+    (`get_segment`) on first use only.
+    """
+    effort_columns = ("effort_id", "segment_id", "activity_id", "name", "start_date", "start_date_local",
+                      "elapsed_time", "moving_time", "distance", "average_heartrate", "max_heartrate", "average_watts",
+                      "average_cadence", "pr_rank", "kom_rank")
+    # what segments() can be ordered by, the column of each
+    segment_orderings = {"attempts": "s.attempts", "best_elapsed_time": "s.best_elapsed_time", "first_date": "s.first_date",
+                         "last_date": "s.last_date", "name": "g.name", "distance": "g.distance", "segment_id": "s.segment_id"}
+
+    def __init__(self, api, conn=None):
+        """
+        Args:
+            api (BareStravaAPI): The API whose detailed activities are indexed.
+            conn (sqlite3.Connection): Where to store the tables. Defaults to the connection of the API cache.
+        """
+        self.api = api
+        self.conn = api.cache.conn if conn is None else conn
+        self.lock = api.cache.lock if conn is None else threading.RLock()
+        self.create()
+
+    def create(self):
+        with self.lock:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS segment_efforts (
+                    effort_id INTEGER PRIMARY KEY,
+                    segment_id INTEGER,
+                    activity_id INTEGER,
+                    name TEXT,
+                    start_date TEXT,
+                    start_date_local TEXT,
+                    elapsed_time INTEGER,
+                    moving_time INTEGER,
+                    distance REAL,
+                    average_heartrate REAL,
+                    max_heartrate REAL,
+                    average_watts REAL,
+                    average_cadence REAL,
+                    pr_rank INTEGER,
+                    kom_rank INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS segment_efforts_segment_time ON segment_efforts (segment_id, elapsed_time);
+                CREATE INDEX IF NOT EXISTS segment_efforts_segment_date ON segment_efforts (segment_id, start_date);
+                CREATE INDEX IF NOT EXISTS segment_efforts_activity ON segment_efforts (activity_id);
+
+                CREATE TABLE IF NOT EXISTS segments (
+                    segment_id INTEGER PRIMARY KEY,
+                    name TEXT,
+                    activity_type TEXT,
+                    distance REAL,
+                    average_grade REAL,
+                    climb_category INTEGER,
+                    city TEXT,
+                    country TEXT,
+                    detailed TEXT,  -- JSON of get_segment, fetched on first use
+                    fetched_at REAL
+                );
+
+                CREATE TABLE IF NOT EXISTS segment_stats (
+                    segment_id INTEGER PRIMARY KEY,
+                    attempts INTEGER,
+                    best_effort_id INTEGER,
+                    best_elapsed_time INTEGER,
+                    first_date TEXT,
+                    last_date TEXT
+                );
+
+                -- activities whose efforts are indexed (including those without any)
+                CREATE TABLE IF NOT EXISTS segment_indexed_activities (
+                    activity_id INTEGER PRIMARY KEY,
+                    efforts INTEGER,
+                    indexed_at REAL
+                );
+            """)
+            self.conn.commit()
+
+    def attach(self, api=None):
+        """Indexes the efforts of every detailed activity `api` (defaults to self.api) fetches from now on."""
+        api = api or self.api
+        api.add_response_hook(StravaAPIRoutes.detailed_activity, self._on_activity)
+        return self
+
+    def _on_activity(self, params, activity):
+        if "segment_efforts" in activity:  # summary representations of an activity don't have them
+            self.index_activity(activity)
+
+    @staticmethod
+    def effort_row(effort, activity_id):
+        return (
+            effort["id"], effort["segment"]["id"], activity_id, effort.get("name"),
+            effort.get("start_date"), effort.get("start_date_local"),
+            effort.get("elapsed_time"), effort.get("moving_time"), effort.get("distance"),
+            effort.get("average_heartrate"), effort.get("max_heartrate"), effort.get("average_watts"),
+            effort.get("average_cadence"), effort.get("pr_rank"), effort.get("kom_rank"),
+        )
+
+    @staticmethod
+    def segment_row(segment):
+        return (segment["id"], segment.get("name"), segment.get("activity_type"), segment.get("distance"),
+                segment.get("average_grade"), segment.get("climb_category"), segment.get("city"), segment.get("country"))
+
+    def index_activity(self, activity):
+        """(Re)indexes the segment efforts of a detailed activity.
+
+        Returns:
+            list[int]: The effort ids which are new personal records (faster than every earlier effort on the segment).
+        """
+        activity_id = activity["id"]
+        efforts = [e for e in activity.get("segment_efforts") or [] if e.get("segment")]
+        rows = [self.effort_row(e, activity_id) for e in efforts]
+        with self.lock:
+            previous = {r[0] for r in self.conn.execute("SELECT DISTINCT segment_id FROM segment_efforts WHERE activity_id = ?",
+                                                        (activity_id,))}
+            self.conn.execute("DELETE FROM segment_efforts WHERE activity_id = ?", (activity_id,))
+            self._insert(rows, [self.segment_row(e["segment"]) for e in efforts], [(activity_id, len(rows))])
+            segment_ids = previous | {row[1] for row in rows}
+            self._update_stats(segment_ids)
+            self.conn.commit()
+        prs = [row[0] for row in rows if self.is_personal_record(row[0])]
+        if prs:
+            logger.info(f"Activity {activity_id} has {len(prs)} personal records")
+        return prs
+
+    def remove_activity(self, activity_id):
+        """Removes the efforts of an activity (e.g. one which was deleted on Strava)."""
+        with self.lock:
+            segment_ids = {r[0] for r in self.conn.execute("SELECT DISTINCT segment_id FROM segment_efforts WHERE activity_id = ?",
+                                                           (activity_id,))}
+            self.conn.execute("DELETE FROM segment_efforts WHERE activity_id = ?", (activity_id,))
+            self.conn.execute("DELETE FROM segment_indexed_activities WHERE activity_id = ?", (activity_id,))
+            self._update_stats(segment_ids)
+            self.conn.commit()
+
+    def _insert(self, effort_rows, segment_rows, activity_rows):
+        """Inserts efforts, segment summaries and indexed activities, must be called holding the lock."""
+        columns = ", ".join(self.effort_columns)
+        self.conn.executemany(f"INSERT OR REPLACE INTO segment_efforts ({columns}) "
+                              f"VALUES ({', '.join('?' * len(self.effort_columns))})", effort_rows)
+        # the detailed segment (if fetched) is kept, only the summary fields are refreshed
+        self.conn.executemany("""
+            INSERT INTO segments (segment_id, name, activity_type, distance, average_grade, climb_category, city, country)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (segment_id) DO UPDATE SET name = excluded.name, activity_type = excluded.activity_type,
+                distance = excluded.distance, average_grade = excluded.average_grade,
+                climb_category = excluded.climb_category, city = excluded.city, country = excluded.country
+        """, segment_rows)
+        now = time.time()
+        self.conn.executemany("INSERT OR REPLACE INTO segment_indexed_activities (activity_id, efforts, indexed_at) "
+                              "VALUES (?, ?, ?)", [(activity_id, n, now) for activity_id, n in activity_rows])
+
+    def _update_stats(self, segment_ids):
+        """Recomputes segment_stats of some segments from their efforts, must be called holding the lock."""
+        segment_ids = list(segment_ids)
+        for i in range(0, len(segment_ids), 500):
+            chunk = segment_ids[i:i + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            self.conn.execute(f"DELETE FROM segment_stats WHERE segment_id IN ({placeholders})", chunk)
+            # SQLite returns the other columns of the row holding the MIN(elapsed_time)
+            self.conn.execute(f"""
+                INSERT INTO segment_stats (segment_id, attempts, best_effort_id, best_elapsed_time, first_date, last_date)
+                SELECT segment_id, COUNT(*), effort_id, MIN(elapsed_time),
+                    (SELECT MIN(start_date) FROM segment_efforts AS d WHERE d.segment_id = e.segment_id),
+                    (SELECT MAX(start_date) FROM segment_efforts AS d WHERE d.segment_id = e.segment_id)
+                FROM segment_efforts AS e WHERE segment_id IN ({placeholders}) GROUP BY segment_id
+            """, chunk)
+
+    def build_cached(self, reindex=False):
+        """Indexes the efforts of the detailed activities in the cache (only not yet indexed ones, unless `reindex`).
+
+        The efforts are extracted by SQLite (json_each), from the latest cached response of each activity.
+
+        Returns:
+            int: The number of activities indexed.
+        """
+        url = self.api.base_url + StravaAPIRoutes.detailed_activity
+        body = "CASE WHEN json_valid(r.response_json) THEN r.response_json END"
+        with self.lock:
+            candidates = self.conn.execute(f"""
+                SELECT r.id, json_extract({body}, '$.id') FROM requests AS r
+                WHERE r.route = ? AND r.method = 'GET' AND r.response_code = 200
+                AND json_type({body}, '$.segment_efforts') = 'array'
+                AND NOT EXISTS (SELECT 1 FROM requests AS newer WHERE newer.url = r.url AND newer.method = 'GET'
+                    AND newer.params IS r.params AND newer.response_code = 200 AND newer.id > r.id)
+            """, (StravaAPIRoutes.detailed_activity,)).fetchall()
+            if not reindex:
+                indexed = {r[0] for r in self.conn.execute("SELECT activity_id FROM segment_indexed_activities")}
+                candidates = [(row, activity_id) for row, activity_id in candidates if activity_id not in indexed]
+        fields = ", ".join(f"json_extract(e.value, '$.{f}')" for f in self.effort_columns[3:])
+        n = 0
+        for i in range(0, len(candidates), 500):
+            chunk = candidates[i:i + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            source = f"requests AS r, json_each({body}, '$.segment_efforts') AS e WHERE r.id IN ({placeholders})"
+            with self.lock:
+                activity_ids = [activity_id for _, activity_id in chunk]
+                self.conn.execute(f"DELETE FROM segment_efforts WHERE activity_id IN ({placeholders})", activity_ids)
+                effort_rows = self.conn.execute(f"""
+                    SELECT json_extract(e.value, '$.id'), json_extract(e.value, '$.segment.id'), json_extract(r.response_json, '$.id'),
+                        {fields}
+                    FROM {source} AND json_extract(e.value, '$.segment.id') IS NOT NULL
+                """, [row for row, _ in chunk]).fetchall()
+                segment_rows = self.conn.execute(f"""
+                    SELECT json_extract(e.value, '$.segment.id'), json_extract(e.value, '$.segment.name'),
+                        json_extract(e.value, '$.segment.activity_type'), json_extract(e.value, '$.segment.distance'),
+                        json_extract(e.value, '$.segment.average_grade'), json_extract(e.value, '$.segment.climb_category'),
+                        json_extract(e.value, '$.segment.city'), json_extract(e.value, '$.segment.country')
+                    FROM {source} AND json_extract(e.value, '$.segment.id') IS NOT NULL
+                    GROUP BY json_extract(e.value, '$.segment.id')
+                """, [row for row, _ in chunk]).fetchall()
+                counts = {}
+                for row in effort_rows:
+                    counts[row[2]] = counts.get(row[2], 0) + 1
+                self._insert(effort_rows, segment_rows, [(activity_id, counts.get(activity_id, 0)) for activity_id in activity_ids])
+                self._update_stats({row[0] for row in segment_rows})
+                self.conn.commit()
+            n += len(chunk)
+        logger.info(f"Indexed the segment efforts of {n} cached activities")
+        return n
+
+    def _efforts(self, cmd, params):
+        with self.lock:
+            rows = self.conn.execute(cmd, params).fetchall()
+        return [dict(zip(self.effort_columns, row)) for row in rows]
+
+    def history(self, segment_id, since=None):
+        """Returns every effort on a segment, oldest first."""
+        columns = ", ".join(self.effort_columns)
+        if since is None:
+            return self._efforts(f"SELECT {columns} FROM segment_efforts WHERE segment_id = ? ORDER BY start_date", (segment_id,))
+        return self._efforts(f"SELECT {columns} FROM segment_efforts WHERE segment_id = ? AND start_date >= ? "
+                             "ORDER BY start_date", (segment_id, since))
+
+    def leaderboard(self, segment_id, limit=10):
+        """Returns the fastest efforts on a segment."""
+        columns = ", ".join(self.effort_columns)
+        return self._efforts(f"SELECT {columns} FROM segment_efforts WHERE segment_id = ? "
+                             "ORDER BY elapsed_time, start_date LIMIT ?", (segment_id, limit))
+
+    def personal_records(self, segment_id):
+        """Returns the progression of the personal record on a segment: each effort faster than all earlier ones, oldest first."""
+        columns = ", ".join(self.effort_columns)
+        return self._efforts(f"""
+            SELECT {columns} FROM (
+                SELECT *, MIN(elapsed_time) OVER (ORDER BY start_date, effort_id
+                    ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS previous_best
+                FROM segment_efforts WHERE segment_id = ?
+            ) WHERE previous_best IS NULL OR elapsed_time < previous_best ORDER BY start_date
+        """, (segment_id,))
+
+    def is_personal_record(self, effort_id):
+        """Returns whether an effort was faster than every earlier effort on its segment."""
+        with self.lock:
+            return self.conn.execute("""
+                SELECT NOT EXISTS (
+                    SELECT 1 FROM segment_efforts AS earlier
+                    WHERE earlier.segment_id = e.segment_id AND earlier.elapsed_time <= e.elapsed_time
+                    AND (earlier.start_date < e.start_date OR earlier.start_date = e.start_date AND earlier.effort_id < e.effort_id)
+                ) FROM segment_efforts AS e WHERE e.effort_id = ?
+            """, (effort_id,)).fetchone() == (1,)
+
+    def trend(self, segment_id, period="month"):
+        """Returns per period: attempts, best, average elapsed time and average heart rate/power on a segment.
+
+        Args:
+            period (str): "day", "week" (ISO), "month" or "year". Defaults to "month".
+        """
+        with self.lock:
+            rows = self.conn.execute(f"""
+                SELECT {period_sql(period, 'start_date')} AS period, COUNT(*), MIN(elapsed_time), AVG(elapsed_time),
+                    AVG(average_heartrate), AVG(average_watts)
+                FROM segment_efforts WHERE segment_id = ? GROUP BY period ORDER BY period
+            """, (segment_id,)).fetchall()
+        keys = ("period", "attempts", "best_elapsed_time", "average_elapsed_time", "average_heartrate", "average_watts")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def segments(self, order_by="attempts DESC", limit=None):
+        """Returns segment_stats joined with the segment summaries, e.g. the most attempted segments.
+
+        Args:
+            order_by (str): One of `segment_orderings`, optionally followed by "ASC" or "DESC". Defaults to "attempts DESC".
+            limit (int | None): Maximum number of segments to return.
+        """
+        column, *direction = order_by.split()
+        direction = [d.upper() for d in direction]
+        if column not in self.segment_orderings or direction not in ([], ["ASC"], ["DESC"]):
+            raise ValueError(f"order_by must be one of {sorted(self.segment_orderings)}, optionally followed by ASC or DESC")
+        order = " ".join([self.segment_orderings[column], *direction])
+        keys = ("segment_id", "name", "activity_type", "distance", "attempts", "best_effort_id", "best_elapsed_time",
+                "first_date", "last_date")
+        cmd = f"""
+            SELECT s.segment_id, g.name, g.activity_type, g.distance, s.attempts, s.best_effort_id, s.best_elapsed_time,
+                s.first_date, s.last_date
+            FROM segment_stats AS s LEFT JOIN segments AS g ON g.segment_id = s.segment_id ORDER BY {order}, s.segment_id"""
+        params = ()
+        if limit is not None:
+            cmd += " LIMIT ?"
+            params = (limit,)
+        with self.lock:
+            rows = self.conn.execute(cmd, params).fetchall()
+        return [dict(zip(keys, row)) for row in rows]
+
+    def segment(self, segment_id, detailed=True):
+        """Returns what is known about a segment, fetching the detailed segment with get_segment on first use if `detailed`."""
+        keys = ("segment_id", "name", "activity_type", "distance", "average_grade", "climb_category", "city", "country",
+                "detailed", "fetched_at")
+        with self.lock:
+            row = self.conn.execute(f"SELECT {', '.join(keys)} FROM segments WHERE segment_id = ?", (segment_id,)).fetchone()
+        segment = dict(zip(keys, row)) if row else {"segment_id": segment_id, "detailed": None}
+        if segment["detailed"] is None and detailed:
+            details = self.api.get_segment(segment_id)
+            with self.lock:
+                self.conn.execute("""
+                    INSERT INTO segments (segment_id, name, activity_type, distance, average_grade, climb_category, city,
+                        country, detailed, fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (segment_id) DO UPDATE SET detailed = excluded.detailed, fetched_at = excluded.fetched_at
+                """, (*self.segment_row(details), json.dumps(details), time.time()))
+                self.conn.commit()
+            segment.update(dict(zip(keys[1:8], self.segment_row(details)[1:])), detailed=json.dumps(details))
+        if isinstance(segment.get("detailed"), str):
+            segment["detailed"] = json.loads(segment["detailed"])
+        return segment
@@ -0,0 +1,278 @@
+import json
+import logging
+import secrets
+import threading
+import time
+
+import requests
+from socketwrench import serve, methods, JSONResponse, Request, Response
+
+from bare_strava_api import StravaAPIRoutes
+from request_scheduler import Priority
+
+
+logger = logging.getLogger(__name__)
+
+
+class StravaWebhook:
+    """Keeps the cache and all_activities up to date from Strava's push subscription events instead of polling.
+
+    * `serve(port)` answers Strava's subscription validation (GET) and events (POST) on /webhook.
+    * An activity "create" queues fetches of the detailed activity and its streams (at backfill priority),
+    then adds it to all_activities.
+    * An activity "update" refetches the detailed activity (bypassing the cache) and patches its summary in all_activities
+    and in the cached list_activities pages.
+    * An activity "delete" removes it from all_activities and every cached response about it, and marks it deleted in the
+    cached list pages.
+    * An athlete "update" with authorized=false (the athlete revoked our access) sets `deauthorized`.
+    * `add_hook(callback)` calls callback(event) for every event handled, e.g. to update rollups or kudos.
+
+    Events can be posted locally for testing, e.g.
+    `post_event("http://localhost:8080/webhook", synthetic_event("create", activity_id))`.
+    Listing all activities is then only needed as a rare fallback for events missed while the server was down,
+    see `serve(poll_every=...)`.
+    """
+    subscriptions_url = "https://www.strava.com/api/v3/push_subscriptions"
+
+    def __init__(self, api, verify_token=None, fetch_streams=True, priority=Priority.backfill):
+        """
+        Args:
+            api (BareStravaAPI): The API whose cache and all_activities are kept up to date. Needs a scheduler.
+            verify_token (str | None): Token Strava echoes back when validating the subscription. Defaults to a random one.
+            fetch_streams (bool): Whether to also fetch the streams of new activities. Defaults to True.
+            priority (int): Priority of the queued fetches. Defaults to Priority.backfill.
+        """
+        if api.scheduler is None:
+            raise ValueError("StravaWebhook requires the API to have a scheduler")
+        self.api = api
+        self.verify_token = verify_token or secrets.token_urlsafe(16)
+        self.fetch_streams = fetch_streams
+        self.priority = priority
+        self.hooks = []
+        self.deauthorized = False
+        self.last_event_at = None
+        self.cleanup_event = None
+
+    def add_hook(self, callback):
+        """Calls callback(event) after each event is handled."""
+        self.hooks.append(callback)
+
+    def validate(self, mode, challenge, verify_token):
+        """Answers Strava's subscription validation request, raises PermissionError if it isn't ours."""
+        if mode != "subscribe" or verify_token != self.verify_token:
+            raise PermissionError("Invalid webhook validation request")
+        return {"hub.challenge": challenge}
+
+    def handle_event(self, event: dict):
+        """Applies one push subscription event.
+
+        Args:
+            event (dict): {"object_type": "activity" | "athlete", "object_id": int, "aspect_type": "create" | "update" | "delete",
+                "updates": dict, "owner_id": int, "subscription_id": int, "event_time": int}
+
+        Returns:
+            concurrent.futures.Future | None: The queued fetch, if any.
+        """
+        self.last_event_at = time.time()
+        object_type = event.get("object_type")
+        aspect_type = event.get("aspect_type")
+        object_id = int(event["object_id"])
+        owner_id = event.get("owner_id")
+        athlete_id = getattr(self.api, "athlete_id", None)
+        if owner_id is not None and athlete_id is not None and owner_id != athlete_id:
+            logger.info(f"Ignoring {object_type} {aspect_type} event of athlete {owner_id}")
+            return None
+        logger.info(f"Webhook event: {object_type} {object_id} {aspect_type} {event.get('updates') or ''}")
+
+        future = None
+        if object_type == "activity":
+            if aspect_type == "create":
+                future = self.submit(self.fetch_activity, object_id)
+            elif aspect_type == "update":
+                # refetched rather than deleted first, so the previous copy is still there to diff (see ChangeFeed)
+                future = self.submit(self.fetch_activity, object_id, streams=False, max_age=0)
+            elif aspect_type == "delete":
+                self.delete_activity(object_id)
+        elif object_type == "athlete" and str(event.get("updates", {}).get("authorized")).lower() == "false":
+            logger.warning(f"Athlete {object_id} revoked access")
+            self.deauthorized = True
+        for hook in self.hooks:
+            hook(event)
+        return future
+
+    def submit(self, fn, *args, **kwargs):
+        future = self.api.scheduler.executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(_log_exception)
+        return future
+
+    def fetch_activity(self, activity_id, streams=True, max_age=None):
+        """Fetches a detailed activity (and its streams) and updates its summary, returns the detailed activity."""
+        with self.api.priority(self.priority):
+            activity = self.api.get_activity(activity_id, max_age=max_age)
+            if streams and self.fetch_streams:
+                self.api.get_activity_streams(activity_id)
+        self.update_summary(activity)
+        return activity
+
+    def update_summary(self, activity):
+        """Replaces the summary of an activity in all_activities and in the cached list pages it appears in."""
+        # fetches run on the scheduler's threads, the cache lock keeps them from interleaving with each other and
+        # with the owning thread replacing all_activities after a listing
+        with self.api.cache.lock:
+            patched = self.patch_list_pages(activity["id"], activity)
+            store = getattr(self.api, "all_activities", None)
+            if store is None:
+                return
+            store.remove(activity["id"])
+            for row, summary in patched:
+                store.add(summary, row=row)
+            if not patched:
+                store.add(activity, keep_raw=True)  # created since the last listing, the next listing will add its summary to the cache
+            self.api.activity_ids = list(store.keys())
+
+    def delete_activity(self, activity_id):
+        """Forgets everything about an activity which was deleted on Strava."""
+        self.invalidate_activity(activity_id)
+        with self.api.cache.lock:
+            self.patch_list_pages(activity_id, None)
+            store = getattr(self.api, "all_activities", None)
+            if store is not None and store.remove(activity_id):
+                self.api.activity_ids = list(store.keys())
+
+    def invalidate_activity(self, activity_id, related=True):
+        """Deletes the cached detailed activity and, if `related`, its cached streams, kudos, comments and laps."""
+        url = self.api.base_url + StravaAPIRoutes.detailed_activity.format(id=int(activity_id))
+        self.api.cache.delete(url=url, method="GET")
+        if related:
+            self.api.cache.delete(url=("LIKE", f"{url}/%"), method="GET")
+
+    def patch_list_pages(self, activity_id, activity):
+        """Rewrites the cached list_activities pages containing an activity.
+
+        Pages keep their length, so cached pagination still sees a full page where Strava returned one:
+        a deleted activity is replaced by a tombstone {"id": activity_id, "deleted": True}, which ActivityStore skips.
+
+        Args:
+            activity_id (int): The activity.
+            activity (dict | None): The new (e.g. detailed) activity, only the fields the summary had are taken from it.
+                None marks the activity deleted.
+
+        Returns:
+            list[tuple[int, dict]]: [(requests row id, patched summary)] for each page the activity was in.
+        """
+        cache = self.api.cache
+        # only the bodies of the list route (found through the route index) are searched, inside SQLite
+        rows = cache.query(StravaAPIRoutes.list_activities, columns=["id", "response_json"], contains=("$", "$.id", activity_id),
+                           latest=False, url=self.api.base_url + StravaAPIRoutes.list_activities)
+        patched = []
+        for row, response_json in rows:
+            page = cache.codec.loads(response_json)
+            for i, summary in enumerate(page):
+                if summary.get("id") != activity_id:
+                    continue
+                if activity is None:
+                    page[i] = {"id": activity_id, "deleted": True}
+                else:
+                    page[i] = {k: activity.get(k, v) for k, v in summary.items()}
+                    patched.append((row, page[i]))
+                cache.update_row(row, response_json=cache.codec.dumps(page))
+                break
+        return patched
+
+    def serve(self, port=8080, poll_every=None):
+        """Serves the webhook at http://localhost:<port>/webhook from a background thread until `stop` is called.
+
+        Args:
+            port (int): Defaults to 8080.
+            poll_every (float | None): Also list new activities every this many seconds, as a fallback for missed events.
+                Defaults to None (never).
+        """
+        self.cleanup_event = threading.Event()
+        thread = threading.Thread(target=serve, args=(WebhookWebServer(self),),
+                                  kwargs={"port": port, "cleanup_event": self.cleanup_event}, daemon=True)
+        thread.start()
+        if poll_every:
+            threading.Thread(target=self._poll_loop, args=(poll_every,), daemon=True).start()
+        return thread
+
+    def stop(self):
+        if self.cleanup_event is not None:
+            self.cleanup_event.set()
+
+    def _poll_loop(self, poll_every):
+        while not self.cleanup_event.wait(poll_every):
+            try:
+                with self.api.priority(Priority.sync):
+                    self.api.list_all_activities()
+            except Exception as e:
+                logger.error(f"Fallback listing of activities failed: {e}")
+
+    def create_subscription(self, callback_url):
+        """Subscribes to events, Strava validates `callback_url` (so `serve` must be reachable there) before answering.
+
+        Returns:
+            dict: {"id": subscription id}
+        """
+        r = requests.post(self.subscriptions_url, data={
+            "client_id": self.api.client_id,
+            "client_secret": self.api.client_secret,
+            "callback_url": callback_url,
+            "verify_token": self.verify_token,
+        })
+        if r.status_code not in (200, 201):
+            raise ValueError(f"Error {r.status_code}: {r.text}")
+        return r.json()
+
+    def list_subscriptions(self):
+        """Returns the subscriptions of the app (there can only be one)."""
+        r = requests.get(self.subscriptions_url, params={"client_id": self.api.client_id, "client_secret": self.api.client_secret})
+        if r.status_code != 200:
+            raise ValueError(f"Error {r.status_code}: {r.text}")
+        return r.json()
+
+    def delete_subscription(self, subscription_id):
+        r = requests.delete(f"{self.subscriptions_url}/{subscription_id}",
+                            params={"client_id": self.api.client_id, "client_secret": self.api.client_secret})
+        if r.status_code != 204:
+            raise ValueError(f"Error {r.status_code}: {r.text}")
+
+
+def _log_exception(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Webhook fetch failed: {future.exception()}")
+
+
+class WebhookWebServer:
+    def __init__(self, webhook):
+        self._webhook = webhook
+
+    @methods("GET", "POST")
+    def webhook(self, request: Request, **kwargs):
+        if request.method == "GET":
+            query = request.path.query_args()
+            try:
+                return JSONResponse(self._webhook.validate(query.get("hub.mode"), query.get("hub.challenge"),
+                                                           query.get("hub.verify_token")))
+            except PermissionError:
+                return Response(b"Forbidden", status_code=403)
+        # Strava wants a 200 within 2 seconds, anything slow was queued by handle_event
+        self._webhook.handle_event(json.loads(request.body))
+        return JSONResponse({})
+
+
+def synthetic_event(aspect_type, object_id, object_type="activity", owner_id=None, updates=None, subscription_id=0):
+    """Builds an event like the ones Strava posts, for testing."""
+    return {
+        "aspect_type": aspect_type,
+        "event_time": int(time.time()),
+        "object_id": object_id,
+        "object_type": object_type,
+        "owner_id": owner_id,
+        "subscription_id": subscription_id,
+        "updates": updates or {},
+    }
+
+
+def post_event(url, event):
+    """Posts an event to a webhook, e.g. post_event("http://localhost:8080/webhook", synthetic_event("delete", 123))."""
+    return requests.post(url, json=event)
@@ -0,0 +1,258 @@
+import heapq
+import logging
+import math
+import threading
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from bare_strava_api import StravaAPIRoutes
+
+
+logger = logging.getLogger(__name__)
+
+
+def visvalingam_areas(lat, lng):
+    """Returns the effective area of each point of a line (Visvalingam-Whyatt), the endpoints get inf.
+
+    Keeping the k points with the largest effective areas gives the Visvalingam simplification of the line to k points.
+    Longitudes are scaled by cos(latitude), so areas are comparable in every direction.
+    Only the initial areas are computed with numpy: each removal changes the areas of the removed point's neighbours,
+    which decides the next removal, so the heap loop stays sequential (about 7 µs per point).
+    """
+    n = len(lat)
+    areas = np.full(n, np.inf)
+    if n < 3:
+        return areas
+    x = (lng * math.cos(math.radians(float(np.nanmean(lat))))).tolist()
+    y = lat.tolist()
+
+    def area(i, j, k):
+        return abs((x[j] - x[i]) * (y[k] - y[i]) - (x[k] - x[i]) * (y[j] - y[i])) / 2
+
+    xs, ys = np.asarray(x), np.asarray(y)
+    initial = np.abs((xs[1:-1] - xs[:-2]) * (ys[2:] - ys[:-2]) - (xs[2:] - xs[:-2]) * (ys[1:-1] - ys[:-2])) / 2
+    current = [math.inf, *initial.tolist(), math.inf]  # area of the triangle each remaining point forms with its neighbours
+    prev = list(range(-1, n - 1))
+    next_ = list(range(1, n + 1))
+    heap = [(a, i) for i, a in enumerate(current[1:-1], 1)]
+    heapq.heapify(heap)
+    largest = 0.0
+    while heap:
+        a, i = heapq.heappop(heap)
+        if a != current[i]:
+            continue  # stale entry of a point which was removed or whose neighbours changed
+        # a point's effective area is never smaller than that of a point removed before it
+        largest = max(largest, a)
+        areas[i] = largest
+        current[i] = None
+        p, q = prev[i], next_[i]
+        next_[p], prev[q] = q, p
+        for j in (p, q):
+            if 0 < j < n - 1:
+                current[j] = area(prev[j], j, next_[j])
+                heapq.heappush(heap, (current[j], j))
+    return areas
+
+
+class StreamPyramid:
+    """Precomputed multi-resolution versions of activity streams, so charts don't need the full streams.
+
+    * Level 0 holds every point, each level above has `factor` times fewer buckets, up to a single bucket.
+    * Numeric streams (altitude, heartrate, watts, ...) keep the min, max and mean of each bucket, so a chart drawn
+    from the buckets still shows every spike.
+    * latlng is simplified with Visvalingam-Whyatt, each level keeps the points which matter most to the shape of the route.
+    * `chart(activity_id, stream, start, end, max_points)` answers from the finest level with at most max_points buckets
+    in the time range (so at least max_points / factor of them), no matter how long the activity is.
+    * Levels are stored as float64 blobs in the `stream_lod` table (of the cache database by default) and the most
+    recently charted ones are kept in memory. `attach(api)` builds them whenever streams are fetched,
+    `build_cached()` builds them for streams which were cached before.
+
+    Requires numpy.
+    """
+    factor = 4
+
+    def __init__(self, api=None, conn=None, max_cached=256):
+        """
+        Args:
+            api (BareStravaAPI | None): Used to fetch streams which have no pyramid yet, and by `build_cached`.
+            conn (sqlite3.Connection): Where to store the levels. Defaults to the connection of the API cache.
+            max_cached (int): Number of (activity, stream) pyramids kept in memory. Defaults to 256.
+        """
+        if np is None:
+            raise ImportError("StreamPyramid requires numpy (pip install numpy)")
+        self.api = api
+        self.conn = api.cache.conn if conn is None else conn
+        self.lock = api.cache.lock if conn is None else threading.RLock()
+        self.max_cached = max_cached
+        self._cached = OrderedDict()  # {(activity_id, stream): [(bucket_size, array)]}
+        self.create()
+
+    def create(self):
+        with self.lock:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS stream_lod (
+                    activity_id INTEGER,
+                    stream TEXT,
+                    level INTEGER,
+                    bucket_size INTEGER,
+                    n INTEGER,
+                    data BLOB,
+                    PRIMARY KEY (activity_id, stream, level)
+                )""")
+            self.conn.commit()
+
+    def attach(self, api=None):
+        """Builds the pyramids of every activity's streams fetched by `api` (defaults to self.api) from now on."""
+        api = api or self.api
+        api.add_response_hook(StravaAPIRoutes.activity_streams, self._on_streams)
+        return self
+
+    def _on_streams(self, params, streams):
+        self.build(params["id"], streams)
+
+    @staticmethod
+    def stream_data(streams):
+        """Returns {stream type: data} of a streams response, with or without key_by_type."""
+        if isinstance(streams, dict):
+            return {k: v["data"] if isinstance(v, dict) else v for k, v in streams.items()}
+        return {s["type"]: s["data"] for s in streams}
+
+    def build(self, activity_id, streams):
+        """Builds (or rebuilds) the pyramids of the streams of an activity.
+
+        Args:
+            activity_id (int): The activity.
+            streams (dict | list): A get_activity_streams response. Points are placed by the time stream if there is one.
+        """
+        data = self.stream_data(streams)
+        n = max((len(v) for v in data.values()), default=0)
+        t = np.asarray(data["time"], dtype=float) if "time" in data else np.arange(n, dtype=float)
+        rows = []
+        for name, values in data.items():
+            if name == "time" or len(values) != len(t) or not len(t):
+                continue
+            if name == "latlng":
+                levels = self.latlng_levels(t, np.asarray(values, dtype=float).reshape(-1, 2))
+            else:
+                levels = self.numeric_levels(t, np.asarray(values, dtype=float))
+            rows.extend((activity_id, name, level, bucket_size, a.shape[1], a.tobytes())
+                        for level, (bucket_size, a) in enumerate(levels))
+        names = sorted({row[1] for row in rows})
+        with self.lock:
+            self.conn.execute(f"DELETE FROM stream_lod WHERE activity_id = ? AND stream IN ({', '.join('?' * len(names))})",
+                              (activity_id, *names))
+            self.conn.executemany("INSERT INTO stream_lod VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.conn.commit()
+            for name in names:
+                self._cached.pop((activity_id, name), None)
+
+    def numeric_levels(self, t, values):
+        """Returns [(bucket size, array of rows (bucket start time, min, max, mean))], finest level first."""
+        levels = [(1, np.vstack([t, values, values, values]))]
+        missing = np.isnan(values)
+        filled = np.where(missing, 0.0, values)
+        present = (~missing).astype(float)
+        bucket_size = self.factor
+        while levels[-1][1].shape[1] > 1:
+            starts = np.arange(0, len(values), bucket_size)
+            counts = np.add.reduceat(present, starts)
+            means = np.divide(np.add.reduceat(filled, starts), counts, out=np.full(len(starts), np.nan), where=counts > 0)
+            # fmin/fmax skip NaNs (buckets without any value stay NaN)
+            levels.append((bucket_size, np.vstack([t[starts], np.fmin.reduceat(values, starts),
+                                                   np.fmax.reduceat(values, starts), means])))
+            bucket_size *= self.factor
+        return levels
+
+    def latlng_levels(self, t, latlng):
+        """Returns [(bucket size, array of rows (time, lat, lng, effective area))], finest level first."""
+        keep = ~np.isnan(latlng).any(axis=1)
+        t, latlng = t[keep], latlng[keep]
+        areas = visvalingam_areas(latlng[:, 0], latlng[:, 1])
+        by_importance = np.argsort(-areas, kind="stable")
+        everything = np.vstack([t, latlng[:, 0], latlng[:, 1], areas])
+        levels = [(1, everything)]
+        bucket_size = self.factor
+        while levels[-1][1].shape[1] > 2:
+            n = max(-(-len(t) // bucket_size), 2)
+            levels.append((bucket_size, everything[:, np.sort(by_importance[:n])]))
+            bucket_size *= self.factor
+        return levels
+
+    def levels(self, activity_id, stream):
+        """Returns the levels [(bucket size, array)] of a stream, finest first, fetching the streams if needed."""
+        key = (activity_id, stream)
+        with self.lock:
+            levels = self._cached.get(key)
+            if levels is not None:
+                self._cached.move_to_end(key)
+                return levels
+        rows = self._rows(key)
+        if not rows and self.api is not None:
+            data = self.stream_data(self.api.get_activity_streams(activity_id))
+            # if the pyramid is attached and the streams came from the network, the response hook built them already,
+            # otherwise only the streams which have no pyramid yet are built
+            with self.lock:
+                built = {r[0] for r in self.conn.execute("SELECT DISTINCT stream FROM stream_lod WHERE activity_id = ?",
+                                                         (activity_id,))}
+            missing = {name: values for name, values in data.items() if name == "time" or name not in built}
+            if missing.keys() - {"time"}:
+                self.build(activity_id, missing)
+            rows = self._rows(key)
+        if not rows:
+            raise KeyError(f"Activity {activity_id} has no {stream} stream")
+        levels = [(bucket_size, np.frombuffer(data).reshape(4, n)) for bucket_size, n, data in rows]
+        with self.lock:
+            self._cached[key] = levels
+            while len(self._cached) > self.max_cached:
+                self._cached.popitem(last=False)
+        return levels
+
+    def _rows(self, key):
+        with self.lock:
+            return self.conn.execute("SELECT bucket_size, n, data FROM stream_lod WHERE activity_id = ? AND stream = ? "
+                                     "ORDER BY level", key).fetchall()
+
+    def chart(self, activity_id, stream, start=None, end=None, max_points=600):
+        """Returns at most max_points buckets of a stream between two times (seconds since the start of the activity).
+
+        Returns:
+            dict: {"time": bucket start times, "min", "max", "mean": arrays} for numeric streams,
+            {"time": times, "latlng": (n, 2) array} for latlng, plus the "level" and "bucket_size" used.
+        """
+        levels = self.levels(activity_id, stream)
+        for level, (bucket_size, a) in enumerate(levels):
+            t = a[0]
+            # the bucket containing `start` counts, its later points are in range
+            lo = 0 if start is None else max(int(np.searchsorted(t, start, side="right")) - 1, 0)
+            hi = len(t) if end is None else int(np.searchsorted(t, end, side="right"))
+            if hi - lo <= max_points:
+                break
+        a = a[:, lo:hi]
+        result = {"level": level, "bucket_size": bucket_size, "time": a[0]}
+        if stream == "latlng":
+            result["latlng"] = a[1:3].T
+        else:
+            result.update(min=a[1], max=a[2], mean=a[3])
+        return result
+
+    def build_cached(self, rebuild=False):
+        """Builds the pyramids of every cached streams response (only of activities without pyramids unless `rebuild`)."""
+        url = self.api.base_url + StravaAPIRoutes.activity_streams
+        prefix, suffix = url.split("{id}")
+        with self.lock:
+            built = {r[0] for r in self.conn.execute("SELECT DISTINCT activity_id FROM stream_lod")}
+        rows = self.api.cache.select(columns=["url", "response_json"], url=("LIKE", f"{prefix}%{suffix}"),
+                                     method="GET", response_code=200, order_by="called_at")
+        n = 0
+        for row_url, body in rows:  # oldest first, so the latest response of an activity wins
+            activity_id = row_url[len(prefix):-len(suffix)]
+            if not activity_id.isdigit() or (int(activity_id) in built and not rebuild):
+                continue
+            self.build(int(activity_id), self.api.cache.codec.loads(body))
+            n += 1
+        logger.info(f"Built stream pyramids of {n} cached responses")
+        return n
@@ -0,0 +1,244 @@
+import heapq
+import logging
+import shutil
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+from urllib.parse import urlencode
+
+import requests
+import yaml
+
+from bare_strava_api import BareStravaAPI
+from request_scheduler import RequestScheduler
+from strava_oauth import Scopes
+
+
+logger = logging.getLogger(__name__)
+
+
+class TenantAPI(BareStravaAPI):
+    """BareStravaAPI for one of the athletes served by a TenantManager.
+
+    * Its tokens are in `<root>/<athlete_id>/secrets.yaml` (the app's client id and secret stay in the app's secrets.yaml)
+    and are refreshed by the manager's refresh thread instead of a thread of its own.
+    * Its responses are cached in its own shard `<root>/<athlete_id>/api_cache.db`, with its own connection and lock,
+    so lookups never scan or wait for another athlete's data.
+    * Its requests go through the manager's scheduler, which takes turns between athletes within each priority class.
+    """
+
+    def __init__(self, manager, athlete_id,
+                 get_athlete=False,
+                 list_all_activities=False,
+                 get_athlete_zones=False,
+                 get_athlete_stats=False,
+                 offline=False,
+                 as_of=None
+                 ):
+        """
+        Args:
+            manager (TenantManager): The manager holding the app credentials and the shared scheduler.
+            athlete_id (int): The athlete.
+            get_athlete, list_all_activities, get_athlete_zones, get_athlete_stats, offline, as_of: See BareStravaAPI.
+                Nothing is requested by default, athletes are opened on demand.
+        """
+        self.manager = manager
+        self.athlete_id = athlete_id
+        self.athlete_info = None
+        tenant_dir = manager.tenant_dir(athlete_id)
+        self.secrets_yaml = tenant_dir / "secrets.yaml"
+        self.cache_db = str(tenant_dir / "api_cache.db")
+        super().__init__(get_athlete, list_all_activities, get_athlete_zones, get_athlete_stats, offline=offline,
+                         as_of=as_of, scheduler=manager.scheduler, tenant=athlete_id)
+
+    def authorize(self):
+        """Loads the athlete's tokens, refreshing them now if they are about to expire (the manager refreshes them later)."""
+        with self.secrets_yaml.open("r") as f:
+            self.secrets = yaml.safe_load(f)
+        self.client_id = self.manager.client_id
+        self.client_secret = self.manager.client_secret
+        self.expires_at = self.secrets.get("expires_at", time.time())
+        if self.expires_in < self.manager.refresh_margin:
+            self.refresh()
+        else:
+            self.set_access_token(self.access_token)
+
+    def close(self):
+        self.cache.conn.close()
+
+
+class TenantManager:
+    """Serves many athletes under one Strava app.
+
+        tenants/
+            <athlete_id>/
+                secrets.yaml  # the athlete's access and refresh tokens
+                api_cache.db  # the athlete's cache shard
+
+    * `authorize_url(redirect_uri)` is the link to send an athlete to, `add_tenant(code)` exchanges the code Strava
+    redirects back with for the athlete's tokens.
+    * `manager[athlete_id]` opens a TenantAPI on first use and keeps it open, so the cost of an athlete doesn't depend
+    on how many other athletes there are.
+    * One thread refreshes the tokens of all open athletes, each shortly before it expires (see `start`).
+    * All athletes share one RequestScheduler with the app's rate limits, which takes turns between athletes.
+    """
+    rate_limits = BareStravaAPI.rate_limits
+
+    def __init__(self, root=Path("tenants"), app_secrets_yaml=Path("secrets.yaml"), scheduler=None, refresh_margin=10 * 60):
+        """
+        Args:
+            root (Path): Directory holding a directory per athlete. Defaults to "tenants".
+            app_secrets_yaml (Path): YAML file with the app's client_id and client_secret. Defaults to "secrets.yaml".
+            scheduler (RequestScheduler | None): Defaults to a new RequestScheduler with the app's rate limits.
+            refresh_margin (float): Refresh tokens this many seconds before they expire. Defaults to 10 minutes.
+        """
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        with Path(app_secrets_yaml).open("r") as f:
+            app_secrets = yaml.safe_load(f)
+        self.client_id = app_secrets["client_id"]
+        self.client_secret = app_secrets["client_secret"]
+        self.scheduler = scheduler or RequestScheduler(self.rate_limits)
+        self.refresh_margin = refresh_margin
+        self.apis = {}  # {athlete_id: TenantAPI} of the open athletes
+        self._opening = {}  # {athlete_id: Future of its TenantAPI} of the athletes being opened
+        self.condition = threading.Condition()
+        self._expiry = []  # heap of (expires_at, athlete_id) of the open athletes
+        self.cleanup_event = threading.Event()
+        self.refresh_thread = None
+
+    def tenant_dir(self, athlete_id):
+        return self.root / str(int(athlete_id))
+
+    def athlete_ids(self):
+        """Returns the ids of all athletes which authorized the app."""
+        return sorted(int(p.name) for p in self.root.iterdir() if p.name.isdigit() and (p / "secrets.yaml").exists())
+
+    def __contains__(self, athlete_id):
+        return (self.tenant_dir(athlete_id) / "secrets.yaml").exists()
+
+    def __getitem__(self, athlete_id):
+        return self.get(athlete_id)
+
+    def get(self, athlete_id, **kwargs):
+        """Returns the TenantAPI of an athlete, opening it on first use (kwargs are passed to TenantAPI)."""
+        api = self.apis.get(athlete_id)
+        if api is not None:
+            return api
+        if athlete_id not in self:
+            raise KeyError(f"Athlete {athlete_id} has not authorized the app")
+        with self.condition:
+            api = self.apis.get(athlete_id)
+            if api is not None:
+                return api
+            opening = self._opening.get(athlete_id)
+            if opening is None:
+                opening = self._opening[athlete_id] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:  # another thread is opening this athlete
+            return opening.result()
+        # opening refreshes the token and makes the startup requests, so it happens outside of the lock
+        try:
+            api = TenantAPI(self, athlete_id, **kwargs)
+        except BaseException as e:
+            with self.condition:
+                del self._opening[athlete_id]
+            opening.set_exception(e)
+            raise
+        with self.condition:
+            del self._opening[athlete_id]
+            self.apis[athlete_id] = api
+            if not api.offline:
+                heapq.heappush(self._expiry, (api.expires_at, athlete_id))
+                self.condition.notify_all()
+        opening.set_result(api)
+        return api
+
+    def authorize_url(self, redirect_uri, scopes=Scopes.all, state=""):
+        """Returns the link where an athlete authorizes the app, Strava then redirects to `redirect_uri` with a code."""
+        return "https://www.strava.com/oauth/authorize?" + urlencode({
+            "client_id": self.client_id,
+            "response_type": "code",
+            "redirect_uri": redirect_uri,
+            "approval_prompt": "auto",
+            "scope": ",".join(scopes),
+            "state": state,
+        })
+
+    def add_tenant(self, code, scope=""):
+        """Exchanges the code an athlete authorized the app with for their tokens, returns their TenantAPI."""
+        r = requests.post("https://www.strava.com/oauth/token", {
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "code": code,
+            "grant_type": "authorization_code"
+        }).json()
+        athlete_id = r["athlete"]["id"]
+        tenant_dir = self.tenant_dir(athlete_id)
+        tenant_dir.mkdir(parents=True, exist_ok=True)
+        with (tenant_dir / "secrets.yaml").open("w") as f:
+            yaml.dump({
+                "access_token": r["access_token"],
+                "refresh_token": r["refresh_token"],
+                "expires_at": r["expires_at"],
+                "scope": scope
+            }, f)
+        self.close(athlete_id)  # an athlete authorizing again gets new tokens
+        return self.get(athlete_id)
+
+    def remove_tenant(self, athlete_id, delete_data=False):
+        """Forgets an athlete (e.g. after they revoked access), `delete_data` also deletes their tokens and cache shard."""
+        self.close(athlete_id)
+        if delete_data:
+            shutil.rmtree(self.tenant_dir(athlete_id), ignore_errors=True)
+        else:
+            (self.tenant_dir(athlete_id) / "secrets.yaml").unlink(missing_ok=True)
+
+    def close(self, athlete_id):
+        with self.condition:
+            api = self.apis.pop(athlete_id, None)
+        if api is not None:
+            api.close()
+
+    def start(self):
+        """Starts the thread refreshing the tokens of the open athletes."""
+        if self.refresh_thread is None:
+            self.refresh_thread = threading.Thread(target=self._refresh_loop, daemon=True)
+            self.refresh_thread.start()
+        return self
+
+    def stop(self):
+        self.cleanup_event.set()
+        with self.condition:
+            self.condition.notify_all()
+        for athlete_id in list(self.apis):
+            self.close(athlete_id)
+
+    def _refresh_loop(self):
+        while not self.cleanup_event.is_set():
+            with self.condition:
+                if not self._expiry:
+                    self.condition.wait()
+                    continue
+                expires_at, athlete_id = self._expiry[0]
+                wait = expires_at - self.refresh_margin - time.time()
+                if wait > 0:
+                    self.condition.wait(timeout=wait)
+                    continue
+                heapq.heappop(self._expiry)
+                api = self.apis.get(athlete_id)
+            if api is None:
+                continue  # closed since
+            if api.expires_in < self.refresh_margin:  # otherwise it was refreshed since
+                try:
+                    api.refresh()
+                    logger.info(f"Refreshed the token of athlete {athlete_id}, expires in {api.expires_in:.0f} seconds")
+                except Exception as e:
+                    logger.error(f"Failed to refresh the token of athlete {athlete_id}: {e}")
+                    api.expires_at = time.time() + self.refresh_margin + 60  # retry in a minute
+            with self.condition:
+                if self.apis.get(athlete_id) is api:
+                    heapq.heappush(self._expiry, (api.expires_at, athlete_id))
@@ -0,0 +1,32 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bare_strava_api import BareStravaAPI  # noqa: E402
+from mock_strava import MockStrava  # noqa: E402
+
+
+@pytest.fixture
+def mock():
+    with MockStrava(n_activities=450) as mock:
+        yield mock
+
+
+@pytest.fixture
+def make_api(mock, tmp_path):
+    """Returns a function constructing clients (BareStravaAPI unless `cls` is given) of the mock, which share one cache."""
+    def make_api(cls=BareStravaAPI, **kwargs):
+        client_cls = type(f"Mock{cls.__name__}", (cls,), {
+            "base_url": mock.base_url,
+            "cache_db": str(tmp_path / "cache.db"),
+            "rate_limits": {10 ** 9: 1},
+            "authorize": lambda self: self.set_access_token("mock"),
+        })
+        kwargs.setdefault("list_all_activities", False)
+        kwargs.setdefault("get_athlete_zones", False)
+        kwargs.setdefault("get_athlete_stats", False)
+        return client_cls(**kwargs)
+    return make_api
@@ -0,0 +1,66 @@
+import datetime
+import random
+
+from activity_rollups import ActivityRollups, FenwickTree
+from kudokid import KudoKidAPI
+
+
+def activity(activity_id, start_date, sport_type="Run", distance=1000.0):
+    return {"id": activity_id, "sport_type": sport_type, "start_date": start_date, "start_date_local": start_date,
+            "distance": distance, "moving_time": 300, "elapsed_time": 320, "total_elevation_gain": 5.0}
+
+
+def test_fenwick_grow_keeps_sums():
+    r = random.Random(0)
+    tree = FenwickTree(size=3)
+    values = [0.0] * 1000
+    for _ in range(2000):
+        i = r.randrange(1000)  # slots past the end grow the tree
+        delta = r.uniform(-5, 5)
+        values[i] += delta
+        tree.add(i, delta)
+    assert len(tree) >= 1000
+    for lo, hi in ((0, 999), (0, 0), (17, 503), (999, 999)):
+        assert abs(tree.range_sum(lo, hi) - sum(values[lo:hi + 1])) < 1e-6
+
+
+def test_iso_week_buckets():
+    rollups = ActivityRollups({a["id"]: a for a in (
+        activity(1, "2021-01-03T08:00:00Z"),  # Sunday, ISO week 53 of 2020
+        activity(2, "2021-01-04T08:00:00Z"),  # Monday, ISO week 1 of 2021
+        activity(3, "2024-12-30T08:00:00Z"),  # Monday, ISO week 1 of 2025
+    )})
+    assert [(key, totals["count"]) for key, totals in rollups.period_totals("week")] == [
+        ("2020-W53", 1), ("2021-W01", 1), ("2025-W01", 1)]
+    assert rollups.totals("2021-01-01", "2021-01-31")["count"] == 2
+
+
+def test_sync_with_plain_dict():
+    activities = {i: activity(i, f"2024-05-{i:02d}T08:00:00Z") for i in range(1, 11)}
+    rollups = ActivityRollups(activities)
+    assert rollups.sync(activities) == 0
+    activities[11] = activity(11, "2024-05-11T08:00:00Z")
+    assert rollups.sync(activities) == 1
+    assert rollups.totals()["count"] == 11
+
+
+def test_local_stats_sync_incrementally(mock, make_api):
+    api = make_api(KudoKidAPI, list_all_activities=True)
+    store = api.all_activities
+    stats = api.get_local_athlete_stats(reconcile_every=None)
+    rollups = api.rollups
+    assert rollups.totals()["count"] == mock.n_activities
+
+    # ten new activities on Strava, the next listing only adds them to the same store
+    mock.n_activities, mock._epochs = mock.n_activities + 10, None
+    api.list_all_activities()
+    assert api.all_activities is store
+    applied = []
+    add = rollups.add
+    rollups.add = lambda a: applied.append(a["id"]) or add(a)
+    stats = api.get_local_athlete_stats(reconcile_every=None)
+    assert sorted(applied) == [mock.activity_id(i) for i in range(mock.n_activities - 10, mock.n_activities)]
+    assert rollups.totals()["count"] == mock.n_activities
+    assert sum(stats[f"all_{group}_totals"]["count"] for group in ("run", "ride", "swim")) == sum(
+        mock.stats()[f"all_{group}_totals"]["count"] for group in ("run", "ride", "swim"))
+    assert datetime.date.today() >= rollups.parse_date(rollups.newest)
@@ -0,0 +1,53 @@
+from activity_store import ActivityStore, ActivitySummary
+from bare_strava_api import StravaAPIRoutes
+
+
+def test_add_page_remove_and_changes_since(mock):
+    store = ActivityStore()
+    store.add_page([mock.activity(i) for i in range(3)] + [{"id": mock.activity_id(3), "deleted": True}], row=7)
+    assert list(store) == [mock.activity_id(i) for i in range(3)] and store.last_row == 7
+    seq = store.seq
+    assert store.changes_since(0) == ([mock.activity_id(i) for i in range(3)], seq)
+
+    store.add_page([mock.activity(i) for i in range(3)], row=8)  # listed again, nothing changed
+    assert store.changes_since(seq) == ([], seq)
+    store.add(dict(mock.activity(0), kudos_count=99))
+    assert store.remove(mock.activity_id(1)) and not store.remove(mock.activity_id(1))
+    assert store.changes_since(seq) == ([mock.activity_id(0), mock.activity_id(1)], seq + 2)
+    assert store[mock.activity_id(0)]["kudos_count"] == 99 and mock.activity_id(1) not in store
+
+
+def test_raw_is_read_from_cached_pages(mock, make_api):
+    api = make_api()
+    api.list_activity_pages(max_age=0)
+    url = api.base_url + StravaAPIRoutes.list_activities
+    store = ActivityStore(api.cache, url)
+    activity = mock.activity(5)
+    store.add(activity)
+    # the row is found by searching the cached pages, which indexes the other activities on them too
+    assert store._locate(activity["id"]) is not None
+    assert mock.activity_id(6) in store._rows and mock.activity_id(449) not in store._rows
+    assert store[activity["id"]]["map"] == activity["map"] and store[activity["id"]]._raw is None
+    assert store._locate(10 ** 9) is None
+
+
+def test_raw_without_cache_row(mock):
+    activity = mock.activity(0)
+    assert ActivitySummary(activity)["map"] == activity["map"]
+    store = ActivityStore()
+    store.add(activity, keep_raw=True)
+    assert store[activity["id"]]["athlete"] == activity["athlete"]
+    assert store[activity["id"]].to_dict().items() >= activity.items()
+    assert "athlete" in store[activity["id"]]
+
+
+def test_summaries_are_hashable(mock):
+    a, b = ActivitySummary(mock.activity(0)), ActivitySummary(mock.activity(0))
+    assert a == b and len({a, b, ActivitySummary(mock.activity(1))}) == 2
+
+
+def test_uncached_listing_keeps_raw(mock, make_api):
+    api = make_api()
+    activities = api.list_all_activities(max_age=0, cache=False)
+    activity_id = mock.activity_id(10)
+    assert activities[activity_id]["map"] == mock.activity(10)["map"]
@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+from api_cache import APICache
+from bare_strava_api import StravaAPIRoutes
+
+base_url = "https://www.strava.com/api/v3"
+
+
+class Response:
+    headers = {"Content-Type": "application/json; charset=utf-8"}
+
+    def __init__(self, body, status_code=200):
+        self.content = json.dumps(body).encode()
+        self.status_code = status_code
+
+
+def test_string_conditions_are_bound(tmp_path):
+    cache = APICache(str(tmp_path / "cache.db"))
+    cache.cache_get(f"{base_url}/athlete", None, Response({"id": 1}), route="/athlete")
+    # strings which look like operators are compared for equality, never pasted into the SQL
+    assert cache.select(columns="url", url="IS NOT NULL") == []
+    assert cache.select(columns="url", url="> ''") == []
+    assert cache.select(columns="url", url=("LIKE", f"{base_url}/%")) == [f"{base_url}/athlete"]
+
+
+def test_backfill_routes_runs_once(tmp_path):
+    cache = APICache(str(tmp_path / "cache.db"))
+    cache.cache_get(f"{base_url}/activities/5", None, Response({"id": 5}))
+    assert cache.backfill_routes(base_url, StravaAPIRoutes.all) == 1
+    assert cache.select(columns="route") == ["/activities/{id}"]
+    cache.cache_get(f"{base_url}/activities/6", None, Response({"id": 6}))
+    assert cache.backfill_routes(base_url, StravaAPIRoutes.all) == 0
+    assert APICache(str(tmp_path / "cache.db")).backfill_routes(base_url, StravaAPIRoutes.all) == 0
+
+
+def test_query_latest_skips_requests_whose_newest_response_failed(tmp_path):
+    cache = APICache(str(tmp_path / "cache.db"))
+    route = StravaAPIRoutes.detailed_activity
+    for i in (1, 2):
+        cache.cache_get(f"{base_url}/activities/{i}", None, Response({"id": i}), route=route)
+    cache.cache_get(f"{base_url}/activities/1", None, Response({"message": "Record Not Found"}, 404), route=route)
+    cache.cache_get(f"{base_url}/activities/2", None, Response({"message": "Rate Limit Exceeded"}, 429), route=route)
+    assert cache.query(route) == [{"id": 2}]
+    assert sorted(body["id"] for body in cache.query(route, latest=False)) == [1, 2]
+
+
+def test_add_json_column_conflicts(tmp_path):
+    cache = APICache(str(tmp_path / "cache.db"))
+    route = StravaAPIRoutes.detailed_activity
+    cache.cache_get(f"{base_url}/activities/1", None, Response({"id": 1, "kudos_count": 30}), route=route)
+    cache.add_json_column("kudos_count", "$.kudos_count", route=route)
+    # adding the same column again (also from another connection) is a no-op
+    cache.add_json_column("kudos_count", "$.kudos_count", route=route)
+    APICache(str(tmp_path / "cache.db")).add_json_column("kudos_count", "$.kudos_count", route=route)
+    assert cache.query(route, columns="kudos_count") == [30]
+    for name, path, other_route in (("kudos_count", "$.comment_count", route), ("kudos_count", "$.kudos_count", None),
+                                    ("url", "$.url", route), ("route", "$.route", None)):
+        with pytest.raises(ValueError):
+            cache.add_json_column(name, path, route=other_route)
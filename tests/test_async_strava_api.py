@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from async_strava_api import AsyncBareStravaAPI  # noqa: E402
+from request_scheduler import RequestScheduler  # noqa: E402
+
+
+def make_api(mock, tmp_path, **kwargs):
+    cls = type("MockAsyncAPI", (AsyncBareStravaAPI,), {"base_url": mock.base_url, "cache_db": str(tmp_path / "cache.db")})
+    kwargs.setdefault("scheduler", RequestScheduler({10 ** 9: 1}))
+    return cls(**kwargs)
+
+
+def test_endpoints(mock, tmp_path):
+    async def main():
+        api = make_api(mock, tmp_path)
+        try:
+            athlete = await api.get_athlete()
+            activities = await api.list_all_activities()
+            detailed = await asyncio.gather(*(api.get_activity(i) for i in list(activities)[:20]))
+            kudos = await api.list_all_activity_kudos(next(iter(activities)))
+            return athlete, activities, detailed, kudos
+        finally:
+            await api.aclose()
+
+    athlete, activities, detailed, kudos = asyncio.run(main())
+    assert athlete["id"] == mock.athlete_id
+    assert len(activities) == mock.n_activities
+    assert all(d["id"] == i for d, i in zip(detailed, list(activities)[:20]))
+    assert isinstance(kudos, list)
+
+
+def test_route_export(mock, tmp_path):
+    async def main():
+        api = make_api(mock, tmp_path)
+        try:
+            return await api.export_route_gpx_bytes(42), await api.export_route_tcx_bytes(42)
+        finally:
+            await api.aclose()
+
+    gpx, tcx = asyncio.run(main())
+    assert gpx.startswith(b"<?xml") and b"<gpx><name>Route 42</name>" in gpx
+    assert b"<TrainingCenterDatabase>" in tcx
+    assert [path for path, query in mock.requests] == ["/api/v3/routes/42/export_gpx", "/api/v3/routes/42/export_tcx"]
+
+
+def test_sync_startup_is_blocked(mock, tmp_path):
+    api = make_api(mock, tmp_path)
+    with pytest.raises(TypeError):
+        api.startup()
+
+
+def test_acquire_async_does_not_poll():
+    scheduler = RequestScheduler({10 ** 9: 1})
+
+    async def main():
+        order = []
+
+        async def request(i):
+            await scheduler.acquire_async(priority=i % 2)
+            order.append(i)
+
+        scheduler.pause(0.5)
+        started = time.process_time()
+        await asyncio.gather(*(request(i) for i in range(500)))
+        return order, time.process_time() - started
+
+    order, cpu = asyncio.run(main())
+    assert sorted(order) == list(range(500))
+    assert order[:250] == list(range(0, 500, 2))  # by priority, then in arrival order
+    assert cpu < 0.4  # waiting out the pause costs (almost) no CPU
@@ -0,0 +1,37 @@
+def page_requests(mock, since=0):
+    return [path for path, query in mock.requests[since:] if path.endswith("/athlete/activities")]
+
+
+def test_full_listing_requests(mock, make_api):
+    api = make_api()
+    api.get_athlete_stats()
+    since = len(mock.requests)
+    activities = api.list_all_activities(max_age=0)
+    assert len(activities) == mock.n_activities
+    # 450 activities are 3 pages, the stats already fetched are reused for the estimate
+    assert len(mock.requests) - since == 3
+    assert len(page_requests(mock, since)) == 3
+
+
+def test_listing_without_stats_costs_no_stats_request(mock, make_api):
+    api = make_api()
+    since = len(mock.requests)
+    assert len(api.list_all_activities(max_age=0)) == mock.n_activities
+    assert len(page_requests(mock, since)) == len(mock.requests) - since <= 4
+
+
+def test_list_pages_from_scheduler_threads(mock, make_api):
+    api = make_api()
+    executor = api.scheduler.executor
+    # every worker waits on a listing, whose pages must not queue behind them
+    futures = [executor.submit(api.list_activity_pages, max_age=0, expected_pages=1)
+               for _ in range(api.scheduler.max_workers)]
+    for future in futures:
+        assert [len(page) for page in future.result(timeout=60)] == [200, 200, 50]
+
+
+def test_route_export(mock, make_api, tmp_path):
+    api = make_api()
+    assert b"<gpx>" in api.export_route_gpx_bytes(42)
+    api.export_route_tcx_file(42, filename=str(tmp_path / "route.tcx"))
+    assert b"<TrainingCenterDatabase>" in (tmp_path / "route.tcx").read_bytes()
@@ -0,0 +1,32 @@
+import sqlite3
+
+from kudos_sync import KudosSync, period_sql
+
+
+def test_period_sql_iso_weeks():
+    conn = sqlite3.connect(":memory:")
+    week = period_sql("week", "d")
+    # the first days of January can belong to the last ISO week of the previous year and vice versa
+    for date, expected in (("2021-01-03", "2020-W53"), ("2021-01-04", "2021-W01"), ("2024-12-30", "2025-W01"),
+                           ("2023-01-01", "2022-W52"), ("2024-06-15T10:00:00Z", "2024-W24")):
+        assert conn.execute(f"SELECT {week} FROM (SELECT ? AS d)", (date,)).fetchone()[0] == expected
+
+
+def test_sync_refetches_changed_activities(mock, make_api):
+    api = make_api()
+    activities = {mock.activity_id(i): mock.activity(i) for i in range(20)}
+    changed_id = next(i for i, a in activities.items() if a["kudos_count"] >= 2 and a["comment_count"])
+    kudos = KudosSync(api)
+    # the first sync sees two kudos less than Strava has now
+    stale = dict(activities)
+    stale[changed_id] = dict(activities[changed_id], kudos_count=activities[changed_id]["kudos_count"] - 2)
+    assert len(kudos.sync(stale)) == 20
+
+    since = len(mock.requests)
+    assert kudos.changed_activities(activities) == [activities[changed_id]]
+    assert kudos.sync(activities) == {changed_id: (2, 0)}
+    # only the kudos of the changed activity are refetched, its comment count did not change
+    assert {path for path, query in mock.requests[since:]} == {f"/api/v3/activities/{changed_id}/kudos"}
+    assert kudos.activity_deltas(changed_id)[-1][2:] == (activities[changed_id]["kudos_count"],
+                                                         activities[changed_id]["comment_count"], 2, 0)
+    assert kudos.sync(activities) == {}
@@ -0,0 +1,74 @@
+import socket
+import time
+
+import requests
+
+from api_cache import API
+from metrics import Metrics
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def test_render_format():
+    metrics = Metrics()
+    assert metrics.render() == ""
+    metrics.inc("api_requests_total", route="/athlete", result="hit")
+    metrics.observe("api_request_seconds", 0.2, route="/athlete", status=200)
+    for line in metrics.render().splitlines():
+        assert line.startswith("# TYPE ") or line.split(" ")[0].startswith("api_"), line
+
+
+def test_serve_content_type():
+    metrics = Metrics()
+    metrics.inc("api_requests_total", route="/athlete", result="miss")
+    port = free_port()
+    metrics.serve(port=port)
+    try:
+        for _ in range(50):
+            try:
+                r = requests.get(f"http://localhost:{port}/metrics", timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        assert r.status_code == 200
+        assert r.headers["Content-Type"] == "text/plain; version=0.0.4"
+        assert 'api_requests_total{result="miss",route="/athlete"} 1' in r.text
+    finally:
+        metrics.stop()
+
+
+def test_cache_results_without_extra_queries(mock, tmp_path):
+    metrics = Metrics()
+    api = API(mock.base_url, str(tmp_path / "cache.db"), rate_limits={10 ** 9: 1}, loglevel=None, metrics=metrics)
+
+    def selects():
+        return sum(h.count for (name, labels), h in metrics.histograms.items()
+                   if name == "cache_query_seconds" and dict(labels)["op"] == "select")
+
+    before = selects()
+    api.get("/athlete")
+    assert selects() - before == 1  # the lookup which missed tells miss from stale
+    api.get("/athlete")
+    time.sleep(0.01)
+    api.get("/athlete", max_age=0.005)
+    api.get("/athlete", max_age=0)
+    counts = {dict(labels)["result"]: value for (name, labels), value in metrics.counters.items()
+              if name == "api_requests_total"}
+    assert counts == {"miss": 1, "hit": 1, "stale": 1, "bypass": 1}
+
+
+def test_cached_empty_body_is_a_hit(mock, tmp_path):
+    metrics = Metrics()
+    api = API(mock.base_url, str(tmp_path / "cache.db"), rate_limits={10 ** 9: 1}, loglevel=None, metrics=metrics)
+    params = {"page": 10, "per_page": 200}  # past the last page
+    assert api.get("/athlete/activities", params) == []
+    served = len(mock.requests)
+    assert api.get("/athlete/activities", params) == []
+    assert len(mock.requests) == served
+    counts = {dict(labels)["result"]: value for (name, labels), value in metrics.counters.items()
+              if name == "api_requests_total"}
+    assert counts == {"miss": 1, "hit": 1}
@@ -0,0 +1,67 @@
+import json
+import time
+
+import pytest
+
+from api_cache import OfflineMissError
+from bare_strava_api import StravaAPIRoutes
+from change_feed import ChangeFeed
+
+
+def cache_versions(api, activity_id, ages):
+    """Fetches an activity once per age and rewrites the copies as versions "v0", "v1", ... cached `ages` seconds ago."""
+    for _ in ages:
+        api.get_activity(activity_id, max_age=0)
+    url = api.base_url + StravaAPIRoutes.detailed_activity.format(id=activity_id)
+    rows = api.cache.select(columns=["id", "response_json"], url=url, order_by="id")
+    now = time.time()
+    for i, ((row, body), age) in enumerate(zip(rows, ages)):
+        api.cache.update_row(row, called_at=now - age, response_json=json.dumps(dict(json.loads(body), name=f"v{i}")))
+    return now
+
+
+def test_offline_replay(mock, make_api):
+    online = make_api()
+    activity = online.get_activity(mock.activity_id(0))
+    # the empty page past the last activity is a cached answer too
+    empty_page = {"page": 9, "per_page": 200}
+    assert online.get(StravaAPIRoutes.list_activities, empty_page) == []
+
+    requests_before = len(mock.requests)
+    offline = make_api(offline=True)
+    assert offline.get_activity(mock.activity_id(0)) == activity
+    assert offline.get(StravaAPIRoutes.list_activities, empty_page) == []
+    with pytest.raises(OfflineMissError):
+        offline.get_activity(mock.activity_id(1))
+    assert len(mock.requests) == requests_before
+
+
+def test_as_of_replay(mock, make_api):
+    now = cache_versions(make_api(), mock.activity_id(0), (3000, 2000, 1000))
+    assert make_api(as_of=now - 1500, get_athlete=False).get_activity(mock.activity_id(0))["name"] == "v1"
+    assert make_api(as_of=now, get_athlete=False).get_activity(mock.activity_id(0))["name"] == "v2"
+    with pytest.raises(OfflineMissError) as e:
+        make_api(as_of=now - 3500, get_athlete=False).get_activity(mock.activity_id(0))
+    assert e.value.as_of == now - 3500
+
+
+def test_prune_keeps_replay_horizon(mock, make_api):
+    api = make_api()
+    activity_ids = mock.activity_id(0), mock.activity_id(1)
+    for activity_id in activity_ids:
+        now = cache_versions(api, activity_id, (10000, 5000, 1000))
+    ChangeFeed(api, replay_horizon=3600).attach()
+    api.get_activity(activity_ids[0], max_age=0)
+    # the copy an as_of just past the horizon reads and the ones since survive, older ones are deleted
+    assert make_api(as_of=now - 3600, get_athlete=False).get_activity(activity_ids[0])["name"] == "v1"
+    assert make_api(as_of=now - 1000, get_athlete=False).get_activity(activity_ids[0])["name"] == "v2"
+    with pytest.raises(OfflineMissError):
+        make_api(as_of=now - 9000, get_athlete=False).get_activity(activity_ids[0])
+
+    # without a horizon only the latest copy is kept
+    other = make_api()
+    ChangeFeed(other).attach()
+    other.get_activity(activity_ids[1], max_age=0)
+    assert make_api(as_of=time.time(), get_athlete=False).get_activity(activity_ids[1])["name"] == mock.activity(1)["name"]
+    with pytest.raises(OfflineMissError):
+        make_api(as_of=now - 1000, get_athlete=False).get_activity(activity_ids[1])
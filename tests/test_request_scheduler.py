@@ -0,0 +1,56 @@
+import threading
+import time
+
+from bare_strava_api import StravaAPIRoutes
+from request_scheduler import Priority, RequestScheduler
+
+
+def test_backfill_is_not_granted_ahead_of_interactive(mock, make_api):
+    api = make_api()
+    api.scheduler = RequestScheduler({10 ** 9: 1})
+    scheduler = api.scheduler
+    granted = []
+    grant = scheduler._grant
+    scheduler._grant = lambda: granted.append(scheduler.waiting[0][0]) or grant()
+    scheduler.pause(0.5)
+    threads = []
+    for i, priority in enumerate((Priority.backfill, Priority.backfill, Priority.interactive)):
+        threads.append(threading.Thread(target=api.get, args=(StravaAPIRoutes.detailed_activity, {"id": mock.activity_id(i)}),
+                                        kwargs={"priority": priority}))
+        threads[-1].start()
+        time.sleep(0.1)  # the backfills are queued first
+    for thread in threads:
+        thread.join()
+    # the interactive request arrived last but went first, the requests themselves may then reach the API in any order
+    assert granted == [Priority.interactive, Priority.backfill, Priority.backfill]
+
+
+def test_classes_stay_within_their_share(mock, make_api):
+    api = make_api()
+    api.scheduler = RequestScheduler({10: 3600})
+    since = len(mock.requests)
+    for i in range(5):
+        api.get(StravaAPIRoutes.detailed_activity, {"id": mock.activity_id(i)}, priority=Priority.backfill)
+    # half of the window is used up, the other half is kept for higher priorities
+    assert api.scheduler.wait_time(Priority.backfill) > 0
+    assert api.scheduler.wait_time(Priority.kudos) == api.scheduler.wait_time(Priority.interactive) == 0
+    for i in range(5, 9):
+        api.get(StravaAPIRoutes.detailed_activity, {"id": mock.activity_id(i)}, priority=Priority.sync)
+    assert api.scheduler.wait_time(Priority.sync) > 0 and api.scheduler.wait_time(Priority.interactive) == 0
+    api.get(StravaAPIRoutes.detailed_activity, {"id": mock.activity_id(9)})
+    assert api.scheduler.wait_time(Priority.interactive) > 0
+    assert len(mock.requests) - since == 10
+
+
+def test_rate_limited_request_is_retried_after_pause(mock, make_api):
+    api = make_api()
+    api.scheduler = RequestScheduler({10 ** 9: 1})
+    mock.error_rate = 1.0  # every request is answered with 429 until the timer resets it
+    threading.Timer(0.3, setattr, (mock, "error_rate", 0.0)).start()
+    since = len(mock.requests)
+    started = time.time()
+    activity = api.get(StravaAPIRoutes.detailed_activity, {"id": mock.activity_id(1)}, rate_limit_delay=0.5)
+    assert activity["id"] == mock.activity_id(1)
+    # the retry waited out the pause in the scheduler, instead of hammering the API
+    assert api.scheduler.paused_until >= started + 0.5 and time.time() >= api.scheduler.paused_until
+    assert len(mock.requests) - since == 2
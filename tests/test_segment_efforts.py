@@ -0,0 +1,37 @@
+import pytest
+
+from segment_efforts import SegmentEffortIndex
+
+
+def activity(activity_id, start_date, efforts):
+    """A detailed activity with one effort per (segment_id, elapsed_time)."""
+    return {"id": activity_id, "segment_efforts": [
+        {"id": activity_id * 100 + j, "segment": {"id": segment_id, "name": f"Segment {segment_id}"},
+         "start_date": start_date, "elapsed_time": elapsed_time}
+        for j, (segment_id, elapsed_time) in enumerate(efforts)]}
+
+
+@pytest.fixture
+def index(make_api):
+    index = SegmentEffortIndex(make_api())
+    index.index_activity(activity(1, "2021-01-03T08:00:00Z", [(7, 300), (8, 500)]))
+    index.index_activity(activity(2, "2021-01-04T08:00:00Z", [(7, 280)]))
+    index.index_activity(activity(3, "2024-12-30T08:00:00Z", [(7, 290), (9, 100)]))
+    return index
+
+
+def test_trend_iso_weeks(index):
+    assert [(t["period"], t["attempts"], t["best_elapsed_time"]) for t in index.trend(7, period="week")] == [
+        ("2020-W53", 1, 300), ("2021-W01", 1, 280), ("2025-W01", 1, 290)]
+    with pytest.raises(ValueError):
+        index.trend(7, period="fortnight")
+
+
+def test_segments_order_by(index):
+    assert [s["segment_id"] for s in index.segments()] == [7, 8, 9]
+    assert [s["segment_id"] for s in index.segments("best_elapsed_time")] == [9, 7, 8]
+    assert [s["segment_id"] for s in index.segments("last_date desc", limit=2)] == [7, 9]
+    for order_by in ("attempts; DROP TABLE segments", "(SELECT 1)", "attempts DESC, name", "best_elapsed_time sideways"):
+        with pytest.raises(ValueError):
+            index.segments(order_by)
+    assert len(index.segments()) == 3
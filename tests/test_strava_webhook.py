@@ -0,0 +1,81 @@
+import json
+import threading
+
+from bare_strava_api import StravaAPIRoutes
+from change_feed import ChangeFeed
+from strava_webhook import StravaWebhook, synthetic_event
+
+
+def list_pages(api):
+    url = api.base_url + StravaAPIRoutes.list_activities
+    pages = [api.cache.codec.loads(body) for body in api.cache.select(columns="response_json", url=url, order_by="id")]
+    return sorted((page for page in pages if page), key=len, reverse=True)
+
+
+def test_delete_keeps_cached_pages_full(mock, make_api):
+    api = make_api()
+    activities = api.list_all_activities()
+    webhook = StravaWebhook(api)
+    deleted = api.activity_ids[5]
+    webhook.handle_event(synthetic_event("delete", deleted, owner_id=api.athlete_id))
+
+    assert [len(page) for page in list_pages(api)] == [200, 200, 50]
+    assert deleted not in activities and deleted not in api.activity_ids
+    # a second client pages through the cache past the tombstone without asking Strava
+    other = make_api()
+    requests_before = len(mock.requests)
+    pages = other.list_activity_pages(expected_pages=1)
+    assert [len(page) for page in pages] == [199, 200, 50]
+    assert len(mock.requests) == requests_before
+    assert len(other.list_all_activities()) == mock.n_activities - 1
+
+
+def test_concurrent_updates(mock, make_api):
+    api = make_api()
+    api.list_all_activities()
+    webhook = StravaWebhook(api, fetch_streams=False)
+    ids = api.activity_ids[:40]
+    futures = [webhook.handle_event(synthetic_event("update", i, owner_id=api.athlete_id)) for i in ids]
+    threads = [threading.Thread(target=webhook.delete_activity, args=(i,)) for i in api.activity_ids[100:110]]
+    for thread in threads:
+        thread.start()
+    for future in futures:
+        future.result()
+    for thread in threads:
+        thread.join()
+    assert len(api.all_activities) == mock.n_activities - 10
+    assert api.activity_ids == list(api.all_activities)
+    assert all(i in api.all_activities for i in ids)
+
+
+def test_update_is_recorded_in_change_feed(mock, make_api):
+    api = make_api()
+    api.list_all_activities()
+    feed = ChangeFeed(api).attach()
+    webhook = StravaWebhook(api, fetch_streams=False)
+    activity_id = api.activity_ids[3]
+    activity = api.get_activity(activity_id)
+    assert feed.changes() == []
+    # the copy cached before the athlete renamed the activity on Strava
+    url = api.base_url + StravaAPIRoutes.detailed_activity.format(id=activity_id)
+    api.cache.update_row(api.cache.select(columns="id", url=url)[0], response_json=json.dumps(dict(activity, name="Old title")))
+
+    webhook.handle_event(synthetic_event("update", activity_id, owner_id=api.athlete_id, updates={"title": activity["name"]})).result()
+
+    assert [(c["object_id"], c["path"], c["old"], c["new"]) for c in feed.poll("test")] == [
+        (activity_id, "name", "Old title", activity["name"])]
+    assert api.cache.count(url=url) == 1
+    assert api.all_activities[activity_id]["name"] == activity["name"]
+
+
+def test_deleted_activity_is_not_listed(mock, make_api):
+    api = make_api()
+    api.list_all_activities()
+    deleted = api.activity_ids[5]
+    StravaWebhook(api).handle_event(synthetic_event("delete", deleted, owner_id=api.athlete_id))
+
+    page = api.list_athlete_activities(per_page=200)
+    assert len(page) == 199 and deleted not in [a["id"] for a in page]
+    # the cached pages (tombstone included) are listed again from the start
+    activities = api.list_all_activities(after=None)
+    assert len(activities) == mock.n_activities - 1 and deleted not in activities
@@ -0,0 +1,46 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from stream_lod import StreamPyramid, visvalingam_areas  # noqa: E402
+
+
+def test_visvalingam_areas():
+    lat = np.array([0.0, 0.0, 1.0, 0.0, 0.0])
+    lng = np.array([0.0, 1.0, 2.0, 3.0, 4.0])
+    areas = visvalingam_areas(lat, lng)
+    assert np.isinf(areas[0]) and np.isinf(areas[-1])
+    # the peak matters most, the points on the baseline next to it go first
+    assert areas[2] == areas[1:-1].max()
+
+
+def test_cold_streams_are_built_once(mock, make_api):
+    api = make_api()
+    pyramid = StreamPyramid(api).attach()
+    builds = []
+    build = pyramid.build
+    pyramid.build = lambda *args: builds.append(args[0]) or build(*args)
+    activity_id = mock.activity_id(0)
+
+    chart = pyramid.chart(activity_id, "heartrate", max_points=100)
+    assert len(chart["time"]) <= 100
+    assert builds == [activity_id]
+    pyramid.chart(activity_id, "latlng", max_points=100)
+    assert builds == [activity_id]
+
+
+def test_streams_without_pyramid_are_built(mock, make_api):
+    api = make_api()
+    activity_id = mock.activity_id(1)
+    streams = api.get_activity_streams(activity_id)
+    pyramid = StreamPyramid(api)
+    # an earlier response only had the heart rate
+    pyramid.build(activity_id, {k: streams[k] for k in ("time", "heartrate")})
+    builds = []
+    build = pyramid.build
+    pyramid.build = lambda *args: builds.append(sorted(StreamPyramid.stream_data(args[1]))) or build(*args)
+
+    assert len(pyramid.chart(activity_id, "latlng", max_points=100)["time"]) <= 100
+    assert "heartrate" not in builds[0] and "latlng" in builds[0]
+    pyramid.chart(activity_id, "altitude", max_points=100)
+    assert len(builds) == 1
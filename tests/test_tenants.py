@@ -0,0 +1,65 @@
+import time
+
+import pytest
+import yaml
+
+from request_scheduler import RequestScheduler
+from tenants import TenantAPI, TenantManager
+
+
+@pytest.fixture
+def manager(mock, tmp_path, monkeypatch):
+    monkeypatch.setattr(TenantAPI, "base_url", mock.base_url)
+    app_secrets = tmp_path / "secrets.yaml"
+    app_secrets.write_text(yaml.dump({"client_id": 1, "client_secret": "secret"}))
+    manager = TenantManager(tmp_path / "tenants", app_secrets, scheduler=RequestScheduler({10 ** 9: 1}), refresh_margin=60)
+    yield manager
+    manager.stop()
+
+
+def add_athlete(manager, athlete_id, expires_in=3600):
+    tenant_dir = manager.tenant_dir(athlete_id)
+    tenant_dir.mkdir(parents=True)
+    (tenant_dir / "secrets.yaml").write_text(yaml.dump({
+        "access_token": f"token{athlete_id}", "refresh_token": f"refresh{athlete_id}", "expires_at": time.time() + expires_in}))
+
+
+def test_tenants_have_their_own_shard(mock, manager):
+    for athlete_id in (1, 2):
+        add_athlete(manager, athlete_id)
+    first, second = manager[1], manager[2]
+    assert manager[1] is first and manager.athlete_ids() == [1, 2]
+    assert first.headers == {"Authorization": "Bearer token1"} and second.headers == {"Authorization": "Bearer token2"}
+    assert first.scheduler is second.scheduler is manager.scheduler
+    assert (first.tenant, second.tenant) == (1, 2)
+
+    first.get_activity(mock.activity_id(0))
+    assert first.cache.count() == 1 and second.cache.count() == 0
+    assert first.cache_db != second.cache_db and first.cache.conn is not second.cache.conn
+    with pytest.raises(KeyError):
+        manager[3]
+
+
+def test_tokens_are_refreshed_before_they_expire(manager, monkeypatch):
+    refreshed = []
+
+    def refresh(api):
+        refreshed.append(api.athlete_id)
+        api.expires_at = time.time() + 3600
+
+    monkeypatch.setattr(TenantAPI, "refresh", refresh)
+    add_athlete(manager, 1, expires_in=manager.refresh_margin + 0.3)
+    add_athlete(manager, 2)
+    add_athlete(manager, 3, expires_in=manager.refresh_margin - 1)
+    apis = [manager[athlete_id] for athlete_id in (1, 2, 3)]
+    assert refreshed == [3]  # about to expire when opened
+    manager.start()
+    deadline = time.time() + 5
+    while (refreshed != [3, 1] or len(manager._expiry) < 3) and time.time() < deadline:
+        time.sleep(0.05)
+    assert refreshed == [3, 1]
+    # every open athlete stays in the heap, ordered by its new expiry
+    with manager.condition:
+        assert sorted(athlete_id for _, athlete_id in manager._expiry) == [1, 2, 3]
+        assert manager._expiry[0][1] == 2
+    assert all(api.expires_in > manager.refresh_margin for api in apis)